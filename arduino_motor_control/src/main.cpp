@@ -6,6 +6,8 @@
     1395/02/29
 
     Refactored 1400/07/17
+
+    Framed binary protocol 1405/07/26
 */
 
 #include <Arduino.h>
@@ -18,11 +20,31 @@ int enB = 10; // the PWM pin of Motor B
 int in3 = 11; // the Direction pin 1 of Motor B
 int in4 = 12; // the Direction pin 2 of Motor B
 
-signed int cmdSpeedA = 0; // the command for desired PWM of Motor A (0~254) - 255 = 0xFF is reserved for packet first character
-signed int cmdSpeedB = 0; // the command for desired PWM of Motor B (0~254) - 255 = 0xFF is reserved for packet first character
+/*
+    Framed protocol (see desktop_vision_app/src/serial_protocol.py)
+
+    Every frame is COBS encoded and terminated by a 0x00 byte. Before encoding:
+    version (1) | type (1) | sequence (1) | payload (n) | CRC-16/CCITT-FALSE (2)
+    Multi-byte fields are little endian.
 
-unsigned char packet[3]; // packet frame is: {0xFF, cmdSpeedA, cmdSpeedB}
-unsigned char index = 0;
+    Motor command payload: speedA (int16) | speedB (int16), full scale is +-32767
+    Status payload: acknowledged sequence (1) | pwmA (int16) | pwmB (int16) | receive errors (uint16)
+*/
+#define PROTOCOL_VERSION 1
+#define FRAME_TYPE_MOTOR_COMMAND 0x01
+#define FRAME_TYPE_STATUS 0x02
+#define MOTOR_SPEED_SCALE 32767L
+#define MAX_FRAME_LENGTH 64
+
+unsigned char rxBuffer[MAX_FRAME_LENGTH]; // COBS encoded bytes of the frame being received
+unsigned char rxLength = 0;
+bool rxOverflow = false;
+uint16_t rxErrorCount = 0; // frames with bad framing, CRC, version or length
+
+int cmdPwmA = 0; // the command for desired PWM of Motor A (-255~255)
+int cmdPwmB = 0; // the command for desired PWM of Motor B (-255~255)
+unsigned char cmdSequence = 0;
+unsigned char statusSequence = 0;
 bool packetReceived = false;
 
 void motorA(int motorSpeed)
@@ -97,24 +119,130 @@ void setup()
 
   motorA(0);
   motorB(0);
+}
+
+uint16_t crc16(const unsigned char *data, unsigned char length)
+{
+  uint16_t crc = 0xFFFF;
+  for (unsigned char i = 0; i < length; i++)
+  {
+    crc ^= (uint16_t)data[i] << 8;
+    for (unsigned char bit = 0; bit < 8; bit++)
+    {
+      if (crc & 0x8000)
+        crc = (uint16_t)((crc << 1) ^ 0x1021);
+      else
+        crc = (uint16_t)(crc << 1);
+    }
+  }
+  return crc;
+}
+
+// Returns the decoded length, or 0 if the COBS data is invalid
+unsigned char cobsDecode(const unsigned char *encoded, unsigned char length, unsigned char *decoded)
+{
+  unsigned char readIndex = 0;
+  unsigned char writeIndex = 0;
+
+  while (readIndex < length)
+  {
+    unsigned char code = encoded[readIndex];
+    if (code == 0 || readIndex + code > length)
+      return 0;
+    readIndex++;
+    for (unsigned char i = 1; i < code; i++)
+      decoded[writeIndex++] = encoded[readIndex++];
+    if (code < 0xFF && readIndex < length)
+      decoded[writeIndex++] = 0;
+  }
+  return writeIndex;
+}
+
+// Encodes data and writes it to the serial port followed by the delimiter
+void writeCobsFrame(const unsigned char *data, unsigned char length)
+{
+  unsigned char encoded[MAX_FRAME_LENGTH];
+  unsigned char codeIndex = 0;
+  unsigned char writeIndex = 1;
+  unsigned char code = 1;
+
+  for (unsigned char i = 0; i < length; i++)
+  {
+    if (data[i] == 0)
+    {
+      encoded[codeIndex] = code;
+      codeIndex = writeIndex++;
+      code = 1;
+    }
+    else
+    {
+      encoded[writeIndex++] = data[i];
+      code++;
+    }
+  }
+  encoded[codeIndex] = code;
+  encoded[writeIndex++] = 0;
+
+  Serial.write(encoded, writeIndex);
+}
+
+void sendStatus(unsigned char acknowledgedSequence)
+{
+  unsigned char frame[12];
+  frame[0] = PROTOCOL_VERSION;
+  frame[1] = FRAME_TYPE_STATUS;
+  frame[2] = statusSequence++;
+  frame[3] = acknowledgedSequence;
+  frame[4] = cmdPwmA & 0xFF;
+  frame[5] = (cmdPwmA >> 8) & 0xFF;
+  frame[6] = cmdPwmB & 0xFF;
+  frame[7] = (cmdPwmB >> 8) & 0xFF;
+  frame[8] = rxErrorCount & 0xFF;
+  frame[9] = (rxErrorCount >> 8) & 0xFF;
+  uint16_t crc = crc16(frame, 10);
+  frame[10] = crc & 0xFF;
+  frame[11] = (crc >> 8) & 0xFF;
+
+  writeCobsFrame(frame, 12);
+}
+
+void processFrame()
+{
+  unsigned char frame[MAX_FRAME_LENGTH];
+  unsigned char length = cobsDecode(rxBuffer, rxLength, frame);
+
+  // version, type, sequence, 2 x int16 speed, CRC
+  if (length != 9)
+  {
+    rxErrorCount++;
+    return;
+  }
 
-  Serial.println("[ ARDUINO ] It all started :))");
+  uint16_t crc = frame[7] | ((uint16_t)frame[8] << 8);
+  if (crc != crc16(frame, 7) || frame[0] != PROTOCOL_VERSION || frame[1] != FRAME_TYPE_MOTOR_COMMAND)
+  {
+    rxErrorCount++;
+    return;
+  }
+
+  int16_t speedA = (int16_t)(frame[3] | ((uint16_t)frame[4] << 8));
+  int16_t speedB = (int16_t)(frame[5] | ((uint16_t)frame[6] << 8));
+
+  cmdPwmA = (long)speedA * 255 / MOTOR_SPEED_SCALE; // cmdPwmA is between -255 ~ 255
+  cmdPwmB = (long)speedB * 255 / MOTOR_SPEED_SCALE; // cmdPwmB is between -255 ~ 255
+  cmdSequence = frame[2];
+  packetReceived = true;
 }
 
 void loop()
 {
   if (packetReceived)
   {
-    Serial.print("[ ARDUINO ] Received: cmdSpeedA = ");
-    Serial.print(cmdSpeedA);
-    Serial.print(" , cmdSpeedB = ");
-    Serial.println(cmdSpeedB);
-
-    cmdSpeedA = map(cmdSpeedA, 0, 254, -255, 255); // cmdSpeedA is mapped between -255 ~ 255
-    cmdSpeedB = map(cmdSpeedB, 0, 254, -255, 255); // cmdSpeedB is mapped between -255 ~ 255
+    motorA(cmdPwmA);
+    motorB(cmdPwmB);
 
-    motorA(cmdSpeedA);
-    motorB(cmdSpeedB);
+    // Acknowledge the command instead of printing it
+    sendStatus(cmdSequence);
 
     packetReceived = false;
   }
@@ -125,6 +253,9 @@ void loop()
     hardware serial RX.  This routine is run between each
     time loop() runs, so using delay inside loop can delay
     response.  Multiple bytes of data may be available.
+
+    Bytes are collected until the 0x00 delimiter, so a corrupted frame
+    only loses that frame and the next one starts at the delimiter.
 */
 void serialEvent()
 {
@@ -132,25 +263,25 @@ void serialEvent()
   {
     // get the new byte:
     unsigned char inChar = (unsigned char)Serial.read();
-    packet[index] = inChar;
-    index++;
 
-    if (index == 3)
+    if (inChar == 0)
     {
-      if (packet[0] == 0xFF)
-      {
-        index = 0;
-        cmdSpeedA = packet[1];
-        cmdSpeedB = packet[2];
-        packetReceived = true;
+      if (rxOverflow)
+        rxErrorCount++;
+      else if (rxLength > 0)
+        processFrame();
+      rxLength = 0;
+      rxOverflow = false;
+      if (packetReceived)
         break;
-      }
-      else
-      {
-        packet[0] = packet[1];
-        packet[1] = packet[2];
-        index = 2;
-      }
+    }
+    else if (rxLength < MAX_FRAME_LENGTH)
+    {
+      rxBuffer[rxLength++] = inChar;
+    }
+    else
+    {
+      rxOverflow = true;
     }
   }
 }
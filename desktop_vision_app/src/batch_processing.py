@@ -0,0 +1,340 @@
+# Processes a recorded video or a directory of images as fast as possible
+# and writes the joint positions of every frame as columns (.npz or .csv)
+
+# Image processing
+import cv2 as cv
+
+# Command line options
+import argparse
+
+# Path of files
+import pathlib
+
+# Frames waiting for their detection results
+from collections import deque
+
+# for measuring throughput
+import time
+
+import numpy as np
+
+from image_processing import (
+    MARKER_COLOR_NAMES,
+    MAX_DIAMETER_CM,
+    PIXEL_TO_CM_RATIO,
+    compute_joint_positions_cm,
+    crop_image,
+    find_marker_centers,
+    set_color_profile,
+)
+
+# Marker colors learned by hsv_calibration.py
+from color_calibration import COLOR_PROFILES_PATH, load_color_profile
+
+# Reusable buffers of intermediate images
+from frame_context import FrameContext
+
+# Search windows around the previous marker positions
+from marker_tracking import MarkerTracker
+
+# Marker detection in a pool of worker processes
+from parallel_detection import ParallelDetector
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+# Frames per second of image directories and of videos which do not tell it
+DEFAULT_FRAME_RATE = 25.0
+
+PROGRESS_INTERVAL = 5.0  # in seconds
+
+# A result taking longer than this means a worker process has died
+RESULT_TIMEOUT = 30.0  # in seconds
+
+
+def get_column_types():
+    # Column name -> dtype of the output, positions are NaN when not detected
+    columnTypes = {
+        "frame_index": np.int64,
+        "timestamp": np.float64,
+        "success": np.bool_,
+    }
+    for colorName in MARKER_COLOR_NAMES:
+        columnTypes[colorName + "_detected"] = np.bool_
+        for axis in ("x", "y"):
+            columnTypes["{}_{}_px".format(colorName, axis)] = np.float64
+    for colorName in MARKER_COLOR_NAMES:
+        for axis in ("x", "y"):
+            columnTypes["{}_{}_cm".format(colorName, axis)] = np.float64
+    return columnTypes
+
+
+class ColumnBuffer:
+    # Growing NumPy arrays, one per column, filled row by row
+    def __init__(self, columnTypes, capacity=1024):
+        self.rowCount = 0
+        self.columns = {
+            name: np.empty(capacity, columnType)
+            for name, columnType in columnTypes.items()
+        }
+
+    def append(self, row):
+        capacity = len(self.columns["frame_index"])
+        if self.rowCount == capacity:
+            for name, column in self.columns.items():
+                grownColumn = np.empty(2 * capacity, column.dtype)
+                grownColumn[:capacity] = column
+                self.columns[name] = grownColumn
+        for name, value in row.items():
+            self.columns[name][self.rowCount] = value
+        self.rowCount += 1
+
+    def get_columns(self):
+        return {name: column[: self.rowCount] for name, column in self.columns.items()}
+
+
+class Progress:
+    # Prints the number of processed frames and the frame rate from time to time
+    def __init__(self):
+        self.startTime = time.monotonic()
+        self.nextPrintTime = self.startTime + PROGRESS_INTERVAL
+
+    def update(self, frameCount):
+        now = time.monotonic()
+        if now >= self.nextPrintTime:
+            print(
+                "[  BATCH  ] {} frames, {:.1f} fps".format(
+                    frameCount, frameCount / (now - self.startTime)
+                )
+            )
+            self.nextPrintTime = now + PROGRESS_INTERVAL
+
+
+def make_row(frameIndex, timestamp, markerCenters):
+    success = all(centerReady for centerReady, center in markerCenters.values())
+    row = {"frame_index": frameIndex, "timestamp": timestamp, "success": success}
+
+    for colorName in MARKER_COLOR_NAMES:
+        centerReady, center = markerCenters[colorName]
+        row[colorName + "_detected"] = centerReady
+        row[colorName + "_x_px"] = center.x if centerReady else np.nan
+        row[colorName + "_y_px"] = center.y if centerReady else np.nan
+
+    jointPositionsCm = (None,) * len(MARKER_COLOR_NAMES)
+    if success:
+        jointPositionsCm = compute_joint_positions_cm(
+            markerCenters["green"][1], markerCenters["blue"][1], markerCenters["red"][1]
+        )
+    for colorName, positionCm in zip(MARKER_COLOR_NAMES, jointPositionsCm):
+        row[colorName + "_x_cm"] = np.nan if positionCm is None else positionCm.x
+        row[colorName + "_y_cm"] = np.nan if positionCm is None else positionCm.y
+
+    return row
+
+
+def read_video_frames(videoPath, frameRate=None):
+    # Yields (frame index, timestamp in seconds, BGR frame). The frame buffer
+    # is reused, so a frame is only valid until the next one is read
+    videoCapture = cv.VideoCapture(videoPath)
+    if not videoCapture.isOpened():
+        raise IOError("cannot open video: {}".format(videoPath))
+    if frameRate is None:
+        frameRate = videoCapture.get(cv.CAP_PROP_FPS) or DEFAULT_FRAME_RATE
+
+    frameIndex = 0
+    frame = None
+    try:
+        while True:
+            success, frame = videoCapture.read(frame)
+            if not success:
+                break
+            yield frameIndex, frameIndex / frameRate, frame
+            frameIndex += 1
+    finally:
+        videoCapture.release()
+
+
+def read_image_frames(directoryPath, frameRate=None):
+    # Yields (frame index, timestamp in seconds, BGR frame) of the images of
+    # a directory in the order of their file names
+    if frameRate is None:
+        frameRate = DEFAULT_FRAME_RATE
+    imagePaths = sorted(
+        path
+        for path in pathlib.Path(directoryPath).iterdir()
+        if path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+    for frameIndex, imagePath in enumerate(imagePaths):
+        frame = cv.imread(str(imagePath))
+        if frame is None:
+            print("[  BATCH  ] Cannot read {}".format(imagePath))
+            continue
+        yield frameIndex, frameIndex / frameRate, frame
+
+
+def read_frames(source, frameRate=None):
+    if pathlib.Path(source).is_dir():
+        return read_image_frames(source, frameRate)
+    return read_video_frames(source, frameRate)
+
+
+def process_frames(frames, aspectRatio, pyramidLevels=0, trackingEnabled=True):
+    # Detects the markers of each frame in this thread, returns the columns
+    frameContext = FrameContext()
+    markerTracker = None
+    if trackingEnabled:
+        markerTracker = MarkerTracker(MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO)
+
+    columnBuffer = ColumnBuffer(get_column_types())
+    progress = Progress()
+    for frameIndex, timestamp, frame in frames:
+        frameContext.reset_stage_times()
+        markerCenters = find_marker_centers(
+            crop_image(frame, aspectRatio), markerTracker, pyramidLevels, frameContext
+        )
+        columnBuffer.append(make_row(frameIndex, timestamp, markerCenters))
+        progress.update(columnBuffer.rowCount)
+
+    return columnBuffer.get_columns()
+
+
+def process_frames_in_parallel(
+    frames, aspectRatio, pyramidLevels=0, workerCount=None, colorProfile=None
+):
+    # Detects the markers in worker processes (without tracking), frames are
+    # read and cropped while workers process the previous ones
+    parallelDetector = ParallelDetector(
+        workerCount, pyramidLevels=pyramidLevels, colorProfile=colorProfile
+    )
+    parallelDetector.start()
+
+    columnBuffer = ColumnBuffer(get_column_types())
+    progress = Progress()
+
+    # Frame indexes of the submitted frames in order, results come back in it
+    pendingFrameIndexes = deque()
+
+    def take_result():
+        frameIndex = pendingFrameIndexes.popleft()
+        result = parallelDetector.get_result(0, RESULT_TIMEOUT)
+        if result is None:
+            raise RuntimeError(
+                "no detection result for frame {} after {} s, "
+                "a worker process may have died".format(frameIndex, RESULT_TIMEOUT)
+            )
+        parallelDetector.release(result)
+        if result.markerCenters is None:
+            print(
+                "[  BATCH  ] Frame {} failed: {}".format(result.frameId, result.error)
+            )
+            return
+        columnBuffer.append(
+            make_row(result.frameId, result.timestamp, result.markerCenters)
+        )
+        progress.update(columnBuffer.rowCount)
+
+    try:
+        for frameIndex, timestamp, frame in frames:
+            croppedImage = crop_image(frame, aspectRatio)
+            # Wait for the oldest result when all slots are busy
+            while not parallelDetector.submit(0, frameIndex, croppedImage, timestamp):
+                take_result()
+            pendingFrameIndexes.append(frameIndex)
+        while len(pendingFrameIndexes) > 0:
+            take_result()
+    finally:
+        parallelDetector.stop()
+
+    return columnBuffer.get_columns()
+
+
+def save_columns(columns, outputPath):
+    # .npz keeps the column dtypes, .csv has a header line with column names
+    outputPath = pathlib.Path(outputPath)
+    if outputPath.suffix == ".npz":
+        np.savez_compressed(outputPath, **columns)
+    elif outputPath.suffix == ".csv":
+        columnFormats = []
+        for column in columns.values():
+            if column.dtype == np.float64:
+                columnFormats.append("%.3f")
+            else:
+                columnFormats.append("%d")
+        np.savetxt(
+            outputPath,
+            np.column_stack(list(columns.values())),
+            fmt=columnFormats,
+            delimiter=",",
+            header=",".join(columns.keys()),
+            comments="",
+        )
+    else:
+        raise ValueError("unknown output format: {}".format(outputPath.suffix))
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Find joint positions in a video file or image directory"
+    )
+    parser.add_argument("source", help="video file or directory of images")
+    parser.add_argument("output", help="output file (.npz or .csv)")
+    parser.add_argument("--aspect-ratio", type=float, default=1.3)
+    parser.add_argument("--pyramid-levels", type=int, default=0)
+    parser.add_argument(
+        "--frame-rate",
+        type=float,
+        help="frames per second for timestamps (default: from the video)",
+    )
+    parser.add_argument(
+        "--no-tracking",
+        dest="tracking",
+        action="store_false",
+        help="always search markers in the full frame",
+    )
+    parser.add_argument(
+        "--color-profile", help="marker colors saved by hsv_calibration.py"
+    )
+    parser.add_argument("--color-profiles-file", default=COLOR_PROFILES_PATH)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="detect markers in this many processes (0 uses this process)",
+    )
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    args = parse_arguments(arguments)
+    frames = read_frames(args.source, args.frame_rate)
+    colorProfile = None
+    if args.color_profile is not None:
+        colorProfile = load_color_profile(args.color_profile, args.color_profiles_file)
+        set_color_profile(colorProfile)
+
+    startTime = time.monotonic()
+    if args.workers > 0:
+        columns = process_frames_in_parallel(
+            frames, args.aspect_ratio, args.pyramid_levels, args.workers, colorProfile
+        )
+    else:
+        columns = process_frames(
+            frames, args.aspect_ratio, args.pyramid_levels, args.tracking
+        )
+    elapsedTime = time.monotonic() - startTime
+
+    save_columns(columns, args.output)
+
+    frameCount = len(columns["frame_index"])
+    print(
+        "[  BATCH  ] {} frames in {:.1f} s ({:.1f} fps), {} detected, saved to {}".format(
+            frameCount,
+            elapsedTime,
+            frameCount / elapsedTime if elapsedTime > 0 else 0.0,
+            int(np.count_nonzero(columns["success"])),
+            args.output,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
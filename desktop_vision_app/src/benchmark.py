@@ -0,0 +1,346 @@
+# Benchmarks of the vision pipeline which run without camera or serial port
+# Per-stage timings, frame rate and detection accuracy are written as JSON
+
+# Image processing
+import cv2 as cv
+
+# Command line options
+import argparse
+
+# Suppress per-frame prints of the control algorithm
+import contextlib
+import io
+
+# Output format
+import json
+
+# Marker geometry of synthetic frames and center errors
+import math
+
+# Path of files
+import pathlib
+
+# Environment information
+import platform
+
+# for measuring elapsed time
+import time
+
+import numpy as np
+
+from image_processing import *
+
+from blob_extraction import BLOB_BACKENDS, extract_blobs, select_blob
+
+SRC_PATH = pathlib.Path(__file__).parent.resolve()
+SAMPLE_FRAME_PATH = str(SRC_PATH.parent.resolve().joinpath("assets/sample_frame.jpg"))
+
+SYNTHETIC_RESOLUTIONS = ((640, 480), (1280, 960), (1920, 1440))
+
+
+def legacy_find_center(filteredImage):
+    # find_center() as it was before blob extraction backends, kept as baseline
+    success = False
+    center = Point(0, 0)
+
+    contours, hierarchy = cv.findContours(
+        filteredImage, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
+    )
+
+    for contour in contours:
+        moment = cv.moments(contour)
+        if moment["m00"] != 0:
+            x = int(moment["m10"] / moment["m00"])
+            y = int(moment["m01"] / moment["m00"])
+            contourArea = cv.contourArea(contour)
+            if (contourArea > MIN_CONTOUR_AREA) and (contourArea < MAX_CONTOUR_AREA):
+                success = True
+                center = Point(x, y)
+
+    return success, center
+
+
+def time_function(function, repeat):
+    # Mean execution time of a function in milliseconds
+    startTime = time.perf_counter()
+    for iteration in range(repeat):
+        function()
+    return (time.perf_counter() - startTime) * 1000 / repeat
+
+
+def hsv_to_bgr(hsv):
+    pixel = np.uint8([[[hsv.hue, hsv.saturation, hsv.value]]])
+    return tuple(int(channel) for channel in cv.cvtColor(pixel, cv.COLOR_HSV2BGR)[0, 0])
+
+
+def get_marker_radius_pixels():
+    # Marker size in pixels is the one the contour area limits expect
+    return math.sqrt(EXPECTED_CONTOUR_AREA / math.pi)
+
+
+def generate_marker_centers(width, height, randomGenerator):
+    # Random (subpixel) centers of the markers, apart from each other and the borders
+    margin = 2 * get_marker_radius_pixels()
+    markerCenters = {}
+
+    for colorName in MARKER_COLOR_NAMES:
+        while True:
+            center = Point(
+                randomGenerator.uniform(margin, width - margin),
+                randomGenerator.uniform(margin, height - margin),
+            )
+            if all(
+                math.hypot(center.x - other.x, center.y - other.y) > 3 * margin
+                for other in markerCenters.values()
+            ):
+                break
+        markerCenters[colorName] = center
+
+    return markerCenters
+
+
+def generate_synthetic_frame(width, height, markerCenters, randomGenerator):
+    # Noisy background with a disc of each calibrated marker color at its center
+    frame = np.full((height, width, 3), 90, np.uint8)
+    noise = randomGenerator.normal(0, 8, frame.shape)
+    frame = np.clip(frame + noise, 0, 255).astype(np.uint8)
+
+    markerHsvs = {
+        "green": CALIBRATED_HSV_GREEN,
+        "blue": CALIBRATED_HSV_BLUE,
+        "red": CALIBRATED_HSV_RED,
+    }
+
+    # Draw with 4 fractional bits for subpixel centers
+    shift = 4
+    for colorName, center in markerCenters.items():
+        cv.circle(
+            frame,
+            (int(center.x * (1 << shift)), int(center.y * (1 << shift))),
+            int(get_marker_radius_pixels() * (1 << shift)),
+            hsv_to_bgr(markerHsvs[colorName]),
+            -1,
+            cv.LINE_AA,
+            shift,
+        )
+
+    return frame
+
+
+def build_sample_test_set(samplePath, aspectRatio, frameCount=8):
+    # Frames of the sample image moved by a few pixels per frame, as markers do
+    # Reference centers are the detections on the unmoved frame
+    sampleFrame = crop_image(cv.imread(samplePath), aspectRatio)
+    markerCenters = find_marker_centers(sampleFrame)
+
+    frames = []
+    for index in range(frameCount):
+        dx = 2 * index
+        dy = index
+        frame = np.roll(sampleFrame, (dy, dx), axis=(0, 1))
+        trueCenters = {
+            colorName: Point(center.x + dx, center.y + dy)
+            for colorName, (centerReady, center) in markerCenters.items()
+            if centerReady
+        }
+        frames.append((frame, trueCenters))
+
+    return frames
+
+
+def build_synthetic_test_set(width, height, frameCount=8, seed=0):
+    # Markers start at random positions and move a few pixels per frame
+    randomGenerator = np.random.default_rng(seed)
+    markerCenters = generate_marker_centers(width, height, randomGenerator)
+    velocities = {
+        colorName: randomGenerator.uniform(-3, 3, 2) for colorName in markerCenters
+    }
+
+    frames = []
+    for index in range(frameCount):
+        trueCenters = {
+            colorName: Point(
+                center.x + index * velocities[colorName][0],
+                center.y + index * velocities[colorName][1],
+            )
+            for colorName, center in markerCenters.items()
+        }
+        frame = generate_synthetic_frame(width, height, trueCenters, randomGenerator)
+        frames.append((frame, trueCenters))
+
+    return frames
+
+
+def measure_accuracy(frames):
+    # Detection rate and center errors in pixels of find_marker_centers()
+    detectedCount = 0
+    markerCount = 0
+    errors = []
+
+    for frame, trueCenters in frames:
+        markerCenters = find_marker_centers(frame)
+        for colorName, trueCenter in trueCenters.items():
+            markerCount += 1
+            centerReady, center = markerCenters[colorName]
+            if centerReady:
+                detectedCount += 1
+                errors.append(
+                    math.hypot(center.x - trueCenter.x, center.y - trueCenter.y)
+                )
+
+    return {
+        "markers": markerCount,
+        "detectionRate": detectedCount / max(1, markerCount),
+        "meanErrorPixels": float(np.mean(errors)) if errors else None,
+        "maxErrorPixels": float(np.max(errors)) if errors else None,
+    }
+
+
+def benchmark_stages(frames, aspectRatio, repeat):
+    # Mean time in milliseconds of each pipeline stage over the frames
+    images = [frame for frame, trueCenters in frames]
+    hsvImages = [cv.cvtColor(image, cv.COLOR_BGR2HSV) for image in images]
+    segmenter = COLOR_CALIBRATION.get_segmenter()
+    frameContext = FrameContext()
+    masks = [dict(segmenter.segment(hsvImage)) for hsvImage in hsvImages]
+
+    def run_over_frames(function, inputs):
+        return lambda: [function(item) for item in inputs]
+
+    frameCount = len(images)
+    stages = {
+        "crop_image": run_over_frames(
+            lambda image: crop_image(image, aspectRatio), images
+        ),
+        "cvtColor_hsv": run_over_frames(
+            lambda image: cv.cvtColor(image, cv.COLOR_BGR2HSV), images
+        ),
+        "filter_color": run_over_frames(
+            lambda hsvImage: [
+                filter_color(hsvImage, colorName) for colorName in MARKER_COLOR_NAMES
+            ],
+            hsvImages,
+        ),
+        "segmentation": run_over_frames(
+            lambda hsvImage: segmenter.segment(hsvImage, frameContext=frameContext),
+            hsvImages,
+        ),
+        "find_center": run_over_frames(
+            lambda frameMasks: [find_center(mask) for mask in frameMasks.values()],
+            masks,
+        ),
+        "find_join_positions": run_over_frames(find_join_positions, images),
+    }
+
+    results = {
+        name: time_function(function, repeat) / frameCount
+        for name, function in stages.items()
+    }
+
+    # Tracking works on consecutive frames, measured after a warm-up pass
+    markerTracker = MarkerTracker(MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO)
+
+    def track_frames():
+        for image in images:
+            find_marker_centers(image, markerTracker, 0, frameContext)
+
+    track_frames()
+    results["find_marker_centers_tracked"] = (
+        time_function(track_frames, repeat) / frameCount
+    )
+
+    # Whole per-frame routine of the manager, with the serial port not started
+    imageProcessingManager = ImageProcessingManager(None)
+
+    def process_frames():
+        for image in images:
+            imageProcessingManager.main_image_processing(image)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        process_frames()
+        results["main_image_processing"] = (
+            time_function(process_frames, repeat) / frameCount
+        )
+
+    # The manager tracks markers in small windows after the first frame, a
+    # frame where they are lost is searched in full as find_join_positions does
+    results["framesPerSecondTracked"] = 1000 / results["main_image_processing"]
+    results["framesPerSecondFullFrame"] = 1000 / results["find_join_positions"]
+
+    return results
+
+
+def benchmark_blob_backends(masks, repeat=200):
+    # Compare blob extraction backends with the legacy find_center on the masks
+    results = {
+        "legacy": time_function(
+            lambda: [legacy_find_center(mask) for mask in masks.values()], repeat
+        )
+    }
+
+    for blobBackend in BLOB_BACKENDS:
+
+        def extract_and_select():
+            for mask in masks.values():
+                areas, centroids = extract_blobs(mask, blobBackend)
+                select_blob(
+                    areas, MIN_CONTOUR_AREA, MAX_CONTOUR_AREA, EXPECTED_CONTOUR_AREA
+                )
+
+        results[blobBackend] = time_function(extract_and_select, repeat)
+
+    return results
+
+
+def run_benchmarks(samplePath, aspectRatio, repeat):
+
+    testSets = {"sample_frame": build_sample_test_set(samplePath, aspectRatio)}
+    for width, height in SYNTHETIC_RESOLUTIONS:
+        name = "synthetic_{}x{}".format(width, height)
+        testSets[name] = build_synthetic_test_set(width, height)
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "opencv": cv.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+        "repeat": repeat,
+        "testSets": {},
+    }
+
+    for name, frames in testSets.items():
+        results["testSets"][name] = {
+            "resolution": list(frames[0][0].shape[1::-1]),
+            "frames": len(frames),
+            "stagesMs": benchmark_stages(frames, aspectRatio, repeat),
+            "accuracy": measure_accuracy(frames),
+        }
+
+    sampleImage = testSets["sample_frame"][0][0]
+    sampleMasks = COLOR_CALIBRATION.get_segmenter().segment(
+        cv.cvtColor(sampleImage, cv.COLOR_BGR2HSV)
+    )
+    results["blobBackendsMs"] = benchmark_blob_backends(sampleMasks, repeat)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Vision pipeline benchmarks")
+    parser.add_argument("--image", default=SAMPLE_FRAME_PATH)
+    parser.add_argument("--aspect-ratio", type=float, default=1.3)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="JSON file (printed if not given)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.image, args.aspect_ratio, args.repeat)
+
+    if args.output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(args.output, "w") as outputFile:
+            json.dump(results, outputFile, indent=4)
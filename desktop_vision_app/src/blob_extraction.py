@@ -0,0 +1,84 @@
+# Image processing
+import cv2 as cv
+
+import math
+
+# Outer contours of the mask and their moments
+BLOB_BACKEND_CONTOURS = "contours"
+# Connected components with statistics (pixel count areas)
+BLOB_BACKEND_COMPONENTS = "components"
+
+BLOB_BACKENDS = (BLOB_BACKEND_CONTOURS, BLOB_BACKEND_COMPONENTS)
+
+# Measured faster on full frames, connected components label every pixel
+selectedBlobBackend = BLOB_BACKEND_CONTOURS
+
+
+def set_blob_backend(blobBackend):
+    global selectedBlobBackend
+    if blobBackend not in BLOB_BACKENDS:
+        raise ValueError("Unknown blob backend: {}".format(blobBackend))
+    selectedBlobBackend = blobBackend
+
+
+def get_blob_backend():
+    return selectedBlobBackend
+
+
+def extract_blobs_contours(filteredImage):
+    # Areas and centroids of all outer contours
+    # Holes are not needed so no contour hierarchy is built
+    contours, hierarchy = cv.findContours(
+        filteredImage, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE
+    )
+
+    areas = []
+    centroids = []
+
+    for contour in contours:
+        # m00 of a contour is the same as cv.contourArea()
+        moment = cv.moments(contour)
+        if moment["m00"] != 0:
+            areas.append(moment["m00"])
+            centroids.append(
+                (moment["m10"] / moment["m00"], moment["m01"] / moment["m00"])
+            )
+
+    return areas, centroids
+
+
+def extract_blobs_components(filteredImage):
+    # Areas and centroids of all 8-connected components, computed in one pass
+    componentCount, labels, stats, centroids = cv.connectedComponentsWithStats(
+        filteredImage, connectivity=8
+    )
+    # Component 0 is the background
+    return stats[1:, cv.CC_STAT_AREA].tolist(), centroids[1:].tolist()
+
+
+def extract_blobs(filteredImage, blobBackend=None):
+    # Lists of areas and (x, y) centroids of all blobs with the selected backend
+    if blobBackend is None:
+        blobBackend = selectedBlobBackend
+
+    if blobBackend == BLOB_BACKEND_COMPONENTS:
+        return extract_blobs_components(filteredImage)
+
+    return extract_blobs_contours(filteredImage)
+
+
+def select_blob(areas, minArea, maxArea, expectedArea):
+    # Index of the blob inside (minArea, maxArea) whose area is closest to
+    # expectedArea, or -1 if there is none. Ties go to the lowest index
+    # (there are only a handful of blobs so a plain loop beats numpy here)
+    bestIndex = -1
+    bestAreaError = math.inf
+
+    for index, area in enumerate(areas):
+        if (area > minArea) and (area < maxArea):
+            areaError = abs(area - expectedArea)
+            if areaError < bestAreaError:
+                bestIndex = index
+                bestAreaError = areaError
+
+    return bestIndex
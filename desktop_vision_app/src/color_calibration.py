@@ -0,0 +1,199 @@
+# Profiles are stored as JSON
+import json
+
+# Path of files
+import pathlib
+
+import numpy as np
+
+# Segmentation of all marker colors in one pass
+from color_segmentation import ColorSegmenter, compute_hsv_ranges
+
+
+SRC_PATH = pathlib.Path(__file__).parent.resolve()
+# Named calibration profiles written by hsv_calibration.py
+COLOR_PROFILES_PATH = str(
+    SRC_PATH.parent.resolve().joinpath("assets/color_profiles.json")
+)
+
+
+class Hsv:
+    def __init__(self, hue=0, saturation=0, value=0):
+        self.hue = hue
+        self.saturation = saturation
+        self.value = value
+
+
+class ColorCalibration:
+    # Calibrated marker colors and tolerances, compiled once into the HSV bounds,
+    # morphology kernel, segmenter and (optionally) the 3D HSV -> class lookup table
+    # The compiled data is rebuilt only when a calibrated Hsv or a tolerance changes
+    def __init__(
+        self,
+        markerHsvs,
+        hueTolerance,
+        saturationTolerance,
+        valueTolerance,
+        hueWrappedColorNames=("red",),
+        kernelSize=5,
+        morphologyIterations=3,
+        markerTolerances=None,
+    ):
+        # markerHsvs is a dict of color name -> Hsv
+        self.markerHsvs = dict(markerHsvs)
+        self.hueTolerance = hueTolerance
+        self.saturationTolerance = saturationTolerance
+        self.valueTolerance = valueTolerance
+        # Optional dict of color name -> (hue, saturation, value) tolerances
+        # which replace the common ones for that color
+        self.markerTolerances = dict(markerTolerances or {})
+        self.hueWrappedColorNames = tuple(hueWrappedColorNames)
+        self.kernelSize = kernelSize
+        self.morphologyIterations = morphologyIterations
+
+        self.kernel = np.ones((kernelSize, kernelSize), np.uint8)
+
+        self.compiledKey = None
+        self.colorRanges = {}
+        self.segmenter = None
+        self.classLut = None
+
+    def set_marker_hsv(self, colorName, hsv):
+        self.markerHsvs[colorName] = hsv
+
+    def set_tolerances(self, hueTolerance, saturationTolerance, valueTolerance):
+        self.hueTolerance = hueTolerance
+        self.saturationTolerance = saturationTolerance
+        self.valueTolerance = valueTolerance
+
+    def set_marker_tolerances(self, colorName, tolerances):
+        # (hue, saturation, value) tolerances of one color, None for the common ones
+        if tolerances is None:
+            self.markerTolerances.pop(colorName, None)
+        else:
+            self.markerTolerances[colorName] = tuple(tolerances)
+
+    def get_marker_tolerances(self, colorName):
+        return self.markerTolerances.get(
+            colorName,
+            (self.hueTolerance, self.saturationTolerance, self.valueTolerance),
+        )
+
+    def set_morphology_iterations(self, morphologyIterations):
+        # Erosions and dilations removing noise from masks (0 disables them)
+        self.morphologyIterations = morphologyIterations
+
+    def get_key(self):
+        # Everything the compiled data depends on (Hsv objects may be mutated in place)
+        return (
+            tuple(
+                (colorName, hsv.hue, hsv.saturation, hsv.value)
+                + self.get_marker_tolerances(colorName)
+                for colorName, hsv in self.markerHsvs.items()
+            ),
+            self.morphologyIterations,
+        )
+
+    def compile(self):
+        # Recompute bounds and segmenter if the calibration has changed
+        key = self.get_key()
+        if key == self.compiledKey:
+            return
+
+        self.colorRanges = {
+            colorName: compute_hsv_ranges(
+                hsv,
+                *self.get_marker_tolerances(colorName),
+                isHueWrapped=(colorName in self.hueWrappedColorNames),
+                # The common tolerances keep the ranges of the original
+                # filter_color(), calibrated colors wrap their hues correctly
+                isHueClampedBeforeWrap=(colorName not in self.markerTolerances),
+            )
+            for colorName, hsv in self.markerHsvs.items()
+        }
+        self.segmenter = ColorSegmenter(
+            self.colorRanges, self.kernelSize, self.morphologyIterations
+        )
+        # The class lookup table is large so it is only rebuilt on demand
+        self.classLut = None
+        self.compiledKey = key
+
+    def to_profile(self):
+        # Calibrated colors, tolerances and morphology as a JSON-friendly dict
+        return {
+            "markers": {
+                colorName: {
+                    "hsv": [hsv.hue, hsv.saturation, hsv.value],
+                    "tolerance": list(self.get_marker_tolerances(colorName)),
+                }
+                for colorName, hsv in self.markerHsvs.items()
+            },
+            "morphologyIterations": self.morphologyIterations,
+        }
+
+    def apply_profile(self, profile):
+        # Take the colors of a profile, in place so users of this calibration
+        # see the change. Colors missing in the profile are kept
+        for colorName, marker in profile["markers"].items():
+            self.set_marker_hsv(colorName, Hsv(*marker["hsv"]))
+            self.set_marker_tolerances(colorName, marker["tolerance"])
+        self.set_morphology_iterations(profile["morphologyIterations"])
+
+    def get_color_names(self):
+        return list(self.markerHsvs.keys())
+
+    def get_ranges(self, colorName):
+        self.compile()
+        if colorName not in self.colorRanges:
+            raise ValueError("Unknown color name: {}".format(colorName))
+        return self.colorRanges[colorName]
+
+    def get_kernel(self):
+        return self.kernel
+
+    def get_segmenter(self):
+        self.compile()
+        return self.segmenter
+
+    def get_class_lut(self):
+        # 3D lookup table of (hue, saturation, value) -> label bits of the segmenter
+        # 180 * 256 * 256 bytes, built from the per-channel tables on first use
+        self.compile()
+        if self.classLut is None:
+            hueLut, saturationLut, valueLut = self.segmenter.channelLuts
+            self.classLut = (
+                hueLut[:180, np.newaxis, np.newaxis]
+                & saturationLut[np.newaxis, :, np.newaxis]
+                & valueLut[np.newaxis, np.newaxis, :]
+            )
+        return self.classLut
+
+    def label_with_class_lut(self, hsvImage):
+        # Label map of an HSV image through the 3D lookup table
+        # (same result as ColorSegmenter.label)
+        classLut = self.get_class_lut()
+        return classLut[hsvImage[:, :, 0], hsvImage[:, :, 1], hsvImage[:, :, 2]]
+
+
+def load_color_profiles(path=COLOR_PROFILES_PATH):
+    # dict of profile name -> profile, empty if the file does not exist
+    try:
+        with open(path) as profilesFile:
+            return json.load(profilesFile)
+    except FileNotFoundError:
+        return {}
+
+
+def load_color_profile(name, path=COLOR_PROFILES_PATH):
+    profiles = load_color_profiles(path)
+    if name not in profiles:
+        raise ValueError("Unknown color profile: {}".format(name))
+    return profiles[name]
+
+
+def save_color_profile(name, profile, path=COLOR_PROFILES_PATH):
+    # Add or replace a profile, other profiles of the file are kept
+    profiles = load_color_profiles(path)
+    profiles[name] = profile
+    with open(path, "w") as profilesFile:
+        json.dump(profiles, profilesFile, indent=2)
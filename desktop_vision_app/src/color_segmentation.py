@@ -0,0 +1,204 @@
+# Image processing
+import cv2 as cv
+
+import numpy as np
+
+# Reusable buffers of intermediate images
+from frame_context import FrameContext
+
+
+def compute_hsv_ranges(
+    baseHsv,
+    hueTolerance,
+    saturationTolerance,
+    valueTolerance,
+    isHueWrapped=False,
+    isHueClampedBeforeWrap=True,
+):
+    # Compute the list of (lower, upper) HSV bounds used for filtering a color
+    # These are exactly the bounds used by filter_color() in image_processing
+    # With isHueClampedBeforeWrap the hues are clamped to 0..180 before the
+    # second range is computed, as the original filter_color() did, which
+    # leaves only hue 0 (or 180) in it. Otherwise the hues cut off at one end
+    # wrap around to the other end
+
+    hueMin = baseHsv.hue - hueTolerance
+    saturationMin = baseHsv.saturation - saturationTolerance
+    valueMin = baseHsv.value - valueTolerance
+
+    hueMax = baseHsv.hue + hueTolerance
+    unclampedHueMin = hueMin
+    unclampedHueMax = hueMax
+    saturationMax = baseHsv.saturation + saturationTolerance
+    valueMax = baseHsv.value + valueTolerance
+
+    if hueMin < 0:
+        hueMin = 0
+
+    if hueMax > 180:
+        hueMax = 180
+
+    if saturationMin < 0:
+        saturationMin = 0
+
+    if saturationMax > 255:
+        saturationMax = 255
+
+    if valueMin < 0:
+        valueMin = 0
+
+    if valueMax > 255:
+        valueMax = 255
+
+    hsvRanges = [((hueMin, saturationMin, valueMin), (hueMax, saturationMax, valueMax))]
+
+    # red color covers some hues around 0 and some around 180
+    # so two hue ranges is consired for filtering red color
+    if isHueWrapped:
+
+        if not isHueClampedBeforeWrap:
+            hueMin = unclampedHueMin
+            hueMax = unclampedHueMax
+            if hueMin >= 0 and hueMax <= 180:
+                # Nothing is cut off, one range covers the color
+                return hsvRanges
+
+        hueMin2 = 0
+        hueMax2 = 0
+
+        if hueMin < 0:
+            hueMin2 = 180 + hueMin
+            hueMax2 = 180
+
+        if hueMax > 180:
+            hueMin2 = 0
+            hueMax2 = hueMax - 180
+
+        hsvRanges.append(
+            ((hueMin2, saturationMin, valueMin), (hueMax2, saturationMax, valueMax))
+        )
+
+    return hsvRanges
+
+
+class ColorSegmenter:
+    # Segments several colors in a single pass over an HSV image
+    #
+    # Every HSV range gets one bit of an 8-bit label. Because each range is a box
+    # in HSV space, the label of a pixel is the AND of three per-channel lookup
+    # tables: label = hueLut[H] & saturationLut[S] & valueLut[V]
+    # A color's mask is then the pixels having any of the color's bits set
+    def __init__(self, colorRanges, kernelSize=5, morphologyIterations=3):
+        # colorRanges is a dict of color name -> list of (lower, upper) HSV bounds
+        self.colorNames = list(colorRanges.keys())
+
+        rangeCount = sum(len(hsvRanges) for hsvRanges in colorRanges.values())
+        if rangeCount > 8:
+            raise ValueError("At most 8 HSV ranges can be labeled in one pass")
+
+        # One lookup table per channel for cv.LUT
+        self.channelLuts = [np.zeros(256, np.uint8) for channel in range(3)]
+        # Bits of the label which belong to each color
+        self.colorBits = {}
+
+        bit = 0
+        levels = np.arange(256)
+        for colorName in self.colorNames:
+            colorBits = 0
+            for lower, upper in colorRanges[colorName]:
+                for channel in range(3):
+                    isInRange = (levels >= lower[channel]) & (levels <= upper[channel])
+                    self.channelLuts[channel][isInRange] |= 1 << bit
+                colorBits |= 1 << bit
+                bit += 1
+            self.colorBits[colorName] = colorBits
+
+        # Eroding (or dilating) n times with a k*k box is the same as doing it
+        # once with a box of size n*(k-1)+1, and a box is separable
+        self.morphologyRadius = morphologyIterations * (kernelSize - 1) // 2
+        self.morphologyKernels = {}
+        self.morphologyKernel = self.get_morphology_kernel(0)
+
+    def get_morphology_kernel(self, pyramidLevel):
+        # Box kernel for masks downscaled by 2^pyramidLevel
+        if pyramidLevel not in self.morphologyKernels:
+            radius = int(round(self.morphologyRadius / (2**pyramidLevel)))
+            self.morphologyKernels[pyramidLevel] = cv.getStructuringElement(
+                cv.MORPH_RECT, (2 * radius + 1, 2 * radius + 1)
+            )
+        return self.morphologyKernels[pyramidLevel]
+
+    def label(self, hsvImage, frameContext=None, bufferName="frame"):
+        # Return the label map, each bit of a pixel marks one matched HSV range
+        # Intermediate images are written into the buffers of frameContext
+        if frameContext is None:
+            frameContext = FrameContext()
+
+        planeShape = hsvImage.shape[:2]
+        channelImages = [
+            frameContext.get_buffer(bufferName + ".channel" + str(channel), planeShape)
+            for channel in range(3)
+        ]
+        labelImage = frameContext.get_buffer(bufferName + ".label", planeShape)
+        channelLabel = frameContext.get_buffer(bufferName + ".channelLabel", planeShape)
+
+        cv.split(hsvImage, channelImages)
+        cv.LUT(channelImages[0], self.channelLuts[0], dst=labelImage)
+        cv.LUT(channelImages[1], self.channelLuts[1], dst=channelLabel)
+        cv.bitwise_and(labelImage, channelLabel, dst=labelImage)
+        cv.LUT(channelImages[2], self.channelLuts[2], dst=channelLabel)
+        cv.bitwise_and(labelImage, channelLabel, dst=labelImage)
+        return labelImage
+
+    def mask_from_label(
+        self,
+        labelImage,
+        colorName,
+        pyramidLevel=0,
+        frameContext=None,
+        bufferName="frame",
+    ):
+        # Return the noise-removed binary mask (0 or 255) of a color from a label map
+        if frameContext is None:
+            frameContext = FrameContext()
+
+        mask = frameContext.get_buffer(
+            bufferName + ".mask." + colorName, labelImage.shape
+        )
+        temporary = frameContext.get_buffer(
+            bufferName + ".morphology", labelImage.shape
+        )
+
+        cv.bitwise_and(labelImage, self.colorBits[colorName], dst=temporary)
+        cv.compare(temporary, 0, cv.CMP_NE, dst=mask)
+        # remove some noise (a 1x1 kernel would not change the mask)
+        kernel = self.get_morphology_kernel(pyramidLevel)
+        if kernel.shape[0] > 1:
+            cv.erode(mask, kernel, dst=temporary)
+            cv.dilate(temporary, kernel, dst=mask)
+        return mask
+
+    def segment(
+        self,
+        hsvImage,
+        colorNames=None,
+        pyramidLevel=0,
+        frameContext=None,
+        bufferName="frame",
+    ):
+        # Return a dict of color name -> binary mask (for all colors by default)
+        # pyramidLevel scales the morphology for images downscaled by 2^pyramidLevel
+        # With a frameContext the masks are its buffers and valid until the next call
+        if colorNames is None:
+            colorNames = self.colorNames
+
+        if frameContext is None:
+            frameContext = FrameContext()
+
+        labelImage = self.label(hsvImage, frameContext, bufferName)
+        return {
+            colorName: self.mask_from_label(
+                labelImage, colorName, pyramidLevel, frameContext, bufferName
+            )
+            for colorName in colorNames
+        }
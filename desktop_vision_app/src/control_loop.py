@@ -0,0 +1,193 @@
+# Multi-threading
+import threading
+
+# for monotonic timestamps
+import time
+
+# Deadline-based clock of the fixed-rate loop
+from frame_scheduler import FrameScheduler, SCHEDULE_POLICY_DROP_LATE
+
+# Timing histograms
+from pipeline_metrics import LatencyHistogram
+
+# Control algorithms
+from robot_control import create_controller
+
+# Joint states given to the controller
+from state_estimation import JointState, compute_link_angles
+
+
+class ControlLoop:
+    # Runs a RobotController on the latest joint state and sends its motor
+    # speeds. step() is either called by the vision thread after each frame
+    # (rate 0) or by its own thread at a fixed rate, which can be faster than
+    # the camera. When no positions newer than 'staleTimeout' seconds exist the
+    # motors are stopped once, and the controller is reset before it runs again
+    # With an estimator the joint state is predicted to the time of the step
+    # (plus 'predictionLeadTime'), otherwise it is the latest measurement
+    def __init__(
+        self,
+        sendFunction,
+        controller=None,
+        rateHz=0,
+        staleTimeout=0.2,
+        estimator=None,
+    ):
+        self.sendFunction = sendFunction
+        self.controller = controller if controller is not None else create_controller()
+        self.rateHz = rateHz
+        self.staleTimeout = staleTimeout
+        self.isRunning = False
+
+        # Updated by the vision thread and read by the control thread
+        self.estimator = estimator
+        self.estimatorLock = threading.Lock()
+        self.predictionLeadTime = 0.0
+
+        # (jointPositionsCm, timestamp) replaced as a whole by the vision thread
+        self.latestMeasurement = None
+        self.isStopped = True
+        self.lastStepTime = None
+        self.lastSpeeds = (0.0, 0.0)
+        self.lastComputeSeconds = 0.0
+        self.lastSendSeconds = 0.0
+
+        self.scheduler = FrameScheduler(1000, SCHEDULE_POLICY_DROP_LATE)
+        self.statsLock = threading.Lock()
+        self.reset_stats()
+
+    def set_controller(self, controller):
+        self.controller = controller
+        self.isStopped = True
+
+    def set_rate(self, rateHz):
+        # 0 runs the controller after each frame instead of in its own thread
+        self.rateHz = rateHz
+
+    def set_stale_timeout(self, staleTimeout):
+        self.staleTimeout = staleTimeout
+
+    def set_estimator(self, estimator):
+        with self.estimatorLock:
+            self.estimator = estimator
+
+    def set_prediction_lead_time(self, seconds):
+        self.predictionLeadTime = seconds
+
+    def reset_stats(self):
+        with self.statsLock:
+            self.stepCount = 0
+            self.safeStopCount = 0
+            self.computeHistogram = LatencyHistogram()
+            self.sendHistogram = LatencyHistogram()
+
+    def update_measurement(self, jointPositionsCm, timestamp):
+        # timestamp is the time.monotonic() capture time of the frame
+        with self.estimatorLock:
+            if self.estimator is not None:
+                # Velocities are not estimated across a gap in vision
+                previousMeasurement = self.latestMeasurement
+                if (
+                    previousMeasurement is None
+                    or timestamp - previousMeasurement[1] > self.staleTimeout
+                ):
+                    self.estimator.reset()
+                self.estimator.update(jointPositionsCm, timestamp)
+            self.latestMeasurement = (jointPositionsCm, timestamp)
+
+    def get_joint_state(self, timestamp):
+        with self.estimatorLock:
+            if self.estimator is not None and self.estimator.is_ready():
+                return self.estimator.predict(timestamp)
+            jointPositionsCm, measurementTime = self.latestMeasurement
+        return JointState(
+            measurementTime,
+            compute_link_angles(jointPositionsCm),
+            (0.0, 0.0),
+            jointPositionsCm,
+        )
+
+    def check_stale(self, now=None):
+        # Stop the motors once if vision is stale instead of repeating the last
+        # command. Returns True if it is stale
+        if now is None:
+            now = time.monotonic()
+        measurement = self.latestMeasurement
+        if measurement is not None and now - measurement[1] <= self.staleTimeout:
+            return False
+        if not self.isStopped:
+            self.send((0.0, 0.0))
+            self.isStopped = True
+            with self.statsLock:
+                self.safeStopCount += 1
+        return True
+
+    def step(self):
+        # Run the controller once, returns False if it did not run (stale vision)
+        now = time.monotonic()
+        if self.check_stale(now):
+            return False
+
+        if self.isStopped:
+            self.controller.reset()
+            self.isStopped = False
+            self.lastStepTime = None
+
+        dt = 0.0 if self.lastStepTime is None else now - self.lastStepTime
+        self.lastStepTime = now
+
+        jointState = self.get_joint_state(now + self.predictionLeadTime)
+        speeds = self.controller.compute(jointState, dt)
+        self.lastComputeSeconds = time.monotonic() - now
+        with self.statsLock:
+            self.computeHistogram.add(self.lastComputeSeconds)
+            self.stepCount += 1
+
+        self.send(speeds)
+        return True
+
+    def send(self, speeds):
+        startTime = time.monotonic()
+        self.sendFunction(*speeds)
+        self.lastSpeeds = speeds
+        self.lastSendSeconds = time.monotonic() - startTime
+        with self.statsLock:
+            self.sendHistogram.add(self.lastSendSeconds)
+
+    def start(self):
+        self.latestMeasurement = None
+        self.isStopped = True
+        if self.rateHz <= 0:
+            return
+        self.isRunning = True
+        self.scheduler.set_interval(1000 / self.rateHz)
+        self.scheduler.reset()
+        self.controlThread = threading.Thread(
+            target=self.control_thread_handler, daemon=True
+        )
+        self.controlThread.start()
+
+    def stop(self):
+        if self.isRunning:
+            self.isRunning = False
+            self.controlThread.join()
+        # Leave the motors stopped
+        if not self.isStopped:
+            self.send((0.0, 0.0))
+            self.isStopped = True
+
+    def control_thread_handler(self):
+        while self.isRunning:
+            self.scheduler.wait_next_tick()
+            self.step()
+
+    def get_stats(self):
+        with self.statsLock:
+            return {
+                "rateHz": self.rateHz,
+                "steps": self.stepCount,
+                "safeStops": self.safeStopCount,
+                "computeMs": self.computeHistogram.get_stats(),
+                "sendMs": self.sendHistogram.get_stats(),
+                "scheduler": self.scheduler.get_stats() if self.rateHz > 0 else None,
+            }
@@ -0,0 +1,191 @@
+# Image processing
+import cv2 as cv
+
+# Multi-threading
+import threading
+
+# for monotonic timestamps
+import time
+
+import numpy as np
+
+# Deadline-based clock for pacing recorded video sources
+from frame_scheduler import FrameScheduler
+
+
+class FrameRingBuffer:
+    # A preallocated ring of frame buffers shared by one writer (capture thread)
+    # and one reader (processing thread). The reader always gets the newest frame
+    # and the slots of the newest, the currently read and the previously read
+    # frames are never overwritten. The previously read frame is the one of the
+    # latest published FrameResult, which other threads may still be displaying
+    def __init__(self, slotCount=4):
+        # At least one slot for each of: newest frame, frame being read,
+        # previously read frame, frame being written
+        self.slotCount = max(4, slotCount)
+        self.slots = [None] * self.slotCount
+        self.slotFrameIds = [0] * self.slotCount
+        self.slotTimestamps = [0.0] * self.slotCount
+
+        self.condition = threading.Condition()
+        self.nextWriteIndex = 0
+        self.latestIndex = -1
+        self.readingIndex = -1
+        self.previousReadingIndex = -1
+        self.writtenFrameCount = 0
+        self.lastReadFrameId = 0
+        self.droppedFrameCount = 0
+
+    def get_write_buffer(self):
+        # Return index and buffer of the slot which the writer can fill now
+        with self.condition:
+            index = self.nextWriteIndex
+            while index in (
+                self.latestIndex,
+                self.readingIndex,
+                self.previousReadingIndex,
+            ):
+                index = (index + 1) % self.slotCount
+            self.nextWriteIndex = (index + 1) % self.slotCount
+            return index, self.slots[index]
+
+    def commit(self, index, frame, timestamp):
+        # Publish the frame written into slot 'index' as the newest frame
+        with self.condition:
+            if self.slots[index] is not frame:
+                # The writer could not decode in-place (first frame or a new
+                # resolution) so the new array becomes the slot's buffer
+                self.slots[index] = frame
+            self.writtenFrameCount += 1
+            self.slotFrameIds[index] = self.writtenFrameCount
+            self.slotTimestamps[index] = timestamp
+            self.latestIndex = index
+            self.condition.notify_all()
+
+    def read_latest(self, timeout=None):
+        # Wait (up to 'timeout' seconds) for a frame newer than the last one read
+        # Returns (success, frame, frameId, timestamp, droppedFrames) where
+        # droppedFrames is the number of frames overwritten since the last read
+        with self.condition:
+            isNewFrame = self.condition.wait_for(
+                lambda: self.writtenFrameCount > self.lastReadFrameId, timeout
+            )
+            if not isNewFrame:
+                return False, None, self.lastReadFrameId, 0.0, 0
+
+            index = self.latestIndex
+            frameId = self.slotFrameIds[index]
+            droppedFrames = frameId - self.lastReadFrameId - 1
+
+            self.previousReadingIndex = self.readingIndex
+            self.readingIndex = index
+            self.lastReadFrameId = frameId
+            self.droppedFrameCount += droppedFrames
+
+            return (
+                True,
+                self.slots[index],
+                frameId,
+                self.slotTimestamps[index],
+                droppedFrames,
+            )
+
+    def reset(self):
+        with self.condition:
+            self.latestIndex = -1
+            self.readingIndex = -1
+            self.previousReadingIndex = -1
+            self.writtenFrameCount = 0
+            self.lastReadFrameId = 0
+            self.droppedFrameCount = 0
+
+
+class FrameCaptureManager:
+    # A class for capturing frames of a video source in a separate thread
+    # into a FrameRingBuffer
+    def __init__(self, videoSource, slotCount=4, intervalMilliseconds=40):
+        self.isRunning = False
+        self.videoSource = videoSource
+        self.intervalMilliseconds = intervalMilliseconds
+        self.ringBuffer = FrameRingBuffer(slotCount)
+        self.videoCapture = cv.VideoCapture()
+        self.failedReadCount = 0
+        self.captureThread = None
+
+    def set_source(self, videoSource):
+        self.videoSource = videoSource
+
+    def set_interval(self, interval):
+        self.intervalMilliseconds = interval
+
+    def is_live_source(self):
+        # Cameras deliver frames at their own rate, recorded videos must be paced
+        return isinstance(self.videoSource, int)
+
+    def start(self):
+        self.isRunning = True
+        self.ringBuffer.reset()
+        self.captureThread = threading.Thread(target=self.capture_thread_handler)
+        self.captureThread.start()
+
+    def stop(self):
+        self.isRunning = False
+        # A restart must not have two threads reading the same capture
+        if self.captureThread is not None:
+            self.captureThread.join()
+            self.captureThread = None
+
+    def read_latest(self, timeout=None):
+        return self.ringBuffer.read_latest(timeout)
+
+    def get_stats(self):
+        return {
+            "capturedFrames": self.ringBuffer.writtenFrameCount,
+            "droppedFrames": self.ringBuffer.droppedFrameCount,
+            "failedReads": self.failedReadCount,
+        }
+
+    def open_capture(self):
+        self.videoCapture = cv.VideoCapture(self.videoSource)
+        if self.videoCapture.isOpened():
+            # Keep as few frames as possible queued inside the driver so the
+            # newest frame is not hidden behind stale buffered ones
+            self.videoCapture.set(cv.CAP_PROP_BUFFERSIZE, 1)
+
+    def capture_thread_handler(self):
+
+        frameScheduler = None
+        if not self.is_live_source():
+            frameScheduler = FrameScheduler(self.intervalMilliseconds)
+
+        while self.isRunning:
+
+            if frameScheduler is not None:
+                frameScheduler.wait_next_tick()
+
+            if not self.videoCapture.isOpened():
+                self.open_capture()
+                if not self.videoCapture.isOpened():
+                    # Do not hammer a missing source
+                    time.sleep(self.intervalMilliseconds / 1000)
+                continue
+
+            index, buffer = self.ringBuffer.get_write_buffer()
+
+            # Decode directly into the preallocated slot whenever possible
+            success, frame = self.videoCapture.read(buffer)
+
+            if success and isinstance(frame, np.ndarray):
+                self.ringBuffer.commit(index, frame, time.monotonic())
+            else:
+                self.failedReadCount += 1
+                if frameScheduler is None:
+                    time.sleep(self.intervalMilliseconds / 1000)
+
+        if self.videoCapture.isOpened():
+            self.videoCapture.release()
+
+    # Release the video source when the object is destroyed
+    def __del__(self):
+        if self.videoCapture.isOpened():
+            self.videoCapture.release()
@@ -0,0 +1,53 @@
+# for timing pipeline stages
+import time
+
+import numpy as np
+
+
+class FrameContext:
+    # Intermediate images of the per-frame pipeline, allocated once and reused
+    # Each buffer is a view of flat storage which is reallocated only when a
+    # larger size or another type is requested (e.g. a new camera resolution).
+    # Smaller shapes, like search windows clipped at the frame border, reuse
+    # it, so steady-state frames allocate nothing
+    def __init__(self):
+        self.buffers = {}
+        self.rotationIndexes = {}
+        self.allocationCount = 0
+        # Time spent in each pipeline stage during the current frame
+        self.stageTimes = {}
+        self.stageStartTime = 0.0
+
+    def get_buffer(self, name, shape, dtype=np.uint8):
+        size = int(np.prod(shape))
+        storage = self.buffers.get(name)
+        if storage is None or storage.size < size or storage.dtype != dtype:
+            storage = np.empty(size, dtype)
+            self.buffers[name] = storage
+            self.allocationCount += 1
+        return storage[:size].reshape(shape)
+
+    def get_rotating_buffer(self, name, shape, dtype=np.uint8, count=2):
+        # Cycle through 'count' buffers, for images which are handed to another
+        # thread and must not be overwritten by the very next frame
+        index = (self.rotationIndexes.get(name, -1) + 1) % count
+        self.rotationIndexes[name] = index
+        return self.get_buffer("{}[{}]".format(name, index), shape, dtype)
+
+    def reset_stage_times(self):
+        self.stageTimes = {}
+
+    def start_stage(self):
+        self.stageStartTime = time.perf_counter()
+
+    def end_stage(self, stageName):
+        # Add the time since start_stage() or the previous end_stage() to a stage
+        now = time.perf_counter()
+        self.stageTimes[stageName] = (
+            self.stageTimes.get(stageName, 0.0) + now - self.stageStartTime
+        )
+        self.stageStartTime = now
+
+    def release(self):
+        self.buffers = {}
+        self.rotationIndexes = {}
@@ -0,0 +1,58 @@
+# Multi-threading
+import threading
+
+# Immutable records
+from collections import namedtuple
+
+# Everything known about one processed frame. A result is never modified after
+# it is published, so readers always see images, positions and speeds of the
+# same frame. Times are time.monotonic() seconds. displayImages is None or the
+# (original, processed) RGB images in the display size set for the GUI
+FrameResult = namedtuple(
+    "FrameResult",
+    (
+        "frameId",
+        "captureTime",
+        "processedTime",
+        "isDetected",
+        "originalImage",
+        "markerCenters",
+        "jointPositionsCm",
+        "motorSpeeds",
+        "displayImages",
+    ),
+)
+
+
+class FrameResultPublisher:
+    # Hands the newest FrameResult of the processing thread to other threads
+    # Publishing replaces a single reference, so get_latest() needs no lock;
+    # the condition is only used to wake threads waiting for a newer frame
+    def __init__(self):
+        self.latestResult = None
+        self.condition = threading.Condition()
+
+    def publish(self, frameResult):
+        self.latestResult = frameResult
+        with self.condition:
+            self.condition.notify_all()
+
+    def get_latest(self):
+        return self.latestResult
+
+    def wait_for_newer(self, frameId, timeout=None):
+        # Wait (up to 'timeout' seconds) for a result newer than frameId
+        # Returns the result or None if there is none yet
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.latestResult is not None
+                and self.latestResult.frameId > frameId,
+                timeout,
+            )
+        frameResult = self.latestResult
+        if frameResult is not None and frameResult.frameId > frameId:
+            return frameResult
+        return None
+
+    def reset(self):
+        self.latestResult = None
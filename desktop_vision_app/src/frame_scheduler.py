@@ -0,0 +1,94 @@
+# for monotonic clock and sleeping
+import time
+
+# Policies for handling ticks that were missed because a frame took longer
+# than one interval to process:
+# skip the missed ticks and wait for the next deadline on the original grid
+SCHEDULE_POLICY_DROP_LATE = "drop_late"
+# run the missed ticks back-to-back (up to a limit) until the schedule catches up
+SCHEDULE_POLICY_CATCH_UP = "catch_up"
+
+
+class FrameScheduler:
+    # A deadline-based frame clock which sleeps until the next tick instead of
+    # busy-waiting, and keeps statistics of jitter and overruns
+    def __init__(
+        self,
+        intervalMilliseconds=40,
+        policy=SCHEDULE_POLICY_DROP_LATE,
+        maxCatchUpTicks=3,
+    ):
+        self.intervalSeconds = intervalMilliseconds / 1000
+        self.policy = policy
+        self.maxCatchUpTicks = maxCatchUpTicks
+        self.reset()
+
+    def set_interval(self, intervalMilliseconds):
+        self.intervalSeconds = intervalMilliseconds / 1000
+        # Start a new grid of deadlines with the new interval
+        self.nextDeadline = None
+
+    def set_policy(self, policy):
+        self.policy = policy
+
+    def reset(self):
+        self.nextDeadline = None
+        # Statistics
+        self.tickCount = 0
+        self.overrunCount = 0
+        self.droppedTickCount = 0
+        self.lastJitterSeconds = 0.0
+        self.maxJitterSeconds = 0.0
+        self.totalJitterSeconds = 0.0
+
+    def wait_next_tick(self):
+        # Block until the next deadline and return the number of ticks dropped
+        now = time.monotonic()
+
+        if self.nextDeadline is None:
+            self.nextDeadline = now
+
+        if now < self.nextDeadline:
+            time.sleep(self.nextDeadline - now)
+            now = time.monotonic()
+
+        droppedTicks = 0
+        lateTicks = int((now - self.nextDeadline) // self.intervalSeconds)
+
+        if lateTicks > 0:
+            # The previous frame took longer than one interval
+            self.overrunCount += 1
+
+            if self.policy == SCHEDULE_POLICY_CATCH_UP:
+                # Run missed ticks immediately, but never more than the limit
+                droppedTicks = max(0, lateTicks - self.maxCatchUpTicks)
+            else:
+                droppedTicks = lateTicks
+
+            self.droppedTickCount += droppedTicks
+            self.nextDeadline += droppedTicks * self.intervalSeconds
+
+        # Jitter is the delay between the served deadline and the actual wake-up
+        jitter = now - self.nextDeadline
+        self.lastJitterSeconds = jitter
+        self.maxJitterSeconds = max(self.maxJitterSeconds, jitter)
+        self.totalJitterSeconds += jitter
+        self.tickCount += 1
+
+        self.nextDeadline += self.intervalSeconds
+
+        return droppedTicks
+
+    def get_stats(self):
+        meanJitterSeconds = 0.0
+        if self.tickCount > 0:
+            meanJitterSeconds = self.totalJitterSeconds / self.tickCount
+
+        return {
+            "ticks": self.tickCount,
+            "overruns": self.overrunCount,
+            "droppedTicks": self.droppedTickCount,
+            "lastJitterMs": self.lastJitterSeconds * 1000,
+            "meanJitterMs": meanJitterSeconds * 1000,
+            "maxJitterMs": self.maxJitterSeconds * 1000,
+        }
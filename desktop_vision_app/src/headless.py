@@ -0,0 +1,205 @@
+# Runs the vision pipeline without GUI (no tkinter or PIL needed)
+
+# Command line options
+import argparse
+
+# Configuration files
+import json
+
+# for waiting in the main thread
+import time
+
+# Image Processing Operations Management
+from image_processing import ImageProcessingManager
+
+# Recording of frames, detections and commands for replay
+from session_recording import SessionRecorder
+
+# Marker colors learned by hsv_calibration.py
+from color_calibration import COLOR_PROFILES_PATH, load_color_profile
+
+DEFAULT_OPTIONS = {
+    "source": "0",
+    "serial_port": None,
+    "baud": 57600,
+    "serial_protocol": "framed",
+    "interval": 40,
+    "aspect_ratio": 1.3,
+    "pyramid_levels": 0,
+    "workers": 0,
+    "tracking": True,
+    "controller": "algorithm",
+    "control_rate": 0,
+    "stale_timeout": 0.2,
+    "estimation": True,
+    "prediction_lead": 0.0,
+    "status_interval": 5.0,
+    "metrics_log_interval": 0,
+    "metrics_port": None,
+    "record": None,
+    "color_profile": None,
+    "color_profiles_file": COLOR_PROFILES_PATH,
+}
+
+
+def parse_video_source(source):
+    # Camera indexes are given as numbers, everything else is a file path or URL
+    if isinstance(source, int):
+        return source
+    if source.isdigit():
+        return int(source)
+    return source
+
+
+def load_options(arguments=None):
+    # Options are taken from defaults, then the config file, then the command line
+
+    parser = argparse.ArgumentParser(
+        description="Run robot vision and motor control without GUI"
+    )
+    parser.add_argument("--config", help="JSON file with any of the options below")
+    parser.add_argument("--source", help="camera index, video file or stream URL")
+    parser.add_argument("--serial-port", help="serial port of the Arduino board")
+    parser.add_argument("--baud", type=int, help="serial port baud rate")
+    parser.add_argument(
+        "--serial-protocol",
+        choices=("framed", "legacy"),
+        help="packet format of the Arduino firmware",
+    )
+    parser.add_argument("--interval", type=int, help="processing interval in ms")
+    parser.add_argument("--aspect-ratio", type=float, help="frames are cropped to it")
+    parser.add_argument("--pyramid-levels", type=int, help="coarse-to-fine levels")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="detect markers in this many processes (0 uses the processing thread)",
+    )
+    parser.add_argument(
+        "--no-tracking",
+        dest="tracking",
+        action="store_const",
+        const=False,
+        help="always search markers in the full frame",
+    )
+    parser.add_argument("--controller", help="name of the control algorithm")
+    parser.add_argument(
+        "--control-rate",
+        type=float,
+        help="control loop rate in Hz (0 runs it after each frame)",
+    )
+    parser.add_argument(
+        "--stale-timeout",
+        type=float,
+        help="stop the motors when joint positions are older (seconds)",
+    )
+    parser.add_argument(
+        "--no-estimation",
+        dest="estimation",
+        action="store_const",
+        const=False,
+        help="give measured positions to the controller without prediction",
+    )
+    parser.add_argument(
+        "--prediction-lead",
+        type=float,
+        help="seconds from sending a command to its effect on the motors",
+    )
+    parser.add_argument(
+        "--status-interval", type=float, help="seconds between status lines"
+    )
+    parser.add_argument(
+        "--metrics-log-interval", type=float, help="seconds between metrics lines"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="serve Prometheus metrics on this port"
+    )
+    parser.add_argument(
+        "--color-profile", help="marker colors saved by hsv_calibration.py"
+    )
+    parser.add_argument("--color-profiles-file", help="file of the color profiles")
+    parser.add_argument(
+        "--record", help="write frames, detections and commands to this session file"
+    )
+    args = parser.parse_args(arguments)
+
+    options = dict(DEFAULT_OPTIONS)
+
+    if args.config is not None:
+        with open(args.config) as configFile:
+            options.update(json.load(configFile))
+
+    for name, value in vars(args).items():
+        if name != "config" and value is not None:
+            options[name] = value
+
+    return options
+
+
+def print_status(imageProcessingManager):
+    print(
+        "[ HEADLESS ] frame: {} | scheduler: {} | capture: {} | tracking: {} | "
+        "serial: {} | control: {}".format(
+            imageProcessingManager.frameId,
+            imageProcessingManager.get_scheduler_stats(),
+            imageProcessingManager.get_capture_stats(),
+            imageProcessingManager.get_tracking_stats(),
+            imageProcessingManager.get_serial_stats(),
+            imageProcessingManager.get_control_stats(),
+        )
+    )
+
+
+def create_manager(options):
+    # ImageProcessingManager configured with the options, not started yet
+
+    imageProcessingManager = ImageProcessingManager(
+        parse_video_source(options["source"]),
+        options["aspect_ratio"],
+        options["interval"],
+        trackingEnabled=options["tracking"],
+        pyramidLevels=options["pyramid_levels"],
+    )
+    if options["color_profile"] is not None:
+        imageProcessingManager.set_color_profile(
+            load_color_profile(options["color_profile"], options["color_profiles_file"])
+        )
+    imageProcessingManager.config_serial_port(options["serial_port"], options["baud"])
+    imageProcessingManager.set_serial_protocol(options["serial_protocol"])
+    imageProcessingManager.set_worker_count(options["workers"])
+    imageProcessingManager.set_controller(options["controller"])
+    imageProcessingManager.set_control_rate(options["control_rate"])
+    imageProcessingManager.set_stale_timeout(options["stale_timeout"])
+    imageProcessingManager.set_estimation_enabled(options["estimation"])
+    imageProcessingManager.set_prediction_lead_time(options["prediction_lead"])
+    imageProcessingManager.set_metrics_log_interval(options["metrics_log_interval"])
+    return imageProcessingManager
+
+
+def run(options):
+
+    imageProcessingManager = create_manager(options)
+    if options["metrics_port"] is not None:
+        imageProcessingManager.start_metrics_server(options["metrics_port"])
+    sessionRecorder = None
+    if options["record"] is not None:
+        sessionRecorder = SessionRecorder(options["record"])
+        sessionRecorder.start()
+        imageProcessingManager.set_session_recorder(sessionRecorder)
+    imageProcessingManager.start()
+
+    try:
+        while True:
+            time.sleep(options["status_interval"])
+            print_status(imageProcessingManager)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        imageProcessingManager.stop()
+        if sessionRecorder is not None:
+            sessionRecorder.stop()
+            print("[ HEADLESS ] session: {}".format(sessionRecorder.get_stats()))
+        print_status(imageProcessingManager)
+
+
+if __name__ == "__main__":
+    run(load_options())
@@ -0,0 +1,321 @@
+# Learns tight HSV ranges of the markers from sample frames and saves them
+# as a named profile which the application loads at startup
+
+# Image processing
+import cv2 as cv
+
+# Command line options
+import argparse
+
+# Copies of the current calibration
+import copy
+
+# Rounding tolerances up
+import math
+
+# Path of files
+import pathlib
+
+# for measuring segmentation time
+import time
+
+import numpy as np
+
+from image_processing import (
+    COLOR_CALIBRATION,
+    MARKER_COLOR_NAMES,
+    MIN_DIAMETER_CM,
+    PIXEL_TO_CM_RATIO,
+    crop_image,
+    find_center,
+)
+
+# Blobs of masks, counted to show how noisy they are
+from blob_extraction import extract_blobs
+
+# Profile storage
+from color_calibration import COLOR_PROFILES_PATH, save_color_profile
+
+SRC_PATH = pathlib.Path(__file__).parent.resolve()
+SAMPLE_FRAME_PATH = str(SRC_PATH.parent.resolve().joinpath("assets/sample_frame.jpg"))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+# Marker pixels are taken inside this part of the smallest marker radius, so
+# the border blended with the background is left out
+SAMPLE_RADIUS = 0.6 * (MIN_DIAMETER_CM / 2) * PIXEL_TO_CM_RATIO  # in pixels
+
+# Percentiles of marker pixels which bound each channel, outliers are ignored
+LOWER_PERCENTILE = 0.5
+UPPER_PERCENTILE = 99.5
+
+# Added to each side of the measured ranges for lighting changes
+DEFAULT_MARGINS = (4, 25, 35)
+
+MAX_MORPHOLOGY_ITERATIONS = 3
+
+
+def read_sample_frames(paths, aspectRatio, frameStep=25, maxFrameCount=50):
+    # Cropped BGR frames of images, image directories and videos
+    # (every frameStep-th frame of a video)
+    frames = []
+    for path in paths:
+        path = pathlib.Path(path)
+        if path.is_dir():
+            imagePaths = sorted(
+                imagePath
+                for imagePath in path.iterdir()
+                if imagePath.suffix.lower() in IMAGE_EXTENSIONS
+            )
+        else:
+            imagePaths = [path]
+
+        for imagePath in imagePaths:
+            if imagePath.suffix.lower() in IMAGE_EXTENSIONS:
+                frame = cv.imread(str(imagePath))
+                if frame is not None:
+                    frames.append(crop_image(frame, aspectRatio))
+                continue
+
+            videoCapture = cv.VideoCapture(str(imagePath))
+            frameIndex = 0
+            while len(frames) < maxFrameCount:
+                success, frame = videoCapture.read()
+                if not success:
+                    break
+                if frameIndex % frameStep == 0:
+                    frames.append(crop_image(frame, aspectRatio))
+                frameIndex += 1
+            videoCapture.release()
+
+    return frames[:maxFrameCount]
+
+
+def detect_markers(hsvImage, colorCalibration):
+    # Full-frame detection with a given calibration, returns the markers as
+    # find_marker_centers() does and the masks
+    masks = colorCalibration.get_segmenter().segment(hsvImage)
+    return {colorName: find_center(masks[colorName]) for colorName in masks}, masks
+
+
+def collect_marker_pixels(hsvImages, colorCalibration):
+    # HSV pixels inside each marker found with the current calibration
+    # Returns a dict of color name -> list of (frame index, center, N x 3 pixels)
+    markerPixels = {colorName: [] for colorName in MARKER_COLOR_NAMES}
+
+    for frameIndex, hsvImage in enumerate(hsvImages):
+        markerCenters, masks = detect_markers(hsvImage, colorCalibration)
+        for colorName, (centerReady, center) in markerCenters.items():
+            if not centerReady:
+                continue
+            disc = np.zeros(hsvImage.shape[:2], np.uint8)
+            cv.circle(
+                disc,
+                (int(round(center.x)), int(round(center.y))),
+                int(SAMPLE_RADIUS),
+                255,
+                -1,
+            )
+            # Only pixels of the color, highlights and shadows are left out
+            cv.bitwise_and(disc, masks[colorName], dst=disc)
+            markerPixels[colorName].append((frameIndex, center, hsvImage[disc > 0]))
+
+    return markerPixels
+
+
+def reject_outlier_samples(samples, seedHue, margins):
+    # The wide base ranges sometimes find another object instead of a marker
+    # Samples whose median is far from the median of all samples are dropped,
+    # which works as long as most of the frames found the right object
+    medians = np.array(
+        [
+            [
+                np.median(relative_hues(pixels, seedHue)),
+                np.median(pixels[:, 1]),
+                np.median(pixels[:, 2]),
+            ]
+            for frameIndex, center, pixels in samples
+        ]
+    )
+    center = np.median(medians, axis=0)
+    spread = 1.4826 * np.median(np.abs(medians - center), axis=0)
+    limits = np.maximum(3 * spread, margins)
+    return [
+        sample
+        for sample, median in zip(samples, medians)
+        if np.all(np.abs(median - center) <= limits)
+    ]
+
+
+def relative_hues(pixels, seedHue):
+    # Hues are measured from seedHue so ranges around 0/180 stay in one piece
+    return (pixels[:, 0].astype(np.int32) - seedHue + 90) % 180 - 90
+
+
+def fit_marker_range(pixels, seedHue, margins):
+    # (hue, saturation, value) center and tolerances covering the pixels
+    channels = (relative_hues(pixels, seedHue), pixels[:, 1], pixels[:, 2])
+
+    centers = []
+    tolerances = []
+    for channel, margin in zip(channels, margins):
+        lower, upper = np.percentile(channel, (LOWER_PERCENTILE, UPPER_PERCENTILE))
+        centers.append(int(round((lower + upper) / 2)))
+        tolerances.append(int(math.ceil((upper - lower) / 2)) + margin)
+
+    centers[0] = (seedHue + centers[0]) % 180
+    return centers, tolerances
+
+
+def is_marker_found(markerCenter, sampleCenter):
+    # The marker is found on the blob its pixels were sampled from
+    centerReady, center = markerCenter
+    return (
+        centerReady
+        and math.hypot(center.x - sampleCenter.x, center.y - sampleCenter.y)
+        <= SAMPLE_RADIUS
+    )
+
+
+def evaluate_calibration(hsvImages, colorCalibration):
+    # Mask sizes, blob counts, detections and segmentation time on the samples
+    maskPixelCount = 0
+    blobCount = 0
+    detectedCount = 0
+    detections = []
+    startTime = time.perf_counter()
+    for hsvImage in hsvImages:
+        markerCenters, masks = detect_markers(hsvImage, colorCalibration)
+        detections.append(markerCenters)
+    elapsedSeconds = time.perf_counter() - startTime
+
+    for hsvImage, markerCenters in zip(hsvImages, detections):
+        masks = colorCalibration.get_segmenter().segment(hsvImage)
+        for colorName, mask in masks.items():
+            maskPixelCount += cv.countNonZero(mask)
+            blobCount += len(extract_blobs(mask)[0])
+        detectedCount += sum(
+            centerReady for centerReady, center in markerCenters.values()
+        )
+
+    return detections, {
+        "maskPixels": maskPixelCount // len(hsvImages),
+        "blobs": blobCount / len(hsvImages),
+        "detectedMarkers": detectedCount,
+        "segmentationMs": 1000 * elapsedSeconds / len(hsvImages),
+    }
+
+
+def calibrate(frames, margins=DEFAULT_MARGINS, baseCalibration=COLOR_CALIBRATION):
+    # Returns the tight calibration, its profile and a report comparing it with
+    # baseCalibration. Markers not found in any frame keep their base ranges
+    hsvImages = [cv.cvtColor(frame, cv.COLOR_BGR2HSV) for frame in frames]
+    baseDetections, baseReport = evaluate_calibration(hsvImages, baseCalibration)
+    # Red of the common tolerances only covers hue 0 above 0/180, explicit
+    # tolerances let the sampling masks wrap around to the hues above 0 too
+    samplingCalibration = copy.deepcopy(baseCalibration)
+    for colorName in samplingCalibration.get_color_names():
+        samplingCalibration.set_marker_tolerances(
+            colorName, samplingCalibration.get_marker_tolerances(colorName)
+        )
+    markerPixels = collect_marker_pixels(hsvImages, samplingCalibration)
+
+    colorCalibration = copy.deepcopy(baseCalibration)
+    sampleCounts = {}
+    for colorName, samples in markerPixels.items():
+        baseHsv = baseCalibration.markerHsvs[colorName]
+        if len(samples) > 0:
+            samples = reject_outlier_samples(samples, baseHsv.hue, margins)
+        markerPixels[colorName] = samples
+        sampleCounts[colorName] = len(samples)
+        if len(samples) == 0:
+            continue
+        centers, tolerances = fit_marker_range(
+            np.concatenate([pixels for frameIndex, center, pixels in samples]),
+            baseHsv.hue,
+            margins,
+        )
+        colorCalibration.set_marker_hsv(colorName, type(baseHsv)(*centers))
+        colorCalibration.set_marker_tolerances(colorName, tolerances)
+
+    # Tight masks need less noise removal, take the fewest morphology
+    # iterations which still find every sampled marker
+    for morphologyIterations in range(MAX_MORPHOLOGY_ITERATIONS + 1):
+        colorCalibration.set_morphology_iterations(morphologyIterations)
+        detections, report = evaluate_calibration(hsvImages, colorCalibration)
+        if all(
+            is_marker_found(detections[frameIndex][colorName], center)
+            for colorName, samples in markerPixels.items()
+            for frameIndex, center, pixels in samples
+        ):
+            break
+
+    profile = colorCalibration.to_profile()
+    profile["sampleFrames"] = len(frames)
+    # Frames whose pixels were used for each marker
+    profile["sampleCounts"] = sampleCounts
+    return colorCalibration, profile, {"base": baseReport, "calibrated": report}
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Learn marker colors from sample frames and save a profile"
+    )
+    parser.add_argument("name", help="name of the profile")
+    parser.add_argument(
+        "samples",
+        nargs="*",
+        default=[SAMPLE_FRAME_PATH],
+        help="images, image directories or videos (default: the sample frame)",
+    )
+    parser.add_argument("--aspect-ratio", type=float, default=1.3)
+    parser.add_argument(
+        "--frame-step", type=int, default=25, help="use every nth frame of videos"
+    )
+    parser.add_argument("--max-frames", type=int, default=50)
+    parser.add_argument(
+        "--margins",
+        type=int,
+        nargs=3,
+        default=DEFAULT_MARGINS,
+        metavar=("HUE", "SATURATION", "VALUE"),
+        help="added to each side of the measured ranges",
+    )
+    parser.add_argument("--profiles-file", default=COLOR_PROFILES_PATH)
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    args = parse_arguments(arguments)
+    frames = read_sample_frames(
+        args.samples, args.aspect_ratio, args.frame_step, args.max_frames
+    )
+    if len(frames) == 0:
+        raise SystemExit("No sample frames could be read")
+
+    colorCalibration, profile, report = calibrate(frames, tuple(args.margins))
+    save_color_profile(args.name, profile, args.profiles_file)
+
+    for colorName, marker in profile["markers"].items():
+        print(
+            "[CALIBRATE] {}: hsv {} +/- {} (from {} frames)".format(
+                colorName,
+                marker["hsv"],
+                marker["tolerance"],
+                profile["sampleCounts"][colorName],
+            )
+        )
+    print(
+        "[CALIBRATE] morphology iterations: {}".format(profile["morphologyIterations"])
+    )
+    for name, stats in report.items():
+        print("[CALIBRATE] {}: {}".format(name, stats))
+    print(
+        "[CALIBRATE] Saved profile '{}' from {} frames to {}".format(
+            args.name, len(frames), args.profiles_file
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
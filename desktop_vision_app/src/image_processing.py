@@ -4,17 +4,49 @@ import cv2 as cv
 # Multi-threading
 import threading
 
-# for scheduling functions using time.time()
+# Monotonic clocks for latency measurements
 import time
 
 import math
-import numpy as np
 
 # Serial Port Communications Manager
 from serial_port import SerialPortManager
 
 # Robot Control Algorithm
-from robot_control import robot_control_algorithm
+from robot_control import create_controller
+
+# Runs the controller after each frame or at its own fixed rate
+from control_loop import ControlLoop
+
+# Link angles and velocities predicted to the time commands are sent
+from state_estimation import JointStateEstimator, Point
+
+# Marker detection in a pool of worker processes
+from parallel_detection import ParallelDetector
+
+# Marker color calibration compiled into cached bounds and segmenter
+from color_calibration import ColorCalibration, Hsv, load_color_profile
+
+# Areas and centroids of all blobs of a mask
+from blob_extraction import extract_blobs, select_blob, set_blob_backend
+
+# Reusable buffers of intermediate images
+from frame_context import FrameContext
+
+# Search windows around the previous marker positions
+from marker_tracking import MarkerTracker
+
+# Deadline-based clock for processing frames in certain intervals
+from frame_scheduler import FrameScheduler, SCHEDULE_POLICY_DROP_LATE
+
+# Capture thread writing into a ring of preallocated frame buffers
+from frame_capture import FrameCaptureManager
+
+# Per-stage latency histograms and counters
+from pipeline_metrics import PipelineMetrics, MetricsHttpServer
+
+# Immutable per-frame results shared with the GUI thread
+from frame_result import FrameResult, FrameResultPublisher
 
 HUE_TOLERANCE = 20
 SATURATION_TOLERANCE = 120
@@ -31,6 +63,10 @@ GREEN_BLUE_LINK_LENGTH_CM = 30  # in centimeters
 
 MIN_CONTOUR_AREA = math.pow((MIN_DIAMETER_CM / 2) * PIXEL_TO_CM_RATIO, 2) * math.pi
 MAX_CONTOUR_AREA = math.pow((MAX_DIAMETER_CM / 2) * PIXEL_TO_CM_RATIO, 2) * math.pi
+# When several blobs qualify, the one closest to a marker of average diameter wins
+EXPECTED_CONTOUR_AREA = (
+    math.pow(((MIN_DIAMETER_CM + MAX_DIAMETER_CM) / 4) * PIXEL_TO_CM_RATIO, 2) * math.pi
+)
 
 BGR_RED = (0, 0, 255)
 BGR_BLUE = (255, 0, 0)
@@ -38,22 +74,24 @@ BGR_GREEN = (0, 255, 0)
 BGR_WHITE = (255, 255, 255)
 
 
-class Hsv:
-    def __init__(self, hue=0, saturation=0, value=0):
-        self.hue = hue
-        self.saturation = saturation
-        self.value = value
-
-
 CALIBRATED_HSV_RED = Hsv(178, 243, 175)
 CALIBRATED_HSV_BLUE = Hsv(113, 189, 115)
 CALIBRATED_HSV_GREEN = Hsv(55, 157, 135)
 
 
-class Point:
-    def __init__(self, x=0, y=0):
-        self.x = x
-        self.y = y
+MARKER_COLOR_NAMES = ("green", "blue", "red")
+
+COLOR_CALIBRATION = ColorCalibration(
+    {
+        "green": CALIBRATED_HSV_GREEN,
+        "blue": CALIBRATED_HSV_BLUE,
+        "red": CALIBRATED_HSV_RED,
+    },
+    HUE_TOLERANCE,
+    SATURATION_TOLERANCE,
+    VALUE_TOLERANCE,
+    hueWrappedColorNames=("red",),
+)
 
 
 class ImageProcessingManager:
@@ -62,16 +100,57 @@ class ImageProcessingManager:
         videoSource,
         videoAspectRatio=1.0,
         intervalMilliseconds=40,
+        schedulePolicy=SCHEDULE_POLICY_DROP_LATE,
+        trackingEnabled=True,
+        pyramidLevels=0,
     ):
 
         self.isRunning = False
         self.videoSource = videoSource
         self.videoAspectRatio = videoAspectRatio
         self.intervalMilliseconds = intervalMilliseconds
-        self.success = False
-        self.originalImage = None
+        self.frameScheduler = FrameScheduler(intervalMilliseconds, schedulePolicy)
+        self.frameId = 0
+        self.droppedFrameCount = 0
         self.processedImage = None
 
+        # Search markers near their previous positions instead of the full frame
+        self.markerTracker = MarkerTracker(MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO)
+        self.trackingEnabled = trackingEnabled
+        # Number of times the frame is halved for the full-frame search
+        self.pyramidLevels = pyramidLevels
+        # Buffers of intermediate images reused by every frame
+        self.frameContext = FrameContext()
+        # Detected markers of the current frame, the processed image is only
+        # drawn from them when somebody asks for it
+        self.markerCenters = None
+        self.processedImageKey = None
+        self.displayContext = FrameContext()
+        # Result of the newest processed frame for other threads
+        self.resultPublisher = FrameResultPublisher()
+        # (width, height) of RGB images prepared for the GUI with each result
+        self.displaySize = None
+
+        # Latency of each pipeline stage, dropped frames and detection rate
+        self.pipelineMetrics = PipelineMetrics()
+        self.metricsLogInterval = 0
+        self.nextMetricsLogTime = 0.0
+        self.metricsHttpServer = None
+
+        # With a ParallelDetector frames are only cropped by the processing
+        # thread and detected by worker processes (see set_worker_count)
+        self.parallelDetector = None
+        self.isParallelDetectorOwned = False
+        self.parallelSourceId = id(self)
+        # Calibration profile also given to worker processes
+        self.colorProfile = None
+        self.imageProcessingThread = None
+        self.detectionResultThread = None
+
+        # Frames, detections and motor commands are written to a session
+        # file while a SessionRecorder (session_recording.py) is set
+        self.sessionRecorder = None
+
         # Joint positions in centimeters
         self.greenJointPositionCm = Point(0, 0)
         self.blueJointPositionCm = Point(0, 0)
@@ -85,115 +164,574 @@ class ImageProcessingManager:
         self.serialPortName = None
         self.serialPortBaud = 9600
         self.serialPortManager = SerialPortManager(self.serialPortBaud)
+        # Commands are written by the serial writer thread, which times them
+        self.serialPortManager.set_write_time_callback(
+            lambda seconds: self.pipelineMetrics.add_stage_time("serial_write", seconds)
+        )
 
-        # Open the video source
-        self.videoCapture = cv.VideoCapture()
+        # Control runs on the latest joint positions and stops the motors when
+        # they get stale
+        self.controlLoop = ControlLoop(
+            self.send_motor_speeds,
+            estimator=JointStateEstimator(GREEN_BLUE_LINK_LENGTH_CM),
+        )
+
+        # Video source is read in its own thread
+        self.frameCaptureManager = FrameCaptureManager(
+            self.videoSource, intervalMilliseconds=self.intervalMilliseconds
+        )
 
     def set_source(self, videoSource):
         self.videoSource = videoSource
+        self.frameCaptureManager.set_source(videoSource)
 
     def set_interval(self, interval):
         self.intervalMilliseconds = interval
+        self.frameScheduler.set_interval(interval)
+        self.frameCaptureManager.set_interval(interval)
+
+    def set_schedule_policy(self, policy):
+        self.frameScheduler.set_policy(policy)
+
+    def get_scheduler_stats(self):
+        return self.frameScheduler.get_stats()
+
+    def get_capture_stats(self):
+        return self.frameCaptureManager.get_stats()
+
+    def get_serial_stats(self):
+        return {
+            "write": self.serialPortManager.get_write_stats(),
+            "read": self.serialPortManager.get_read_stats(),
+            "link": self.serialPortManager.get_link_stats(),
+        }
+
+    def set_tracking_enabled(self, isEnabled):
+        self.trackingEnabled = isEnabled
+        self.markerTracker.reset()
+
+    def set_pyramid_levels(self, pyramidLevels):
+        # Workers take it on start()
+        self.pyramidLevels = pyramidLevels
+        if self.parallelDetector is not None:
+            self.parallelDetector.pyramidLevels = pyramidLevels
+
+    def set_blob_backend(self, blobBackend):
+        # Process-wide, workers take it on start()
+        set_blob_backend(blobBackend)
+        if self.parallelDetector is not None:
+            self.parallelDetector.blobBackend = blobBackend
+
+    def set_worker_count(self, workerCount):
+        # Detect markers in 'workerCount' worker processes (0 detects them in
+        # the processing thread). Marker tracking is not used by workers since
+        # consecutive frames go to different processes. Takes effect on start()
+        if self.isParallelDetectorOwned:
+            self.parallelDetector.stop()
+        if workerCount > 0:
+            self.parallelDetector = ParallelDetector(
+                workerCount,
+                pyramidLevels=self.pyramidLevels,
+                colorProfile=self.colorProfile,
+            )
+            self.isParallelDetectorOwned = True
+        else:
+            self.parallelDetector = None
+            self.isParallelDetectorOwned = False
+
+    def set_parallel_detector(self, parallelDetector, sourceId=None):
+        # Share a started ParallelDetector with other managers
+        if self.isParallelDetectorOwned:
+            self.parallelDetector.stop()
+        self.parallelDetector = parallelDetector
+        self.isParallelDetectorOwned = False
+        if sourceId is not None:
+            self.parallelSourceId = sourceId
+        parallelDetector.pyramidLevels = self.pyramidLevels
+        if self.colorProfile is not None:
+            parallelDetector.colorProfile = self.colorProfile
+
+    def set_color_profile(self, profile):
+        # A calibration profile dict or the name of a saved one. Marker colors
+        # are shared by all managers of the process. Workers take it on start()
+        if isinstance(profile, str):
+            profile = load_color_profile(profile)
+        set_color_profile(profile)
+        self.colorProfile = profile
+        if self.parallelDetector is not None:
+            self.parallelDetector.colorProfile = profile
+
+    def is_alive(self):
+        # False when a processing thread has ended (e.g. by an exception)
+        # although the manager was not stopped
+        threads = (self.imageProcessingThread, self.detectionResultThread)
+        return self.isRunning and all(
+            thread is None or thread.is_alive() for thread in threads
+        )
+
+    def get_parallel_stats(self):
+        if self.parallelDetector is None:
+            return None
+        return self.parallelDetector.get_stats()
+
+    def get_metrics(self):
+        return self.pipelineMetrics.get_snapshot()
+
+    def set_metrics_log_interval(self, seconds):
+        # Print a metrics line every 'seconds' (0 disables it)
+        self.metricsLogInterval = seconds
+
+    def start_metrics_server(self, port=9100, host="127.0.0.1"):
+        # Serve metrics on http://host:port/metrics (Prometheus text format)
+        self.metricsHttpServer = MetricsHttpServer(self.pipelineMetrics, port, host)
+        self.metricsHttpServer.start()
+
+    def set_session_recorder(self, sessionRecorder):
+        # A started SessionRecorder or None, the caller stops it
+        self.sessionRecorder = sessionRecorder
+
+    def get_tracking_stats(self):
+        return self.markerTracker.get_stats()
 
     def config_serial_port(self, portName, baudRate):
         self.serialPortName = portName
         self.serialPortBaud = baudRate
 
-    def get_joint_positions(self):
+    def set_controller(self, controller):
+        # A RobotController or the name of a registered one
+        if isinstance(controller, str):
+            controller = create_controller(controller)
+        self.controlLoop.set_controller(controller)
+
+    def set_control_rate(self, rateHz):
+        # 0 runs the controller after each processed frame (default), otherwise
+        # in its own thread at rateHz. Takes effect on start()
+        self.controlLoop.set_rate(rateHz)
+
+    def set_stale_timeout(self, staleTimeout):
+        # Motors are stopped when the newest joint positions are older (seconds)
+        self.controlLoop.set_stale_timeout(staleTimeout)
+
+    def set_estimation_enabled(self, isEnabled):
+        # Without estimation the controller gets the measured positions and
+        # zero angular velocities
+        if isEnabled:
+            self.controlLoop.set_estimator(
+                JointStateEstimator(GREEN_BLUE_LINK_LENGTH_CM)
+            )
+        else:
+            self.controlLoop.set_estimator(None)
+
+    def set_prediction_lead_time(self, seconds):
+        # Expected delay from sending a command to its effect on the motors,
+        # added to the prediction time of joint states
+        self.controlLoop.set_prediction_lead_time(seconds)
+
+    def get_control_stats(self):
+        return self.controlLoop.get_stats()
+
+    def set_serial_protocol(self, protocol):
+        # "framed" for the current Arduino firmware, "legacy" for the 3-byte packet
+        self.serialPortManager.set_protocol(protocol)
+
+    def set_display_size(self, displayWidth, displayHeight):
+        # Each FrameResult will also carry the original and processed images
+        # resized and converted to RGB for display, so the GUI thread does not
+        # have to (None disables it)
+        if displayWidth is None or displayHeight is None:
+            self.displaySize = None
+        else:
+            self.displaySize = (displayWidth, displayHeight)
+
+    def prepare_display_images(self, originalImage, markerCenters):
+        # Resize first, so the color conversion only touches display-size pixels
+        # Rotating buffers keep the images of the published results intact
+        # while the GUI converts them
+        displayWidth, displayHeight = self.displaySize
+        displayShape = (displayHeight, displayWidth, 3)
+
+        resizedImage = cv.resize(
+            originalImage,
+            (displayWidth, displayHeight),
+            dst=self.frameContext.get_buffer("displayResized", displayShape),
+        )
+        originalRgbImage = cv.cvtColor(
+            resizedImage,
+            cv.COLOR_BGR2RGB,
+            dst=self.frameContext.get_rotating_buffer(
+                "displayOriginal", displayShape, count=3
+            ),
+        )
+
+        processedRgbImage = render_overlay(
+            markerCenters,
+            self.frameContext.get_rotating_buffer(
+                "displayProcessed", displayShape, count=3
+            ),
+            displayWidth / originalImage.shape[1],
+        )
+        cv.cvtColor(processedRgbImage, cv.COLOR_BGR2RGB, dst=processedRgbImage)
+
+        return originalRgbImage, processedRgbImage
+
+    def get_current_joint_positions(self):
+        # Positions of the frame being processed, for the processing thread only
         return (
             self.greenJointPositionCm,
             self.blueJointPositionCm,
             self.redJointPositionCm,
         )
 
+    def get_latest_result(self):
+        # FrameResult of the newest processed frame (None before the first one)
+        return self.resultPublisher.get_latest()
+
+    def wait_for_result(self, frameId, timeout=None):
+        # Wait for a FrameResult newer than frameId, None on timeout
+        return self.resultPublisher.wait_for_newer(frameId, timeout)
+
+    def get_joint_positions(self):
+        frameResult = self.resultPublisher.get_latest()
+        if frameResult is None:
+            return Point(0, 0), Point(0, 0), Point(0, 0)
+        return frameResult.jointPositionsCm
+
     def get_images(self):
-        return self.success, self.originalImage, self.processedImage
+        # Original and processed images of the same frame
+        frameResult = self.resultPublisher.get_latest()
+        if frameResult is None:
+            return False, None, None
+        return (
+            True,
+            frameResult.originalImage,
+            self.get_processed_image(frameResult=frameResult),
+        )
+
+    def get_processed_image(
+        self, displayWidth=None, displayHeight=None, frameResult=None
+    ):
+        # Draw the processed image of a frame (the newest if not given) on demand,
+        # optionally directly in display size. It is drawn at most once per frame
+        # and size
+        if frameResult is None:
+            frameResult = self.resultPublisher.get_latest()
+        if frameResult is None:
+            return None
+
+        frameId = frameResult.frameId
+        markerCenters = frameResult.markerCenters
+        originalImage = frameResult.originalImage
+
+        imageShape = originalImage.shape
+        if displayWidth is not None and displayHeight is not None:
+            imageShape = (displayHeight, displayWidth, imageShape[2])
+
+        key = (frameId, imageShape)
+        if key != self.processedImageKey:
+            self.processedImage = render_overlay(
+                markerCenters,
+                self.displayContext.get_rotating_buffer("overlay", imageShape),
+                imageShape[1] / originalImage.shape[1],
+            )
+            self.processedImageKey = key
+
+        return self.processedImage
+
+    def start_outputs(self):
+        # Serial port and control, without capture and processing threads
+        # (used alone when frames are fed with process_frame())
+        self.resultPublisher.reset()
+        self.processedImageKey = None
+        # Start Serial Port Communication (runs without a robot if no port is set)
+        if self.serialPortName is not None:
+            self.serialPortManager.set_name(self.serialPortName)
+            self.serialPortManager.set_baud(self.serialPortBaud)
+            self.serialPortManager.start()
+        # Start Control Loop Thread (if it has its own rate)
+        self.controlLoop.start()
+
+    def stop_outputs(self):
+        self.controlLoop.stop()
+        self.serialPortManager.stop()
 
     def start(self):
         self.isRunning = True
-        # Start Serial Port Communication
-        self.serialPortManager.set_name(self.serialPortName)
-        self.serialPortManager.set_baud(self.serialPortBaud)
-        self.serialPortManager.start()
+        self.start_outputs()
         # Start Video Capture Thread
-        self.videoCaptureThread = threading.Thread(target=self.image_thread_handler)
-        self.videoCaptureThread.start()
+        self.frameCaptureManager.start()
+        self.nextMetricsLogTime = time.monotonic() + self.metricsLogInterval
+        if self.parallelDetector is None:
+            # Start Image Processing Thread
+            self.imageProcessingThread = threading.Thread(
+                target=self.image_thread_handler
+            )
+            self.imageProcessingThread.start()
+        else:
+            # Start Frame Submission and Detection Result Threads
+            if self.isParallelDetectorOwned:
+                self.parallelDetector.start()
+            self.imageProcessingThread = threading.Thread(
+                target=self.parallel_submit_thread_handler
+            )
+            self.imageProcessingThread.start()
+            self.detectionResultThread = threading.Thread(
+                target=self.parallel_result_thread_handler
+            )
+            self.detectionResultThread.start()
 
     def stop(self):
         self.isRunning = False
-        self.serialPortManager.stop()
+        self.frameCaptureManager.stop()
+        for thread in (self.imageProcessingThread, self.detectionResultThread):
+            if thread is not None:
+                thread.join()
+        self.imageProcessingThread = None
+        self.detectionResultThread = None
+        if self.parallelDetector is not None:
+            if self.isParallelDetectorOwned:
+                self.parallelDetector.stop()
+            else:
+                # Frames still queued in a shared detector are never taken
+                self.parallelDetector.discard_source(self.parallelSourceId)
+        self.stop_outputs()
+        if self.metricsHttpServer is not None:
+            self.metricsHttpServer.stop()
+            self.metricsHttpServer = None
 
     def image_thread_handler(self):
 
+        self.frameScheduler.reset()
+        self.markerTracker.reset()
+
+        while self.isRunning:
+
+            # Sleep until the next deadline to process frames in certain intervals
+            self.frameScheduler.wait_next_tick()
+
+            # Always take the newest captured frame, older ones are dropped
+            (
+                success,
+                frame,
+                frameId,
+                frameTimestamp,
+                droppedFrames,
+            ) = self.frameCaptureManager.read_latest(self.intervalMilliseconds / 1000)
+
+            if not success:
+                # No new frame since the last tick
+                self.check_control_stale()
+                continue
+
+            processingStartTime = time.monotonic()
+            self.frameContext.reset_stage_times()
+            self.frameContext.start_stage()
+
+            self.frameId = frameId
+            self.droppedFrameCount += droppedFrames
+
+            # Correct aspect ratio of frame by cropping
+            originalImage = crop_image(frame, self.videoAspectRatio)
+            self.frameContext.end_stage("crop")
+
+            ##################################
+            #  Main Image Processing Routine #
+            ##################################
+            isDetected = self.main_image_processing(originalImage, frameTimestamp)
+
+            self.publish_frame_result(
+                frameId, frameTimestamp, originalImage, isDetected
+            )
+
+            # Capture latency is the age of the frame when its processing started
+            self.frameContext.stageTimes["capture"] = (
+                processingStartTime - frameTimestamp
+            )
+            self.record_frame_metrics(frameTimestamp, isDetected, droppedFrames)
+
+    def parallel_submit_thread_handler(self):
+        # Crop the newest frames and hand them to the worker processes
+        self.frameScheduler.reset()
+
+        while self.isRunning:
+
+            self.frameScheduler.wait_next_tick()
+
+            (
+                success,
+                frame,
+                frameId,
+                frameTimestamp,
+                droppedFrames,
+            ) = self.frameCaptureManager.read_latest(self.intervalMilliseconds / 1000)
+
+            if not success:
+                continue
+
+            processingStartTime = time.monotonic()
+            originalImage = crop_image(frame, self.videoAspectRatio)
+            self.pipelineMetrics.add_stage_time(
+                "crop", time.monotonic() - processingStartTime
+            )
+            self.pipelineMetrics.add_stage_time(
+                "capture", processingStartTime - frameTimestamp
+            )
+
+            # The frame is copied into shared memory, so the ring buffer slot
+            # can be reused right away. If all workers are busy it is dropped
+            if not self.parallelDetector.submit(
+                self.parallelSourceId, frameId, originalImage, frameTimestamp
+            ):
+                droppedFrames += 1
+            self.droppedFrameCount += droppedFrames
+            self.pipelineMetrics.count_dropped_frames(droppedFrames)
+
+    def parallel_result_thread_handler(self):
+        # Take detection results in frame order and run the rest of the pipeline
+
         while self.isRunning:
 
-            # Do processing on captured frame in certain intervals
-            if time_ms() % self.intervalMilliseconds == 0:
+            result = self.parallelDetector.get_result(self.parallelSourceId, 0.1)
+            if result is None:
+                self.check_control_stale()
+                continue
 
-                if not self.videoCapture.isOpened():
-                    self.videoCapture = cv.VideoCapture(self.videoSource)
-                else:
-                    success, frame = self.videoCapture.read()
+            # Published results may be held by readers for a few frames, so they
+            # get a copy and the shared memory slot goes back to the workers
+            originalImage = self.frameContext.get_rotating_buffer(
+                "parallelOriginal", result.image.shape, count=3
+            )
+            originalImage[...] = result.image
+            self.parallelDetector.release(result)
+
+            self.frameContext.reset_stage_times()
+            self.frameContext.stageTimes.update(result.stageTimes)
+
+            markerCenters = result.markerCenters
+            if markerCenters is None:
+                print("[  VISION ] Detection failed: {}".format(result.error))
+                markerCenters = {
+                    colorName: (False, Point(0, 0)) for colorName in MARKER_COLOR_NAMES
+                }
 
-                    self.success = success and frame.all != None
+            self.frameId = result.frameId
+            self.markerCenters = markerCenters
+            isDetected = self.process_marker_centers(markerCenters, result.timestamp)
 
-                    if self.success:
-                        # Correct aspect ratio of frame by cropping
-                        self.originalImage = crop_image(frame, self.videoAspectRatio)
+            self.publish_frame_result(
+                result.frameId, result.timestamp, originalImage, isDetected
+            )
+            self.record_frame_metrics(result.timestamp, isDetected, 0)
+
+    def process_frame(self, frameId, frameTimestamp, image):
+        # Runs the pipeline on a cropped frame in the calling thread, e.g. to
+        # replay a recorded session. Needs start_outputs() instead of start()
+        self.frameContext.reset_stage_times()
+        self.frameId = frameId
+        isDetected = self.main_image_processing(image, frameTimestamp)
+        self.publish_frame_result(frameId, frameTimestamp, image, isDetected)
+        self.record_frame_metrics(frameTimestamp, isDetected, 0)
+        return isDetected
+
+    def publish_frame_result(self, frameId, frameTimestamp, originalImage, isDetected):
+        sessionRecorder = self.sessionRecorder
+        if sessionRecorder is not None:
+            sessionRecorder.record_frame(
+                frameId, frameTimestamp, originalImage, self.markerCenters
+            )
+
+        displayImages = None
+        if self.displaySize is not None:
+            self.frameContext.start_stage()
+            displayImages = self.prepare_display_images(
+                originalImage, self.markerCenters
+            )
+            self.frameContext.end_stage("display")
+
+        # Readers of the result get a read-only view of the frame
+        originalImage = originalImage.view()
+        originalImage.flags.writeable = False
+        self.resultPublisher.publish(
+            FrameResult(
+                frameId,
+                frameTimestamp,
+                time.monotonic(),
+                isDetected,
+                originalImage,
+                self.markerCenters,
+                self.get_current_joint_positions(),
+                (self.motorSpeedA, self.motorSpeedB),
+                displayImages,
+            )
+        )
 
-                        ##################################
-                        #  Main Image Processing Routine #
-                        ##################################
-                        self.processedImage = self.main_image_processing(
-                            self.originalImage
-                        )
+    def record_frame_metrics(self, frameTimestamp, isDetected, droppedFrames):
+        stageTimes = self.frameContext.stageTimes
+        stageTimes["total"] = time.monotonic() - frameTimestamp
+        self.pipelineMetrics.add_stage_times(stageTimes)
+        self.pipelineMetrics.count_frame(isDetected, droppedFrames)
 
-                    else:
-                        continue
+        if self.metricsLogInterval > 0 and time.monotonic() >= self.nextMetricsLogTime:
+            print(self.pipelineMetrics.format_log_line())
+            self.nextMetricsLogTime = time.monotonic() + self.metricsLogInterval
 
-    # Release the video source when the object is destroyed
+    # Stop the threads when the object is destroyed
     def __del__(self):
+        self.frameCaptureManager.stop()
         self.serialPortManager.stop()
-        if self.videoCapture.isOpened():
-            self.videoCapture.release()
 
-    def main_image_processing(self, inputImage):
+    def main_image_processing(self, inputImage, frameTimestamp=None):
+        # frameTimestamp is the time.monotonic() capture time of inputImage
 
-        success, greenCenter, blueCenter, redCenter, outputImage = find_join_positions(
-            inputImage
+        markerTracker = self.markerTracker if self.trackingEnabled else None
+
+        markerCenters = find_marker_centers(
+            inputImage, markerTracker, self.pyramidLevels, self.frameContext
         )
+        self.markerCenters = markerCenters
 
-        if success:
+        return self.process_marker_centers(markerCenters, frameTimestamp)
 
-            scalingRatio = (
-                math.sqrt(
-                    math.pow(blueCenter.x - greenCenter.x, 2)
-                    + math.pow(blueCenter.y - greenCenter.y, 2)
-                )
-                / GREEN_BLUE_LINK_LENGTH_CM
-            )
+    def process_marker_centers(self, markerCenters, frameTimestamp=None):
+        # Joint positions and control of the markers found in a frame
 
-            # Convert units pixel position units into ground truth centimeters
-            # the Green point is considered as the origin of our coordinate system
-            blueCmX = (1 / scalingRatio) * (blueCenter.x - greenCenter.x)
-            blueCmY = -(1 / scalingRatio) * (blueCenter.y - greenCenter.y)
-            redCmX = (1 / scalingRatio) * (redCenter.x - greenCenter.x)
-            redCmY = -(1 / scalingRatio) * (redCenter.y - greenCenter.y)
+        success = is_detection_complete(markerCenters)
 
-            self.blueJointPositionCm = Point(blueCmX, blueCmY)
-            self.redJointPositionCm = Point(redCmX, redCmY)
+        if success:
 
-            # Give joint positions to the Robot Control Algorithm and get the motor speeds
-            self.motorSpeedA, self.motorSpeedB = robot_control_algorithm(
+            (
                 self.greenJointPositionCm,
                 self.blueJointPositionCm,
                 self.redJointPositionCm,
+            ) = compute_joint_positions_cm(
+                markerCenters["green"][1],
+                markerCenters["blue"][1],
+                markerCenters["red"][1],
             )
 
-            # Send speed of motors to Arduino board
-            self.send_motor_speeds(self.motorSpeedA, self.motorSpeedB)
+            # Give joint positions to the control loop
+            if frameTimestamp is None:
+                frameTimestamp = time.monotonic()
+            self.controlLoop.update_measurement(
+                self.get_current_joint_positions(), frameTimestamp
+            )
+
+        if not self.controlLoop.isRunning:
+            # Control runs once per frame: the controller computes the motor
+            # speeds and they are sent to Arduino board
+            if success and self.controlLoop.step():
+                stageTimes = self.frameContext.stageTimes
+                stageTimes["control"] = self.controlLoop.lastComputeSeconds
+            else:
+                self.controlLoop.check_stale()
+
+        return success
 
-        return outputImage
+    def check_control_stale(self):
+        # Called by the vision thread when no frame arrives. Control running
+        # once per frame must stop the motors without frames too, a control
+        # thread checks it on every step itself
+        if not self.controlLoop.isRunning:
+            self.controlLoop.check_stale()
 
     def send_motor_speeds(self, speedA, speedB):
         # speeds must be normalized and saturated between -1.0 and 1.0
@@ -209,28 +747,19 @@ class ImageProcessingManager:
         if speedB < -1.0:
             speedB = -1.0
 
-        # Create a 3-byte packet which is defined in Arduino code
-        cmdPacket = [0xFF, 0, 0]
-        # 0xFF or 255 is reserved for start of packet byte
-        # so the speed bytes value range is (0, 254)
-        cmdPacket[1] = map_number(int(speedA * 255), -255, 255, 0, 254)
-        cmdPacket[2] = map_number(int(speedB * 255), -255, 255, 0, 254)
-
-        # Send cmdPacket to serial port
-        try:
-            if (
-                self.serialPortManager.serialPort.isOpen()
-                and self.serialPortManager.isRunning
-            ):
-                self.serialPortManager.serialPort.write(bytearray(cmdPacket))
-        except:
-            # ignore errors
-            pass
+        self.motorSpeedA = speedA
+        self.motorSpeedB = speedB
 
+        sessionRecorder = self.sessionRecorder
+        if sessionRecorder is not None:
+            sessionRecorder.record_command(
+                self.frameId, time.monotonic(), speedA, speedB
+            )
 
-def time_ms():
-    # Get time in milliseconds
-    return int(time.time() * 1000)
+        # Hand the speeds to the serial writer thread, which encodes them in
+        # the packet format of the serial protocol (see serial_protocol.py)
+        # and replaces any command which is not written yet
+        self.serialPortManager.send_motor_speeds(speedA, speedB)
 
 
 def crop_image(inputImage, desiredAspectRatio):
@@ -257,154 +786,312 @@ def crop_image(inputImage, desiredAspectRatio):
     return croppedImage
 
 
+def set_color_profile(profile):
+    # Use the marker colors of a calibration profile (hsv_calibration.py)
+    # instead of the hard-coded ones, for all pipelines of this process
+    COLOR_CALIBRATION.apply_profile(profile)
+
+
 def filter_color(hsvImage, colorNameToFilter):
+    # Reference implementation filtering one color at a time
+    # find_join_positions() uses the calibration's segmenter which gives the same masks
 
-    if colorNameToFilter == "green":
+    hsvRanges = COLOR_CALIBRATION.get_ranges(colorNameToFilter)
 
-        baseHue = CALIBRATED_HSV_GREEN.hue
-        baseSaturation = CALIBRATED_HSV_GREEN.saturation
-        baseValue = CALIBRATED_HSV_GREEN.value
+    lower, upper = hsvRanges[0]
+    filteredImage = cv.inRange(hsvImage, lower, upper)
 
-    elif colorNameToFilter == "blue":
+    for lower, upper in hsvRanges[1:]:
+        filteredImage2 = cv.inRange(hsvImage, lower, upper)
+        filteredImage = cv.bitwise_or(filteredImage, filteredImage2)
 
-        baseHue = CALIBRATED_HSV_BLUE.hue
-        baseSaturation = CALIBRATED_HSV_BLUE.saturation
-        baseValue = CALIBRATED_HSV_BLUE.value
+    kernel = COLOR_CALIBRATION.get_kernel()
+    iterations = COLOR_CALIBRATION.morphologyIterations
+    # remove some noise
+    if iterations > 0:
+        filteredImage = cv.erode(filteredImage, kernel, iterations=iterations)
+        filteredImage = cv.dilate(filteredImage, kernel, iterations=iterations)
 
-    elif colorNameToFilter == "red":
+    return filteredImage
 
-        baseHue = CALIBRATED_HSV_RED.hue
-        baseSaturation = CALIBRATED_HSV_RED.saturation
-        baseValue = CALIBRATED_HSV_RED.value
 
-    else:
-        pass
+def compare_segmentation(hsvImage):
+    # Count mismatching pixels between the segmenter and filter_color() masks
+    masks = COLOR_CALIBRATION.get_segmenter().segment(hsvImage)
+    return {
+        colorName: cv.countNonZero(
+            cv.bitwise_xor(masks[colorName], filter_color(hsvImage, colorName))
+        )
+        for colorName in MARKER_COLOR_NAMES
+    }
 
-    hueMin = baseHue - HUE_TOLERANCE
-    saturationMin = baseSaturation - SATURATION_TOLERANCE
-    valueMin = baseValue - VALUE_TOLERANCE
 
-    hueMax = baseHue + HUE_TOLERANCE
-    saturationMax = baseSaturation + SATURATION_TOLERANCE
-    valueMax = baseValue + VALUE_TOLERANCE
+def find_center(
+    filteredImage,
+    minContourArea=MIN_CONTOUR_AREA,
+    maxContourArea=MAX_CONTOUR_AREA,
+    expectedContourArea=EXPECTED_CONTOUR_AREA,
+):
 
-    if hueMin < 0:
-        hueMin = 0
+    success = False
+    center = Point(0, 0)
 
-    if hueMax > 180:
-        hueMax = 180
+    areas, centroids = extract_blobs(filteredImage)
 
-    if saturationMin < 0:
-        saturationMin = 0
+    index = select_blob(areas, minContourArea, maxContourArea, expectedContourArea)
 
-    if saturationMax > 255:
-        saturationMax = 255
+    if index >= 0:
+        success = True
+        # Centroids are kept as floats, only rendering rounds them to pixels
+        center = Point(centroids[index][0], centroids[index][1])
 
-    if valueMin < 0:
-        valueMin = 0
+    return success, center
 
-    if valueMax > 255:
-        valueMax = 255
 
-    filteredImage = cv.inRange(
-        hsvImage, (hueMin, saturationMin, valueMin), (hueMax, saturationMax, valueMax)
-    )
+def find_center_in_window(inputImage, colorName, searchWindow, frameContext):
+    # Find center of a marker inside (x0, y0, x1, y1) window of a BGR image
 
-    # red color covers some hues around 0 and some around 180
-    # so two hue ranges is consired for filtering red color
-    if colorNameToFilter == "red":
+    frameContext.start_stage()
 
-        hueMin2 = 0
-        hueMax2 = 0
+    x0, y0, x1, y1 = searchWindow
+    windowImage = inputImage[y0:y1, x0:x1]
+    hsvWindow = frameContext.get_buffer("window.hsv", windowImage.shape)
+    cv.cvtColor(windowImage, cv.COLOR_BGR2HSV, dst=hsvWindow)
+    frameContext.end_stage("hsv")
 
-        if hueMin < 0:
-            hueMin2 = 180 + hueMin
-            hueMax2 = 180
+    segmenter = COLOR_CALIBRATION.get_segmenter()
+    filteredWindow = segmenter.segment(
+        hsvWindow, [colorName], frameContext=frameContext, bufferName="window"
+    )[colorName]
+    frameContext.end_stage("mask")
 
-        if hueMax > 180:
-            hueMin2 = 0
-            hueMax2 = hueMax - 180
+    centerReady, center = find_center(filteredWindow)
+    frameContext.end_stage("contour")
 
-        filteredImage2 = cv.inRange(
-            hsvImage,
-            (hueMin2, saturationMin, valueMin),
-            (hueMax2, saturationMax, valueMax),
-        )
-        filteredImage = cv.bitwise_or(filteredImage, filteredImage2)
+    if centerReady:
+        center = Point(center.x + x0, center.y + y0)
 
-    kernel = np.ones((5, 5), np.uint8)
-    # remove some noise
-    filteredImage = cv.erode(filteredImage, kernel, iterations=3)
-    filteredImage = cv.dilate(filteredImage, kernel, iterations=3)
+    return centerReady, center
 
-    return filteredImage
 
+def find_centers_in_pyramid(inputImage, colorNames, pyramidLevels, frameContext):
+    # Coarse-to-fine search: segment on the image downscaled by 2^pyramidLevels
+    # and refine each found center on a small full resolution window
 
-def find_center(filteredImage):
+    frameContext.start_stage()
 
-    success = False
-    center = Point(0, 0)
+    smallImage = inputImage
+    for level in range(pyramidLevels):
+        smallShape = (
+            (smallImage.shape[0] + 1) // 2,
+            (smallImage.shape[1] + 1) // 2,
+            smallImage.shape[2],
+        )
+        smallImage = cv.pyrDown(
+            smallImage,
+            dst=frameContext.get_buffer("pyramid" + str(level), smallShape),
+            dstsize=(smallShape[1], smallShape[0]),
+        )
 
-    contours, hierarchy = cv.findContours(
-        filteredImage, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
+    scale = inputImage.shape[1] / smallImage.shape[1]
+    areaScale = math.pow(scale, 2)
+
+    hsvImage = frameContext.get_buffer("pyramid.hsv", smallImage.shape)
+    cv.cvtColor(smallImage, cv.COLOR_BGR2HSV, dst=hsvImage)
+    frameContext.end_stage("hsv")
+
+    segmenter = COLOR_CALIBRATION.get_segmenter()
+    masks = segmenter.segment(
+        hsvImage, colorNames, pyramidLevels, frameContext, bufferName="pyramid"
     )
+    frameContext.end_stage("mask")
 
-    for contour in contours:
+    # Half size of refinement window, large enough for a marker and the
+    # uncertainty of the coarse center
+    windowRadius = int(
+        MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO / 2 + segmenter.morphologyRadius + 2 * scale
+    )
 
-        moment = cv.moments(contour)
+    markerCenters = {}
 
-        if moment["m00"] != 0:
+    for colorName in colorNames:
 
-            x = int(moment["m10"] / moment["m00"])
-            y = int(moment["m01"] / moment["m00"])
+        centerReady, coarseCenter = find_center(
+            masks[colorName],
+            MIN_CONTOUR_AREA / areaScale,
+            MAX_CONTOUR_AREA / areaScale,
+            EXPECTED_CONTOUR_AREA / areaScale,
+        )
+        frameContext.end_stage("contour")
+
+        if centerReady:
+            x = int(coarseCenter.x * scale)
+            y = int(coarseCenter.y * scale)
+            searchWindow = (
+                max(0, x - windowRadius),
+                max(0, y - windowRadius),
+                min(inputImage.shape[1], x + windowRadius + 1),
+                min(inputImage.shape[0], y + windowRadius + 1),
+            )
+            markerCenters[colorName] = find_center_in_window(
+                inputImage, colorName, searchWindow, frameContext
+            )
+            frameContext.start_stage()
+        else:
+            markerCenters[colorName] = (False, Point(0, 0))
 
-            contourArea = cv.contourArea(contour)
+    return markerCenters
 
-            if (contourArea > MIN_CONTOUR_AREA) and (contourArea < MAX_CONTOUR_AREA):
 
-                success = True
-                center = Point(x, y)
+def find_marker_centers(
+    inputImage, markerTracker=None, pyramidLevels=0, frameContext=None
+):
+    # Find centers of all markers, returns a dict of color name -> (ready, center)
+    # With a MarkerTracker each marker is first searched in a small window around
+    # its previous position and only the lost markers are searched in full frame
+    # With pyramidLevels > 0 the full-frame search is done coarse-to-fine
+    # With a FrameContext all intermediate images reuse its buffers
 
-    return success, center
+    if frameContext is None:
+        frameContext = FrameContext()
 
+    markerCenters = {}
+    lostColorNames = []
 
-def find_join_positions(inputImage):
+    for colorName in MARKER_COLOR_NAMES:
 
-    success = False
+        searchWindow = None
+        if markerTracker is not None:
+            searchWindow = markerTracker.get_search_window(colorName, inputImage.shape)
 
-    greenCenter = Point(0, 0)
-    blueCenter = Point(0, 0)
-    redCenter = Point(0, 0)
+        if searchWindow is None:
+            lostColorNames.append(colorName)
+            continue
 
-    greenCenterReady = False
-    blueCenterReady = False
-    redCenterReady = False
+        centerReady, center = find_center_in_window(
+            inputImage, colorName, searchWindow, frameContext
+        )
 
-    hsvImage = cv.cvtColor(inputImage, cv.COLOR_BGR2HSV)
+        if centerReady:
+            markerCenters[colorName] = (True, center)
+        else:
+            lostColorNames.append(colorName)
 
-    # filter green color
-    filteredGreen = filter_color(hsvImage, "green")
-    # filter red color
-    filteredBlue = filter_color(hsvImage, "blue")
-    # filter red color
-    filteredRed = filter_color(hsvImage, "red")
+        markerTracker.update(colorName, centerReady, center, isTracked=True)
+
+    if len(lostColorNames) > 0:
+
+        if pyramidLevels > 0:
+            markerCenters.update(
+                find_centers_in_pyramid(
+                    inputImage, lostColorNames, pyramidLevels, frameContext
+                )
+            )
+
+        else:
+            frameContext.start_stage()
+
+            hsvImage = frameContext.get_buffer("frame.hsv", inputImage.shape)
+            cv.cvtColor(inputImage, cv.COLOR_BGR2HSV, dst=hsvImage)
+            frameContext.end_stage("hsv")
+
+            # filter the remaining colors in one pass
+            masks = COLOR_CALIBRATION.get_segmenter().segment(
+                hsvImage, lostColorNames, frameContext=frameContext
+            )
+            frameContext.end_stage("mask")
+
+            for colorName in lostColorNames:
+                markerCenters[colorName] = find_center(masks[colorName])
+            frameContext.end_stage("contour")
+
+        if markerTracker is not None:
+            for colorName in lostColorNames:
+                centerReady, center = markerCenters[colorName]
+                markerTracker.update(colorName, centerReady, center, isTracked=False)
+
+    return markerCenters
+
+
+def is_detection_complete(markerCenters):
+    # All of the markers are found
+    return all(centerReady for centerReady, center in markerCenters.values())
+
+
+def find_join_positions(
+    inputImage, markerTracker=None, pyramidLevels=0, frameContext=None, drawOverlay=True
+):
+
+    if frameContext is None:
+        frameContext = FrameContext()
+
+    markerCenters = find_marker_centers(
+        inputImage, markerTracker, pyramidLevels, frameContext
+    )
+
+    success = is_detection_complete(markerCenters)
 
     # get green color coordinates
-    greenCenterReady, greenCenter = find_center(filteredGreen)
+    greenCenterReady, greenCenter = markerCenters["green"]
     # get blue color coordinates
-    blueCenterReady, blueCenter = find_center(filteredBlue)
+    blueCenterReady, blueCenter = markerCenters["blue"]
     # get red color coordinates
-    redCenterReady, redCenter = find_center(filteredRed)
+    redCenterReady, redCenter = markerCenters["red"]
 
-    # Create a blank image
-    processedImage = np.zeros(inputImage.shape, dtype=np.uint8)
+    processedImage = None
+
+    if drawOverlay:
+        # The previous image may still be displayed so two buffers are rotated
+        processedImage = render_overlay(
+            markerCenters,
+            frameContext.get_rotating_buffer("overlay", inputImage.shape),
+        )
+
+    return success, greenCenter, blueCenter, redCenter, processedImage
+
+
+def compute_joint_positions_cm(greenCenter, blueCenter, redCenter):
+    # Joint positions in centimeters from marker centers in pixels
+
+    scalingRatio = (
+        math.sqrt(
+            math.pow(blueCenter.x - greenCenter.x, 2)
+            + math.pow(blueCenter.y - greenCenter.y, 2)
+        )
+        / GREEN_BLUE_LINK_LENGTH_CM
+    )
+
+    # Convert units pixel position units into ground truth centimeters
+    # the Green point is considered as the origin of our coordinate system
+    blueCmX = (1 / scalingRatio) * (blueCenter.x - greenCenter.x)
+    blueCmY = -(1 / scalingRatio) * (blueCenter.y - greenCenter.y)
+    redCmX = (1 / scalingRatio) * (redCenter.x - greenCenter.x)
+    redCmY = -(1 / scalingRatio) * (redCenter.y - greenCenter.y)
+
+    return Point(0, 0), Point(blueCmX, blueCmY), Point(redCmX, redCmY)
+
+
+def render_overlay(markerCenters, outputImage, scale=1.0):
+    # Draw found markers and links between them on outputImage (cleared first)
+    # scale is the ratio of outputImage size to the processed image size, so the
+    # overlay can be drawn directly into a smaller display image
+
+    greenCenterReady, greenCenter = markerCenters["green"]
+    blueCenterReady, blueCenter = markerCenters["blue"]
+    redCenterReady, redCenter = markerCenters["red"]
+
+    markerRadius = int(MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO / 2 * scale)
+    lineThickness = max(1, int(5 * scale))
+
+    processedImage = outputImage
+    processedImage.fill(0)
 
     if greenCenterReady:
         # draw green circle
         processedImage = cv.circle(
             processedImage,
-            (greenCenter.x, greenCenter.y),
-            int(MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO / 2),
+            point_to_pixel(greenCenter, scale),
+            markerRadius,
             BGR_GREEN,
             -1,
         )
@@ -413,8 +1100,8 @@ def find_join_positions(inputImage):
         # draw blue circle
         processedImage = cv.circle(
             processedImage,
-            (blueCenter.x, blueCenter.y),
-            int(MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO / 2),
+            point_to_pixel(blueCenter, scale),
+            markerRadius,
             BGR_BLUE,
             -1,
         )
@@ -423,8 +1110,8 @@ def find_join_positions(inputImage):
         # draw red circle
         processedImage = cv.circle(
             processedImage,
-            (redCenter.x, redCenter.y),
-            int(MAX_DIAMETER_CM * PIXEL_TO_CM_RATIO / 2),
+            point_to_pixel(redCenter, scale),
+            markerRadius,
             BGR_RED,
             -1,
         )
@@ -433,26 +1120,28 @@ def find_join_positions(inputImage):
         # draw line between green and blue points
         processedImage = cv.line(
             processedImage,
-            (greenCenter.x, greenCenter.y),
-            (blueCenter.x, blueCenter.y),
+            point_to_pixel(greenCenter, scale),
+            point_to_pixel(blueCenter, scale),
             BGR_WHITE,
-            5,
+            lineThickness,
         )
 
     if blueCenterReady and redCenterReady:
         # draw line between blue and red points
         processedImage = cv.line(
             processedImage,
-            (blueCenter.x, blueCenter.y),
-            (redCenter.x, redCenter.y),
+            point_to_pixel(blueCenter, scale),
+            point_to_pixel(redCenter, scale),
             BGR_WHITE,
-            5,
+            lineThickness,
         )
 
-    if greenCenterReady and blueCenterReady and redCenterReady:
-        success = True
+    return processedImage
 
-    return success, greenCenter, blueCenter, redCenter, processedImage
+
+def point_to_pixel(point, scale=1.0):
+    # Nearest integer pixel of a (scaled) point for OpenCV drawing functions
+    return (int(round(point.x * scale)), int(round(point.y * scale)))
 
 
 def map_number(x, in_min, in_max, out_min, out_max):
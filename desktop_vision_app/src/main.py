@@ -7,6 +7,10 @@ import pathlib
 # GUI for this application
 from robot_vision_gui import RobotVisionGUI
 
+# Marker colors learned by hsv_calibration.py
+from image_processing import set_color_profile
+from color_calibration import load_color_profile
+
 SRC_PATH = pathlib.Path(__file__).parent.resolve()
 ICON_PATH = SRC_PATH.parent.resolve().joinpath("assets/icon.png")
 VDO_PATH = str(SRC_PATH.parent.resolve().joinpath("assets/sample_video.mp4"))
@@ -25,6 +29,11 @@ if __name__ == "__main__":
     desiredAspectRatio = 1.3
     serialPortBaud = 57600
     guiUpdateInterval = 40
+    # Name of a profile saved by hsv_calibration.py (None uses the built-in colors)
+    colorProfileName = None
+
+    if colorProfileName is not None:
+        set_color_profile(load_color_profile(colorProfileName))
 
     # Create master Tkinter window
     # Tk() must be created here globally to avoid some errors
@@ -0,0 +1,55 @@
+class MarkerTracker:
+    # Keeps the last known position of each marker and gives a small search
+    # window around it, so the next frame does not need a full-frame search
+    def __init__(self, markerDiameterPixels, motionMarginPixels=20, paddingPixels=6):
+        # Half of the window side: the marker itself, the distance it may move
+        # between two frames and some padding for the morphology kernel
+        self.windowRadius = int(
+            markerDiameterPixels / 2 + motionMarginPixels + paddingPixels
+        )
+        self.lastCenters = {}
+        self.trackedSearchCount = 0
+        self.fullSearchCount = 0
+        self.lostCount = 0
+
+    def reset(self):
+        self.lastCenters = {}
+
+    def get_search_window(self, colorName, imageShape):
+        # Return (x0, y0, x1, y1) of the window to search or None for full frame
+        center = self.lastCenters.get(colorName)
+        if center is None:
+            return None
+
+        imageHeight = imageShape[0]
+        imageWidth = imageShape[1]
+
+        x0 = max(0, int(center.x) - self.windowRadius)
+        y0 = max(0, int(center.y) - self.windowRadius)
+        x1 = min(imageWidth, int(center.x) + self.windowRadius + 1)
+        y1 = min(imageHeight, int(center.y) + self.windowRadius + 1)
+
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        return x0, y0, x1, y1
+
+    def update(self, colorName, success, center, isTracked):
+        # Store the result of a search, a lost marker falls back to full-frame search
+        if isTracked:
+            self.trackedSearchCount += 1
+        else:
+            self.fullSearchCount += 1
+
+        if success:
+            self.lastCenters[colorName] = center
+        elif colorName in self.lastCenters:
+            self.lostCount += 1
+            del self.lastCenters[colorName]
+
+    def get_stats(self):
+        return {
+            "trackedSearches": self.trackedSearchCount,
+            "fullSearches": self.fullSearchCount,
+            "lostMarkers": self.lostCount,
+        }
@@ -0,0 +1,288 @@
+# Worker processes
+import multiprocessing
+
+# Frames are shared with workers instead of being pickled
+from multiprocessing import shared_memory
+
+# Number of cores
+import os
+
+# Multi-threading
+import threading
+
+# Results waiting for their turn
+from collections import deque
+
+import numpy as np
+
+# Blob extraction backend of the workers
+from blob_extraction import get_blob_backend
+
+# Buffers of intermediate images reused by every frame of a worker
+from frame_context import FrameContext
+
+
+def detection_worker(taskQueue, resultQueue, pyramidLevels, colorProfile, blobBackend):
+    # Runs in a worker process: find markers in frames written to shared memory
+    # Imported here so the parent process does not import it twice when spawning
+    from image_processing import (
+        find_marker_centers,
+        set_blob_backend,
+        set_color_profile,
+    )
+
+    set_blob_backend(blobBackend)
+    if colorProfile is not None:
+        set_color_profile(colorProfile)
+
+    frameContext = FrameContext()
+    sharedMemories = {}
+
+    while True:
+        task = taskQueue.get()
+        if task is None:
+            break
+
+        slotIndex, sharedMemoryName, shape = task
+
+        if sharedMemoryName not in sharedMemories:
+            sharedMemories[sharedMemoryName] = shared_memory.SharedMemory(
+                sharedMemoryName
+            )
+        image = np.ndarray(shape, np.uint8, sharedMemories[sharedMemoryName].buf)
+
+        frameContext.reset_stage_times()
+        try:
+            # No tracking: consecutive frames of a source go to different workers
+            markerCenters = find_marker_centers(
+                image, None, pyramidLevels, frameContext
+            )
+            error = None
+        except Exception as exception:
+            markerCenters = None
+            error = repr(exception)
+        del image
+
+        resultQueue.put(
+            (slotIndex, markerCenters, dict(frameContext.stageTimes), error)
+        )
+
+    for sharedMemory in sharedMemories.values():
+        sharedMemory.close()
+
+
+class DetectionResult:
+    # Markers found in a frame by a worker. image is the frame in shared memory
+    # and stays valid until the result is given back with ParallelDetector.release()
+    def __init__(
+        self, slotIndex, frameId, image, timestamp, markerCenters, stageTimes, error
+    ):
+        self.slotIndex = slotIndex
+        self.frameId = frameId
+        self.image = image
+        self.timestamp = timestamp
+        self.markerCenters = markerCenters
+        self.stageTimes = stageTimes
+        self.error = error
+
+
+class ParallelDetector:
+    # A pool of worker processes finding markers in frames of one or more
+    # sources. Frames are copied once into shared memory slots, results of each
+    # source are returned in the order its frames were submitted
+    def __init__(
+        self,
+        workerCount=None,
+        slotCount=None,
+        pyramidLevels=0,
+        colorProfile=None,
+        blobBackend=None,
+    ):
+        if workerCount is None:
+            workerCount = max(1, (os.cpu_count() or 2) - 1)
+        self.workerCount = workerCount
+        # Frames being processed plus frames whose results are still in use
+        self.slotCount = slotCount if slotCount is not None else 3 * workerCount
+        self.pyramidLevels = pyramidLevels
+        # Calibration profile of the workers (None keeps the hard-coded colors)
+        self.colorProfile = colorProfile
+        # Blob backend of the workers (None takes the one selected in this
+        # process when the workers are started)
+        self.blobBackend = blobBackend
+        self.isRunning = False
+
+        self.condition = threading.Condition()
+        self.slots = [None] * self.slotCount
+        self.freeSlotIndexes = deque(range(self.slotCount))
+        self.slotTimestamps = [0.0] * self.slotCount
+        self.slotShapes = [None] * self.slotCount
+        self.slotFrameIds = [None] * self.slotCount
+        # A slot is busy from submit() to release(), so it identifies its frame
+        # Slots of each source in submission order and results by slot
+        self.pendingSlotIndexes = {}
+        self.completedResults = {}
+        # Slots of discarded sources still being processed by a worker
+        self.discardedSlotIndexes = set()
+
+    def start(self):
+        # Workers are spawned (not forked) since the parent runs other threads
+        context = multiprocessing.get_context("spawn")
+        self.taskQueue = context.Queue()
+        self.resultQueue = context.Queue()
+        self.workers = [
+            context.Process(
+                target=detection_worker,
+                args=(
+                    self.taskQueue,
+                    self.resultQueue,
+                    self.pyramidLevels,
+                    self.colorProfile,
+                    self.blobBackend
+                    if self.blobBackend is not None
+                    else get_blob_backend(),
+                ),
+                daemon=True,
+            )
+            for index in range(self.workerCount)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        self.isRunning = True
+        self.collectorThread = threading.Thread(
+            target=self.collector_thread_handler, daemon=True
+        )
+        self.collectorThread.start()
+
+    def stop(self):
+        if not self.isRunning:
+            return
+        self.isRunning = False
+        for worker in self.workers:
+            self.taskQueue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.resultQueue.put(None)
+        self.collectorThread.join()
+
+        with self.condition:
+            for index, sharedMemory in enumerate(self.slots):
+                if sharedMemory is not None:
+                    self.close_slot(sharedMemory)
+                    self.slots[index] = None
+            self.freeSlotIndexes = deque(range(self.slotCount))
+            self.pendingSlotIndexes = {}
+            self.completedResults = {}
+            self.discardedSlotIndexes = set()
+            self.condition.notify_all()
+
+    def close_slot(self, sharedMemory):
+        sharedMemory.unlink()
+        try:
+            sharedMemory.close()
+        except BufferError:
+            # An image of a result is still referenced somewhere, the memory is
+            # freed when the last reference is gone
+            pass
+
+    def get_slot(self, index, byteCount):
+        # Shared memory of a slot, reallocated when a frame does not fit
+        sharedMemory = self.slots[index]
+        if sharedMemory is None or sharedMemory.size < byteCount:
+            if sharedMemory is not None:
+                self.close_slot(sharedMemory)
+            sharedMemory = shared_memory.SharedMemory(create=True, size=byteCount)
+            self.slots[index] = sharedMemory
+        return sharedMemory
+
+    def submit(self, sourceId, frameId, frame, timestamp):
+        # Queue a BGR frame, returns False (frame dropped) if all slots are busy
+        with self.condition:
+            if not self.isRunning or len(self.freeSlotIndexes) == 0:
+                return False
+            slotIndex = self.freeSlotIndexes.popleft()
+
+        sharedMemory = self.get_slot(slotIndex, frame.nbytes)
+        np.ndarray(frame.shape, np.uint8, sharedMemory.buf)[:] = frame
+
+        with self.condition:
+            self.slotTimestamps[slotIndex] = timestamp
+            self.slotShapes[slotIndex] = frame.shape
+            self.slotFrameIds[slotIndex] = frameId
+            self.pendingSlotIndexes.setdefault(sourceId, deque()).append(slotIndex)
+        self.taskQueue.put((slotIndex, sharedMemory.name, frame.shape))
+        return True
+
+    def collector_thread_handler(self):
+        while True:
+            message = self.resultQueue.get()
+            if message is None:
+                break
+            slotIndex, markerCenters, stageTimes, error = message
+            with self.condition:
+                if slotIndex in self.discardedSlotIndexes:
+                    self.discardedSlotIndexes.remove(slotIndex)
+                    self.freeSlotIndexes.append(slotIndex)
+                    continue
+                self.completedResults[slotIndex] = (markerCenters, stageTimes, error)
+                self.condition.notify_all()
+
+    def is_next_result_ready(self, sourceId):
+        pendingSlotIndexes = self.pendingSlotIndexes.get(sourceId)
+        return (
+            pendingSlotIndexes is not None
+            and len(pendingSlotIndexes) > 0
+            and pendingSlotIndexes[0] in self.completedResults
+        )
+
+    def get_result(self, sourceId, timeout=None):
+        # Wait (up to 'timeout' seconds) for the result of the oldest submitted
+        # frame of a source, returns a DetectionResult or None
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.is_next_result_ready(sourceId), timeout
+            ):
+                return None
+            slotIndex = self.pendingSlotIndexes[sourceId].popleft()
+            markerCenters, stageTimes, error = self.completedResults.pop(slotIndex)
+            frameId = self.slotFrameIds[slotIndex]
+            image = np.ndarray(
+                self.slotShapes[slotIndex], np.uint8, self.slots[slotIndex].buf
+            )
+            timestamp = self.slotTimestamps[slotIndex]
+
+        return DetectionResult(
+            slotIndex,
+            frameId,
+            image,
+            timestamp,
+            markerCenters,
+            stageTimes,
+            error,
+        )
+
+    def release(self, result):
+        # The slot of a result can take a new frame
+        with self.condition:
+            self.freeSlotIndexes.append(result.slotIndex)
+
+    def discard_source(self, sourceId):
+        # Forget all frames of a source that were not taken with get_result(),
+        # e.g. when its pipeline is stopped while other sources keep running
+        with self.condition:
+            for slotIndex in self.pendingSlotIndexes.pop(sourceId, ()):
+                if slotIndex in self.completedResults:
+                    del self.completedResults[slotIndex]
+                    self.freeSlotIndexes.append(slotIndex)
+                else:
+                    self.discardedSlotIndexes.add(slotIndex)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "workers": self.workerCount,
+                "freeSlots": len(self.freeSlotIndexes),
+                "pendingFrames": sum(
+                    len(slotIndexes) for slotIndexes in self.pendingSlotIndexes.values()
+                ),
+            }
@@ -0,0 +1,270 @@
+# Local HTTP endpoint for metrics
+import http.server
+
+# Output format of the HTTP endpoint
+import json
+
+# Multi-threading
+import threading
+
+# Rolling windows of samples
+from collections import deque
+
+import numpy as np
+
+# Stages of the pipeline, in the order a frame goes through them
+# "capture" is the age of a frame when its processing starts
+# "serial_write" is the write of a motor command to the port by the writer thread
+# "display" is the preparation of GUI images, only measured when a GUI shows them
+PIPELINE_STAGES = (
+    "capture",
+    "crop",
+    "hsv",
+    "mask",
+    "contour",
+    "control",
+    "serial_write",
+    "display",
+    "total",
+)
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    # Rolling window of the latest latency samples of a stage
+    def __init__(self, windowSize=500):
+        self.samples = deque(maxlen=windowSize)
+        self.sampleCount = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.sampleCount += 1
+
+    def get_stats(self):
+        stats = {"count": self.sampleCount}
+        if len(self.samples) == 0:
+            for percentile in PERCENTILES:
+                stats["p{}".format(percentile)] = None
+            return stats
+
+        values = np.percentile(np.array(self.samples) * 1000, PERCENTILES)
+        for percentile, value in zip(PERCENTILES, values):
+            stats["p{}".format(percentile)] = float(value)
+        return stats
+
+
+class PipelineMetrics:
+    # Latency histograms of each stage plus frame, drop and detection counters
+    # Written by the processing thread, read by any thread
+    def __init__(self, windowSize=500):
+        self.lock = threading.Lock()
+        self.histograms = {
+            stageName: LatencyHistogram(windowSize) for stageName in PIPELINE_STAGES
+        }
+        self.processedFrameCount = 0
+        self.droppedFrameCount = 0
+        self.detectedFrameCount = 0
+        self.recentDetections = deque(maxlen=windowSize)
+
+    def add_stage_time(self, stageName, seconds):
+        with self.lock:
+            self.histograms[stageName].add(seconds)
+
+    def add_stage_times(self, stageTimes):
+        with self.lock:
+            for stageName, seconds in stageTimes.items():
+                self.histograms[stageName].add(seconds)
+
+    def count_dropped_frames(self, droppedFrames):
+        with self.lock:
+            self.droppedFrameCount += droppedFrames
+
+    def count_frame(self, success, droppedFrames=0):
+        with self.lock:
+            self.processedFrameCount += 1
+            self.droppedFrameCount += droppedFrames
+            if success:
+                self.detectedFrameCount += 1
+            self.recentDetections.append(success)
+
+    def get_snapshot(self):
+        # All metrics as a dict, latencies in milliseconds
+        with self.lock:
+            recentSuccessRate = None
+            if len(self.recentDetections) > 0:
+                recentSuccessRate = sum(self.recentDetections) / len(
+                    self.recentDetections
+                )
+            return {
+                "processedFrames": self.processedFrameCount,
+                "droppedFrames": self.droppedFrameCount,
+                "detectedFrames": self.detectedFrameCount,
+                "detectionSuccessRate": recentSuccessRate,
+                "stagesMs": {
+                    stageName: histogram.get_stats()
+                    for stageName, histogram in self.histograms.items()
+                },
+            }
+
+    def format_log_line(self):
+        snapshot = self.get_snapshot()
+        stageTexts = []
+        for stageName, stats in snapshot["stagesMs"].items():
+            if stats["p50"] is not None:
+                stageTexts.append(
+                    "{} {:.2f}/{:.2f}/{:.2f}".format(
+                        stageName, stats["p50"], stats["p95"], stats["p99"]
+                    )
+                )
+        successRate = snapshot["detectionSuccessRate"]
+        return (
+            "[ METRICS ] frames: {} | dropped: {} | detection: {} | "
+            "p50/p95/p99 ms: {}".format(
+                snapshot["processedFrames"],
+                snapshot["droppedFrames"],
+                "N/A" if successRate is None else "{:.0%}".format(successRate),
+                ", ".join(stageTexts),
+            )
+        )
+
+    def format_prometheus(self, labels=None):
+        # Metrics in Prometheus text exposition format
+        snapshot = self.get_snapshot()
+        labelText = ""
+        if labels:
+            labelText = ",".join(
+                '{}="{}"'.format(name, value) for name, value in labels.items()
+            )
+
+        def metric_line(name, value, extraLabels=""):
+            allLabels = ",".join(text for text in (labelText, extraLabels) if text)
+            if allLabels:
+                return "{}{{{}}} {}".format(name, allLabels, value)
+            return "{} {}".format(name, value)
+
+        lines = [
+            "# TYPE vision_processed_frames_total counter",
+            metric_line("vision_processed_frames_total", snapshot["processedFrames"]),
+            "# TYPE vision_dropped_frames_total counter",
+            metric_line("vision_dropped_frames_total", snapshot["droppedFrames"]),
+            "# TYPE vision_detected_frames_total counter",
+            metric_line("vision_detected_frames_total", snapshot["detectedFrames"]),
+        ]
+
+        if snapshot["detectionSuccessRate"] is not None:
+            lines.append("# TYPE vision_detection_success_ratio gauge")
+            lines.append(
+                metric_line(
+                    "vision_detection_success_ratio", snapshot["detectionSuccessRate"]
+                )
+            )
+
+        lines.append("# TYPE vision_stage_latency_ms summary")
+        for stageName, stats in snapshot["stagesMs"].items():
+            for percentile in PERCENTILES:
+                value = stats["p{}".format(percentile)]
+                if value is not None:
+                    lines.append(
+                        metric_line(
+                            "vision_stage_latency_ms",
+                            value,
+                            'stage="{}",quantile="{}"'.format(
+                                stageName, percentile / 100
+                            ),
+                        )
+                    )
+            lines.append(
+                metric_line(
+                    "vision_stage_latency_ms_count",
+                    stats["count"],
+                    'stage="{}"'.format(stageName),
+                )
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+def format_prometheus_pipelines(pipelineMetricsByName):
+    # Metrics of several pipelines labeled with pipeline="name". Samples of
+    # each metric are grouped under a single TYPE line as Prometheus requires
+    typeLines = {}
+    sampleLines = {}
+    for pipelineName, pipelineMetrics in pipelineMetricsByName.items():
+        metricName = None
+        for line in pipelineMetrics.format_prometheus(
+            {"pipeline": pipelineName}
+        ).splitlines():
+            if line.startswith("# TYPE "):
+                metricName = line.split()[2]
+                typeLines[metricName] = line
+            else:
+                sampleLines.setdefault(metricName, []).append(line)
+
+    lines = []
+    for metricName, typeLine in typeLines.items():
+        lines.append(typeLine)
+        lines.extend(sampleLines.get(metricName, ()))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHttpServer:
+    # Serves PipelineMetrics on http://host:port/metrics (Prometheus text)
+    # and /metrics.json in a separate thread. pipelineMetrics can also be a
+    # dict of PipelineMetrics by pipeline name
+    def __init__(self, pipelineMetrics, port=9100, host="127.0.0.1"):
+        self.pipelineMetrics = pipelineMetrics
+        self.port = port
+        self.host = host
+        self.httpServer = None
+
+    def start(self):
+        pipelineMetrics = self.pipelineMetrics
+
+        def format_text():
+            if isinstance(pipelineMetrics, dict):
+                return format_prometheus_pipelines(pipelineMetrics)
+            return pipelineMetrics.format_prometheus()
+
+        def get_snapshot():
+            if isinstance(pipelineMetrics, dict):
+                return {
+                    pipelineName: metrics.get_snapshot()
+                    for pipelineName, metrics in pipelineMetrics.items()
+                }
+            return pipelineMetrics.get_snapshot()
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = format_text().encode()
+                    contentType = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(get_snapshot()).encode()
+                    contentType = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Do not print every request
+                pass
+
+        self.httpServer = http.server.ThreadingHTTPServer(
+            (self.host, self.port), MetricsRequestHandler
+        )
+        self.serverThread = threading.Thread(
+            target=self.httpServer.serve_forever, daemon=True
+        )
+        self.serverThread.start()
+
+    def stop(self):
+        if self.httpServer is not None:
+            self.httpServer.shutdown()
+            self.httpServer.server_close()
+            self.httpServer = None
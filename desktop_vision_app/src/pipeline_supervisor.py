@@ -0,0 +1,283 @@
+# Runs several camera-to-robot pipelines in one process from a single config
+
+# Command line options
+import argparse
+
+# Configuration files
+import json
+
+# Multi-threading
+import threading
+
+# for monotonic timestamps
+import time
+
+# Options and configuration of a single pipeline
+from headless import DEFAULT_OPTIONS, create_manager
+
+# Marker detection processes shared by all pipelines
+from parallel_detection import ParallelDetector
+
+# One metrics endpoint for all pipelines
+from pipeline_metrics import MetricsHttpServer
+
+PIPELINE_STATE_STOPPED = "stopped"
+PIPELINE_STATE_RUNNING = "running"
+# Running, but no frame was processed for 'stall_timeout' seconds
+PIPELINE_STATE_STALLED = "stalled"
+# Stopped by an error, restarted after a delay
+PIPELINE_STATE_FAILED = "failed"
+
+# "defaults" are headless options of every pipeline, each entry of "pipelines"
+# has a unique "name" and overrides any of them, e.g.
+# {"workers": 2, "pipelines": [{"name": "left", "source": "0",
+#  "serial_port": "/dev/ttyUSB0"}, {"name": "right", "source": "1",
+#  "serial_port": "/dev/ttyUSB1"}]}
+DEFAULT_SUPERVISOR_OPTIONS = {
+    # Detection processes shared by all pipelines (0 detects in their threads)
+    "workers": 0,
+    "check_interval": 1.0,
+    "stall_timeout": 5.0,
+    "restart_delay": 1.0,
+    "max_restart_delay": 30.0,
+    "status_interval": 5.0,
+    "metrics_port": None,
+    "defaults": {},
+    "pipelines": [],
+}
+
+
+class Pipeline:
+    # An ImageProcessingManager of the supervisor and its health
+    def __init__(self, name, options, imageProcessingManager):
+        self.name = name
+        self.options = options
+        self.imageProcessingManager = imageProcessingManager
+        self.state = PIPELINE_STATE_STOPPED
+        self.startTime = None
+        self.restartCount = 0
+        self.restartDelay = None
+        self.nextRestartTime = None
+        self.lastError = None
+
+
+class PipelineSupervisor:
+    # Starts the pipelines, checks their health and restarts a failed one
+    # without touching the others. Marker detection runs in one pool of worker
+    # processes shared by all pipelines, each pipeline has its own capture,
+    # processing and serial threads and its own metrics
+    def __init__(self, config):
+        self.options = dict(DEFAULT_SUPERVISOR_OPTIONS)
+        self.options.update(config)
+        self.isRunning = False
+        self.stopEvent = threading.Event()
+        self.metricsHttpServer = None
+
+        self.parallelDetector = None
+        if self.options["workers"] > 0:
+            self.parallelDetector = ParallelDetector(self.options["workers"])
+
+        self.pipelines = []
+        for pipelineConfig in self.options["pipelines"]:
+            self.add_pipeline(pipelineConfig)
+
+    def add_pipeline(self, pipelineConfig):
+        name = pipelineConfig["name"]
+        if self.get_pipeline(name) is not None:
+            raise ValueError("duplicate pipeline name: {}".format(name))
+
+        options = dict(DEFAULT_OPTIONS)
+        options.update(self.options["defaults"])
+        options.update(pipelineConfig)
+        # Marker colors are shared by all pipelines of the process, and the
+        # pyramid levels by all pipelines of the shared detector
+        for pipeline in self.pipelines:
+            if pipeline.options["color_profile"] != options["color_profile"]:
+                raise ValueError("all pipelines must use the same color profile")
+            if (
+                self.parallelDetector is not None
+                and pipeline.options["pyramid_levels"] != options["pyramid_levels"]
+            ):
+                raise ValueError(
+                    "all pipelines must use the same pyramid levels with workers"
+                )
+        # Workers and the metrics server belong to the supervisor
+        options["workers"] = 0
+        imageProcessingManager = create_manager(options)
+        if self.parallelDetector is not None:
+            imageProcessingManager.set_parallel_detector(self.parallelDetector, name)
+
+        pipeline = Pipeline(name, options, imageProcessingManager)
+        pipeline.restartDelay = self.options["restart_delay"]
+        self.pipelines.append(pipeline)
+        return pipeline
+
+    def get_pipeline(self, name):
+        for pipeline in self.pipelines:
+            if pipeline.name == name:
+                return pipeline
+        return None
+
+    def start(self):
+        if self.parallelDetector is not None:
+            self.parallelDetector.start()
+        for pipeline in self.pipelines:
+            self.start_pipeline(pipeline)
+
+        if self.options["metrics_port"] is not None:
+            self.metricsHttpServer = MetricsHttpServer(
+                {
+                    pipeline.name: pipeline.imageProcessingManager.pipelineMetrics
+                    for pipeline in self.pipelines
+                },
+                self.options["metrics_port"],
+            )
+            self.metricsHttpServer.start()
+
+        self.isRunning = True
+        self.stopEvent.clear()
+        self.monitorThread = threading.Thread(target=self.monitor_thread_handler)
+        self.monitorThread.start()
+
+    def stop(self):
+        if self.isRunning:
+            self.isRunning = False
+            self.stopEvent.set()
+            self.monitorThread.join()
+        for pipeline in self.pipelines:
+            self.stop_pipeline(pipeline)
+            pipeline.state = PIPELINE_STATE_STOPPED
+        if self.metricsHttpServer is not None:
+            self.metricsHttpServer.stop()
+            self.metricsHttpServer = None
+        if self.parallelDetector is not None:
+            self.parallelDetector.stop()
+
+    def start_pipeline(self, pipeline):
+        try:
+            pipeline.imageProcessingManager.start()
+        except Exception as exception:
+            self.fail_pipeline(pipeline, repr(exception))
+            return
+        pipeline.state = PIPELINE_STATE_RUNNING
+        pipeline.startTime = time.monotonic()
+
+    def stop_pipeline(self, pipeline):
+        try:
+            pipeline.imageProcessingManager.stop()
+        except Exception as exception:
+            print(
+                "[SUPERVISOR] Pipeline {} did not stop cleanly: {!r}".format(
+                    pipeline.name, exception
+                )
+            )
+
+    def fail_pipeline(self, pipeline, error):
+        # Stop the pipeline and restart it later, with a growing delay if it
+        # keeps failing
+        print("[SUPERVISOR] Pipeline {} failed: {}".format(pipeline.name, error))
+        self.stop_pipeline(pipeline)
+        pipeline.state = PIPELINE_STATE_FAILED
+        pipeline.lastError = error
+        pipeline.nextRestartTime = time.monotonic() + pipeline.restartDelay
+        pipeline.restartDelay = min(
+            2 * pipeline.restartDelay, self.options["max_restart_delay"]
+        )
+
+    def check_pipeline(self, pipeline, now):
+        if pipeline.state == PIPELINE_STATE_FAILED:
+            if now >= pipeline.nextRestartTime:
+                print("[SUPERVISOR] Restarting pipeline {}".format(pipeline.name))
+                pipeline.restartCount += 1
+                self.start_pipeline(pipeline)
+            return
+
+        imageProcessingManager = pipeline.imageProcessingManager
+        if not imageProcessingManager.is_alive():
+            self.fail_pipeline(pipeline, "processing thread ended")
+            return
+
+        # A stalled source is reopened by its capture thread, it is only reported
+        latestResult = imageProcessingManager.get_latest_result()
+        lastFrameTime = pipeline.startTime
+        if latestResult is not None:
+            lastFrameTime = max(lastFrameTime, latestResult.processedTime)
+        if now - lastFrameTime > self.options["stall_timeout"]:
+            pipeline.state = PIPELINE_STATE_STALLED
+        else:
+            pipeline.state = PIPELINE_STATE_RUNNING
+            # Failures long ago do not delay the next restart
+            if now - pipeline.startTime > self.options["max_restart_delay"]:
+                pipeline.restartDelay = self.options["restart_delay"]
+
+    def monitor_thread_handler(self):
+        while not self.stopEvent.wait(self.options["check_interval"]):
+            now = time.monotonic()
+            for pipeline in self.pipelines:
+                self.check_pipeline(pipeline, now)
+
+    def get_status(self):
+        status = {}
+        for pipeline in self.pipelines:
+            imageProcessingManager = pipeline.imageProcessingManager
+            metrics = imageProcessingManager.get_metrics()
+            status[pipeline.name] = {
+                "state": pipeline.state,
+                "restarts": pipeline.restartCount,
+                "lastError": pipeline.lastError,
+                "frame": imageProcessingManager.frameId,
+                "processedFrames": metrics["processedFrames"],
+                "droppedFrames": metrics["droppedFrames"],
+                "detectionSuccessRate": metrics["detectionSuccessRate"],
+                "link": imageProcessingManager.serialPortManager.get_link_stats(),
+                "control": imageProcessingManager.get_control_stats(),
+            }
+        if self.parallelDetector is not None:
+            status["detector"] = self.parallelDetector.get_stats()
+        return status
+
+
+def load_config(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Run several robot vision pipelines without GUI"
+    )
+    parser.add_argument("config", help="JSON file with the pipelines")
+    parser.add_argument(
+        "--workers", type=int, help="detection processes shared by all pipelines"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="serve Prometheus metrics on this port"
+    )
+    args = parser.parse_args(arguments)
+
+    with open(args.config) as configFile:
+        config = json.load(configFile)
+    if args.workers is not None:
+        config["workers"] = args.workers
+    if args.metrics_port is not None:
+        config["metrics_port"] = args.metrics_port
+    return config
+
+
+def print_status(pipelineSupervisor):
+    for name, status in pipelineSupervisor.get_status().items():
+        print("[SUPERVISOR] {}: {}".format(name, status))
+
+
+def run(config):
+    pipelineSupervisor = PipelineSupervisor(config)
+    pipelineSupervisor.start()
+
+    try:
+        while True:
+            time.sleep(pipelineSupervisor.options["status_interval"])
+            print_status(pipelineSupervisor)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipelineSupervisor.stop()
+        print_status(pipelineSupervisor)
+
+
+if __name__ == "__main__":
+    run(load_config())
@@ -1,3 +1,10 @@
+# Random speeds of the test algorithm
+import random
+
+# Generator of the test algorithm, seeded once instead of on every call
+randomGenerator = random.Random()
+
+
 def robot_control_algorithm(greenPositionCm, bluePositionCm, redPositionCm):
 
     ##########################################
@@ -5,21 +12,63 @@ def robot_control_algorithm(greenPositionCm, bluePositionCm, redPositionCm):
     ##########################################
 
     print(
-        "[  VISION ] Position of joints: ({}, {}), ({}, {}), ({}, {})".format(
-            int(greenPositionCm.x),
-            int(greenPositionCm.y),
-            int(bluePositionCm.x),
-            int(bluePositionCm.y),
-            int(redPositionCm.x),
-            int(redPositionCm.y),
+        "[  VISION ] Position of joints: "
+        "({:.1f}, {:.1f}), ({:.1f}, {:.1f}), ({:.1f}, {:.1f})".format(
+            greenPositionCm.x,
+            greenPositionCm.y,
+            bluePositionCm.x,
+            bluePositionCm.y,
+            redPositionCm.x,
+            redPositionCm.y,
         )
     )
     # Just for test
-    import random
-    import time
-
-    random.seed(time.time())
-    motorSpeedA = random.uniform(-1, 1)
-    motorSpeedB = random.uniform(-1, 1)
+    motorSpeedA = randomGenerator.uniform(-1, 1)
+    motorSpeedB = randomGenerator.uniform(-1, 1)
 
     return motorSpeedA, motorSpeedB
+
+
+class RobotController:
+    # Interface of control algorithms run by ControlLoop (control_loop.py)
+    # A controller gets the latest JointState (state_estimation.py: link angles,
+    # angular velocities and joint positions in centimeters) and the time since
+    # its previous call, and returns normalized motor speeds (-1.0 ~ 1.0)
+    def reset(self):
+        # Called when control (re)starts, e.g. after a safe stop
+        pass
+
+    def compute(self, jointState, dt):
+        raise NotImplementedError
+
+
+class AlgorithmController(RobotController):
+    # Runs robot_control_algorithm() on the (predicted) joint positions
+    def compute(self, jointState, dt):
+        greenPositionCm, bluePositionCm, redPositionCm = jointState.jointPositionsCm
+        return robot_control_algorithm(greenPositionCm, bluePositionCm, redPositionCm)
+
+
+class StopController(RobotController):
+    # Keeps the motors stopped, e.g. for testing vision alone
+    def compute(self, jointState, dt):
+        return 0.0, 0.0
+
+
+# Controllers selectable by name, new ones are added with register_controller()
+CONTROLLER_CLASSES = {
+    "algorithm": AlgorithmController,
+    "stop": StopController,
+}
+
+DEFAULT_CONTROLLER_NAME = "algorithm"
+
+
+def register_controller(name, controllerClass):
+    CONTROLLER_CLASSES[name] = controllerClass
+
+
+def create_controller(name=DEFAULT_CONTROLLER_NAME):
+    if name not in CONTROLLER_CLASSES:
+        raise ValueError("unknown controller: {}".format(name))
+    return CONTROLLER_CLASSES[name]()
@@ -49,6 +49,12 @@ class RobotVisionGUI:
         self.tkImageWidth = int(self.tkImageHeight * self.videoAspectRatio)
         self.originalTkImage = None
         self.processedTkImage = None
+        # Frame id of the images and labels shown in GUI
+        self.displayedFrameId = 0
+        # The processing thread prepares RGB images in the size of image boxes
+        self.imageProcessingManager.set_display_size(
+            self.tkImageWidth, self.tkImageHeight
+        )
 
         # Joint positions in centimeters
         self.greenJointPositionCm = Point(0, 0)
@@ -287,6 +293,7 @@ class RobotVisionGUI:
             self.imageProcessingManager.set_source(self.videoSource)
             self.imageProcessingManager.set_interval(self.imageProcessingInterval)
             self.imageProcessingManager.start()
+            self.displayedFrameId = 0
             # Start updating image boxes in GUI
             # time.sleep(0.5)
             self.update_gui_loop()
@@ -355,45 +362,46 @@ class RobotVisionGUI:
         # Set default value of selectedPort
         self.selectedPort.set(portNames[0])
 
-    def convert_cv_image_to_tk_image(self, frame, isColored):
-        # In order to convert to PIL Image type should be first converted to RGB
-        if isColored:
-            frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
+    def update_tk_image(self, tkImage, imageBox, rgbImage):
+        # Copy an RGB image of display size into the ImageTk type shown in an
+        # image box. The PhotoImage is created for the first frame only and
+        # reused for the next ones
+        image = Image.fromarray(rgbImage)
+        if tkImage is None:
+            tkImage = ImageTk.PhotoImage(image=image)
+            imageBox.configure(image=tkImage)
         else:
-            frame = cv.cvtColor(frame, cv.COLOR_GRAY2RGB)
-        # Resize to fit the image box in GUI
-        frame = cv.resize(frame, (self.tkImageWidth, self.tkImageHeight))
-        # Return th ImageTk type suitable for Tkinter GUI
-        return ImageTk.PhotoImage(image=Image.fromarray(frame))
+            tkImage.paste(image)
+        return tkImage
 
     def update_gui_loop(self):
         # Update images in a kind of recursive function using Tkinter after() method
-        # Get PIL ImageTk types from ImageProcessingManager for displaying in GUI
-        (
-            success,
-            originalImage,
-            processedImage,
-        ) = self.imageProcessingManager.get_images()
-
-        if success:
+        # Images and joint positions are taken from the same frame result
+        frameResult = self.imageProcessingManager.get_latest_result()
+
+        # Nothing to redraw if no new frame has been processed since the last update
+        if (
+            frameResult is not None
+            and frameResult.frameId != self.displayedFrameId
+            and frameResult.displayImages is not None
+        ):
+            self.displayedFrameId = frameResult.frameId
+            originalRgbImage, processedRgbImage = frameResult.displayImages
 
             try:
-                # Convert CV image to PIL ImageTk in order to display in Tkinter GUI
-                self.originalTkImage = self.convert_cv_image_to_tk_image(
-                    originalImage, True
+                # Copy RGB images prepared by the processing thread into image boxes
+                self.originalTkImage = self.update_tk_image(
+                    self.originalTkImage, self.originalImageBox, originalRgbImage
                 )
-                self.processedTkImage = self.convert_cv_image_to_tk_image(
-                    processedImage, True
+                self.processedTkImage = self.update_tk_image(
+                    self.processedTkImage, self.processedImageBox, processedRgbImage
                 )
-                # Update Labels used for displaying images
-                self.originalImageBox.configure(image=self.originalTkImage)
-                self.processedImageBox.configure(image=self.processedTkImage)
 
                 (
                     self.greenJointPositionCm,
                     self.blueJointPositionCm,
                     self.redJointPositionCm,
-                ) = self.imageProcessingManager.get_joint_positions()
+                ) = frameResult.jointPositionsCm
 
                 greenString = "".join(
                     [
@@ -4,6 +4,40 @@ import serial
 # Multi-threading
 import threading
 
+# Received lines for other threads
+import queue
+
+# for pacing the writes to the link speed
+import time
+
+# Framed binary protocol of the Arduino link
+from serial_protocol import *
+
+# Round-trip latency histogram of the link
+from pipeline_metrics import LatencyHistogram
+
+# A byte on the wire is 1 start bit, 8 data bits and 1 stop bit
+BITS_PER_BYTE = 10
+
+# Reads return after this many seconds when no data arrives
+READ_TIMEOUT = 0.1
+
+# Delay before reopening the port doubles after each failure up to the maximum
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 8.0
+
+# Received bytes without a line ending are flushed as a line after this length
+MAX_LINE_LENGTH = 1024
+
+# Port name of the in-process loopback port (see LoopbackSerialPort)
+LOOPBACK_PORT_NAME = "loopback"
+
+# Commands without acknowledgement after this many seconds are counted as lost
+ACK_TIMEOUT = 1.0
+
+# stop() waits this long for each thread, longer than a read or write timeout
+THREAD_JOIN_TIMEOUT = 2.0
+
 
 class SerialPortManager:
     # A class for management of serial port data in a separate thread
@@ -12,6 +46,43 @@ class SerialPortManager:
         self.serialPortName = None
         self.serialPortBaud = serialPortBaud
         self.serialPort = serial.Serial()
+        self.protocol = SERIAL_PROTOCOL_FRAMED
+
+        # Single-slot mailbox of the writer thread: new motor speeds replace
+        # the pending ones, so the Arduino never receives stale commands
+        self.writeCondition = threading.Condition()
+        self.pendingSpeeds = None
+        self.nextWriteTime = 0.0
+        self.writeCount = 0
+        self.overwriteCount = 0
+        self.droppedPacketCount = 0
+        self.writeErrorCount = 0
+        self.writtenByteCount = 0
+
+        # Lines received from the Arduino (legacy protocol) go to the callback
+        # if one is set, otherwise to a bounded queue which keeps the newest lines
+        self.lineCallback = None
+        # Called with the duration in seconds of each packet written to the port
+        self.writeTimeCallback = None
+        self.receivedLines = queue.Queue(maxsize=100)
+        self.receiveBuffer = bytearray()
+        self.readByteCount = 0
+        self.receivedLineCount = 0
+        self.openFailureCount = 0
+        self.stopEvent = threading.Event()
+        self.serialPortThread = None
+        self.writerThread = None
+
+        # Sequence numbers of sent commands and their acknowledgements
+        self.linkLock = threading.Lock()
+        self.frameDecoder = FrameDecoder()
+        self.commandSequence = 0
+        self.sentTimes = {}
+        self.sentCommandCount = 0
+        self.acknowledgedCommandCount = 0
+        self.lostCommandCount = 0
+        self.roundTripHistogram = LatencyHistogram()
+        self.latestStatus = None
 
     def set_name(self, serialPortName):
         self.serialPortName = serialPortName
@@ -19,52 +90,272 @@ class SerialPortManager:
     def set_baud(self, serialPortBaud):
         self.serialPortBaud = serialPortBaud
 
+    def set_protocol(self, protocol):
+        if protocol not in SERIAL_PROTOCOLS:
+            raise ValueError("unknown serial protocol: {}".format(protocol))
+        self.protocol = protocol
+
+    def set_line_callback(self, lineCallback):
+        # lineCallback(line) is called in the serial thread for each received line
+        self.lineCallback = lineCallback
+
+    def set_write_time_callback(self, writeTimeCallback):
+        # writeTimeCallback(seconds) is called in the writer thread after each
+        # write, the time the port took and not the handoff to the mailbox
+        self.writeTimeCallback = writeTimeCallback
+
+    def get_received_lines(self):
+        # Remove and return the lines received since the previous call
+        lines = []
+        while True:
+            try:
+                lines.append(self.receivedLines.get_nowait())
+            except queue.Empty:
+                return lines
+
+    def get_read_stats(self):
+        return {
+            "bytes": self.readByteCount,
+            "lines": self.receivedLineCount,
+            "openFailures": self.openFailureCount,
+        }
+
     def start(self):
         self.isRunning = True
+        self.stopEvent.clear()
+        self.pendingSpeeds = None
+        self.nextWriteTime = 0.0
         self.serialPortThread = threading.Thread(target=self.serial_thread_handler)
         self.serialPortThread.start()
+        self.writerThread = threading.Thread(
+            target=self.writer_thread_handler, daemon=True
+        )
+        self.writerThread.start()
 
     def stop(self):
         self.isRunning = False
+        self.stopEvent.set()
+        with self.writeCondition:
+            self.writeCondition.notify()
+        # A restart must not have two pairs of threads using the same port
+        for thread in (self.writerThread, self.serialPortThread):
+            if thread is not None:
+                thread.join(THREAD_JOIN_TIMEOUT)
+                if thread.is_alive():
+                    print("[ SERIAL ] {} did not stop".format(thread.name))
+        self.writerThread = None
+        self.serialPortThread = None
         if self.serialPort.isOpen():
             self.serialPort.close()
 
+    def send_motor_speeds(self, speedA, speedB):
+        # Returns immediately, the command is written by the writer thread
+        if not self.isRunning:
+            return
+        with self.writeCondition:
+            if self.pendingSpeeds is not None:
+                self.overwriteCount += 1
+            self.pendingSpeeds = (speedA, speedB)
+            self.writeCondition.notify()
+
+    def encode_motor_speeds(self, speedA, speedB):
+        if self.protocol == SERIAL_PROTOCOL_LEGACY:
+            return encode_legacy_motor_command(speedA, speedB)
+        packet = encode_motor_command(self.commandSequence, speedA, speedB)
+        self.commandSequence = (self.commandSequence + 1) & 0xFF
+        return packet
+
+    def get_link_stats(self):
+        # Acknowledgements of the framed protocol, round-trip times in ms
+        with self.linkLock:
+            self.expire_sent_commands(time.monotonic())
+            return {
+                "sent": self.sentCommandCount,
+                "acknowledged": self.acknowledgedCommandCount,
+                "lost": self.lostCommandCount,
+                "decodeErrors": self.frameDecoder.errorCount,
+                "roundTripMs": self.roundTripHistogram.get_stats(),
+                "status": self.latestStatus,
+            }
+
+    def expire_sent_commands(self, now):
+        # Called with linkLock held
+        for sequence, sentTime in list(self.sentTimes.items()):
+            if now - sentTime > ACK_TIMEOUT:
+                del self.sentTimes[sequence]
+                self.lostCommandCount += 1
+
+    def get_write_stats(self):
+        with self.writeCondition:
+            return {
+                "writes": self.writeCount,
+                "overwrites": self.overwriteCount,
+                "droppedPackets": self.droppedPacketCount,
+                "errors": self.writeErrorCount,
+                "bytes": self.writtenByteCount,
+            }
+
+    def writer_thread_handler(self):
+
+        # After stop() the last pending command (e.g. the final stop of the
+        # motors) is still written once before the thread ends
+        while True:
+
+            with self.writeCondition:
+                while self.isRunning and self.pendingSpeeds is None:
+                    self.writeCondition.wait()
+
+                # Do not write faster than the link can carry, a packet
+                # arriving while waiting replaces the pending one
+                while self.isRunning and time.monotonic() < self.nextWriteTime:
+                    self.writeCondition.wait(self.nextWriteTime - time.monotonic())
+
+                speeds = self.pendingSpeeds
+                self.pendingSpeeds = None
+
+            if speeds is None:
+                if not self.isRunning:
+                    break
+                continue
+
+            if not self.serialPort.isOpen():
+                with self.writeCondition:
+                    self.droppedPacketCount += 1
+                continue
+
+            packet = self.encode_motor_speeds(*speeds)
+            sentTime = time.monotonic()
+            try:
+                self.serialPort.write(packet)
+            except (serial.SerialException, OSError) as error:
+                with self.writeCondition:
+                    self.writeErrorCount += 1
+                print("[ SERIAL ] write failed: {}".format(error))
+                continue
+
+            writeSeconds = time.monotonic() - sentTime
+            with self.writeCondition:
+                self.writeCount += 1
+                self.writtenByteCount += len(packet)
+            if self.writeTimeCallback is not None:
+                self.writeTimeCallback(writeSeconds)
+            if self.protocol == SERIAL_PROTOCOL_FRAMED:
+                with self.linkLock:
+                    # A sequence number still waiting for its acknowledgement
+                    # after 256 commands belongs to a lost command
+                    sequence = (self.commandSequence - 1) & 0xFF
+                    if sequence in self.sentTimes:
+                        self.lostCommandCount += 1
+                    self.sentTimes[sequence] = sentTime
+                    self.sentCommandCount += 1
+            self.nextWriteTime = (
+                time.monotonic() + len(packet) * BITS_PER_BYTE / self.serialPortBaud
+            )
+
+    def open_port(self):
+        if self.serialPortName == LOOPBACK_PORT_NAME:
+            self.serialPort = LoopbackSerialPort(READ_TIMEOUT)
+            return
+        self.serialPort = serial.Serial(
+            port=self.serialPortName,
+            baudrate=self.serialPortBaud,
+            bytesize=8,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            timeout=READ_TIMEOUT,
+            write_timeout=1.0,
+        )
+
     def serial_thread_handler(self):
 
+        reconnectDelay = RECONNECT_DELAY
+        self.receiveBuffer = bytearray()
+
         while self.isRunning:
 
             if not self.serialPort.isOpen():
+                try:
+                    self.open_port()
+                except (serial.SerialException, OSError) as error:
+                    print(
+                        "[ SERIAL ] cannot open {}: {} (retry in {} s)".format(
+                            self.serialPortName, error, reconnectDelay
+                        )
+                    )
+                    self.openFailureCount += 1
+                    self.stopEvent.wait(reconnectDelay)
+                    reconnectDelay = min(2 * reconnectDelay, MAX_RECONNECT_DELAY)
+                    continue
+                reconnectDelay = RECONNECT_DELAY
+                self.receiveBuffer = bytearray()
+                self.frameDecoder.buffer.clear()
+
+            try:
+                # Block until at least one byte arrives or the read times out,
+                # then take everything already waiting in one read
+                data = self.serialPort.read(max(1, self.serialPort.in_waiting))
+            except (serial.SerialException, OSError, TypeError) as error:
+                # TypeError is raised by pyserial when the port is closed
+                # by another thread during a read
+                if self.isRunning:
+                    print("[ SERIAL ] read failed: {}".format(error))
+                    self.serialPort.close()
+                continue
 
-                # Open the serial port
-                self.serialPort = serial.Serial(
-                    port=self.serialPortName,
-                    baudrate=self.serialPortBaud,
-                    bytesize=8,
-                    parity=serial.PARITY_NONE,
-                    stopbits=serial.STOPBITS_ONE,
-                )
+            if data:
+                self.readByteCount += len(data)
+                self.on_bytes_received(data)
+
+    def on_bytes_received(self, data):
+        if self.protocol == SERIAL_PROTOCOL_FRAMED:
+            for frameType, sequence, payload in self.frameDecoder.feed(data):
+                if frameType == FRAME_TYPE_STATUS:
+                    try:
+                        self.on_status_received(decode_status(payload))
+                    except ProtocolError:
+                        self.frameDecoder.errorCount += 1
+            return
+
+        # Split received bytes into lines, keeping an incomplete line for later
+        self.receiveBuffer += data
+        while True:
+            lineEnd = self.receiveBuffer.find(b"\n")
+            if lineEnd >= 0:
+                line = bytes(self.receiveBuffer[:lineEnd])
+                del self.receiveBuffer[: lineEnd + 1]
+            elif len(self.receiveBuffer) >= MAX_LINE_LENGTH:
+                line = bytes(self.receiveBuffer[:MAX_LINE_LENGTH])
+                del self.receiveBuffer[:MAX_LINE_LENGTH]
             else:
+                break
+            self.on_line_received(line.rstrip(b"\r").decode("ascii", "replace"))
+
+    def on_status_received(self, status):
+        now = time.monotonic()
+        with self.linkLock:
+            self.latestStatus = status
+            sentTime = self.sentTimes.pop(status["acknowledgedSequence"], None)
+            if sentTime is not None:
+                self.acknowledgedCommandCount += 1
+                self.roundTripHistogram.add(now - sentTime)
+            self.expire_sent_commands(now)
+
+    def on_line_received(self, line):
+        self.receivedLineCount += 1
+        if self.lineCallback is not None:
+            self.lineCallback(line)
+            return
+        # Drop the oldest line when nobody reads the queue
+        while True:
+            try:
+                self.receivedLines.put_nowait(line)
+                return
+            except queue.Full:
                 try:
-                    # Wait until there is data waiting in the serial buffer
-                    while self.serialPort.in_waiting > 0:
-                        # Read only one byte from serial port
-                        serialPortByte = self.serialPort.read(1)
-                        # Process incoming bytes
-                        self.on_byte_received(serialPortByte)
-                except:
-                    # ignore errors!
+                    self.receivedLines.get_nowait()
+                except queue.Empty:
                     pass
 
     def __del__(self):
         if self.serialPort.isOpen():
             self.serialPort.close()
-
-    def on_byte_received(self, inputByte):
-        # Print the received byte in Python terminal
-        try:
-            character = inputByte.decode("ascii")
-        except UnicodeDecodeError:
-            pass
-        else:
-            print(character, end="")
-        pass
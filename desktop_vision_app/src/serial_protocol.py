@@ -0,0 +1,292 @@
+# Framed binary protocol between the desktop app and the Arduino board
+#
+# Every frame is COBS encoded and terminated by a 0x00 byte, so the receiver
+# can always find the next frame boundary. Before encoding a frame is:
+#
+#   version (1) | type (1) | sequence (1) | payload (n) | CRC-16 (2)
+#
+# Multi-byte fields are little endian. The CRC is CRC-16/CCITT-FALSE of the
+# preceding bytes.
+#
+# Motor command payload (desktop -> Arduino):
+#   speedA (int16) | speedB (int16), full scale is +-MOTOR_SPEED_SCALE
+#
+# Status payload (Arduino -> desktop), sent after each valid motor command:
+#   acknowledged sequence (1) | pwmA (int16) | pwmB (int16) | receive errors (uint16)
+
+# Packing of frame fields
+import struct
+
+# Multi-threading
+import threading
+
+# for the read timeout of the loopback port
+import time
+
+PROTOCOL_VERSION = 1
+
+FRAME_TYPE_MOTOR_COMMAND = 0x01
+FRAME_TYPE_STATUS = 0x02
+
+FRAME_DELIMITER = 0x00
+
+MOTOR_SPEED_SCALE = 32767
+
+# Frames longer than this are treated as corrupted
+MAX_FRAME_LENGTH = 64
+
+# Protocols of the serial link, "legacy" is the 3-byte packet of older firmware
+SERIAL_PROTOCOL_FRAMED = "framed"
+SERIAL_PROTOCOL_LEGACY = "legacy"
+SERIAL_PROTOCOLS = (SERIAL_PROTOCOL_FRAMED, SERIAL_PROTOCOL_LEGACY)
+
+HEADER_FORMAT = "<BBB"
+HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+CRC_LENGTH = 2
+MOTOR_COMMAND_FORMAT = "<hh"
+STATUS_FORMAT = "<BhhH"
+
+
+class ProtocolError(ValueError):
+    # A frame which cannot be decoded (bad framing, CRC, version or length)
+    pass
+
+
+def build_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = build_crc16_table()
+
+
+def crc16_ccitt(data, crc=0xFFFF):
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def cobs_encode(data):
+    # Consistent Overhead Byte Stuffing: the output contains no zero bytes
+    encoded = bytearray([0])
+    codeIndex = 0
+    code = 1
+    for byte in data:
+        if byte == 0:
+            encoded[codeIndex] = code
+            codeIndex = len(encoded)
+            encoded.append(0)
+            code = 1
+        else:
+            encoded.append(byte)
+            code += 1
+            if code == 0xFF:
+                encoded[codeIndex] = code
+                codeIndex = len(encoded)
+                encoded.append(0)
+                code = 1
+    encoded[codeIndex] = code
+    return bytes(encoded)
+
+
+def cobs_decode(encoded):
+    decoded = bytearray()
+    index = 0
+    while index < len(encoded):
+        code = encoded[index]
+        if code == 0 or index + code > len(encoded):
+            raise ProtocolError("invalid COBS data")
+        decoded += encoded[index + 1 : index + code]
+        index += code
+        if code < 0xFF and index < len(encoded):
+            decoded.append(0)
+    return bytes(decoded)
+
+
+def encode_frame(frameType, sequence, payload):
+    # Complete frame on the wire, including the delimiter
+    frame = struct.pack(HEADER_FORMAT, PROTOCOL_VERSION, frameType, sequence & 0xFF)
+    frame += payload
+    frame += struct.pack("<H", crc16_ccitt(frame))
+    return cobs_encode(frame) + bytes([FRAME_DELIMITER])
+
+
+def decode_frame(encoded):
+    # encoded is a frame without its delimiter, returns (type, sequence, payload)
+    frame = cobs_decode(encoded)
+    if len(frame) < HEADER_LENGTH + CRC_LENGTH:
+        raise ProtocolError("frame too short")
+
+    (crc,) = struct.unpack("<H", frame[-CRC_LENGTH:])
+    if crc != crc16_ccitt(frame[:-CRC_LENGTH]):
+        raise ProtocolError("CRC mismatch")
+
+    version, frameType, sequence = struct.unpack(HEADER_FORMAT, frame[:HEADER_LENGTH])
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("unsupported protocol version {}".format(version))
+
+    return frameType, sequence, frame[HEADER_LENGTH:-CRC_LENGTH]
+
+
+def scale_speed(speed):
+    # Normalized speed (-1.0 ~ 1.0) to a 16-bit value
+    speed = min(1.0, max(-1.0, speed))
+    return int(round(speed * MOTOR_SPEED_SCALE))
+
+
+def encode_motor_command(sequence, speedA, speedB):
+    payload = struct.pack(
+        MOTOR_COMMAND_FORMAT, scale_speed(speedA), scale_speed(speedB)
+    )
+    return encode_frame(FRAME_TYPE_MOTOR_COMMAND, sequence, payload)
+
+
+def decode_motor_command(payload):
+    # Returns normalized (speedA, speedB)
+    if len(payload) != struct.calcsize(MOTOR_COMMAND_FORMAT):
+        raise ProtocolError("invalid motor command length")
+    speedA, speedB = struct.unpack(MOTOR_COMMAND_FORMAT, payload)
+    return speedA / MOTOR_SPEED_SCALE, speedB / MOTOR_SPEED_SCALE
+
+
+def encode_status(sequence, acknowledgedSequence, pwmA, pwmB, receiveErrorCount):
+    payload = struct.pack(
+        STATUS_FORMAT,
+        acknowledgedSequence & 0xFF,
+        pwmA,
+        pwmB,
+        receiveErrorCount & 0xFFFF,
+    )
+    return encode_frame(FRAME_TYPE_STATUS, sequence, payload)
+
+
+def decode_status(payload):
+    if len(payload) != struct.calcsize(STATUS_FORMAT):
+        raise ProtocolError("invalid status length")
+    acknowledgedSequence, pwmA, pwmB, receiveErrorCount = struct.unpack(
+        STATUS_FORMAT, payload
+    )
+    return {
+        "acknowledgedSequence": acknowledgedSequence,
+        "pwmA": pwmA,
+        "pwmB": pwmB,
+        "receiveErrors": receiveErrorCount,
+    }
+
+
+def encode_legacy_motor_command(speedA, speedB):
+    # 3-byte packet of older firmware: 0xFF is reserved for start of packet
+    # so the speed bytes value range is (0, 254)
+    speedA = min(1.0, max(-1.0, speedA))
+    speedB = min(1.0, max(-1.0, speedB))
+    return bytes(
+        [
+            0xFF,
+            (int(speedA * 255) + 255) * 254 // 510,
+            (int(speedB * 255) + 255) * 254 // 510,
+        ]
+    )
+
+
+class FrameDecoder:
+    # Splits a byte stream at delimiters and decodes the frames
+    # Corrupted frames are counted and skipped, the stream resynchronizes at
+    # the next delimiter
+    def __init__(self):
+        self.buffer = bytearray()
+        self.errorCount = 0
+
+    def feed(self, data):
+        # Returns the list of (type, sequence, payload) completed by data
+        frames = []
+        self.buffer += data
+        while True:
+            delimiterIndex = self.buffer.find(FRAME_DELIMITER)
+            if delimiterIndex < 0:
+                if len(self.buffer) > MAX_FRAME_LENGTH:
+                    self.buffer.clear()
+                    self.errorCount += 1
+                break
+            encoded = bytes(self.buffer[:delimiterIndex])
+            del self.buffer[: delimiterIndex + 1]
+            if len(encoded) == 0:
+                continue
+            try:
+                frames.append(decode_frame(encoded))
+            except ProtocolError:
+                self.errorCount += 1
+        return frames
+
+
+class LoopbackSerialPort:
+    # In-process stand-in for the serial port and the Arduino firmware
+    # Motor command frames written to it are answered with status frames, as
+    # the firmware does. Every 'dropInterval'-th command is ignored to test
+    # packet loss handling (0 keeps all of them)
+    def __init__(self, timeout=0.1, dropInterval=0):
+        self.timeout = timeout
+        self.dropInterval = dropInterval
+        self.condition = threading.Condition()
+        self.readBuffer = bytearray()
+        self.frameDecoder = FrameDecoder()
+        self.isPortOpen = True
+        self.commandCount = 0
+        self.statusSequence = 0
+        self.pwmA = 0
+        self.pwmB = 0
+
+    def isOpen(self):
+        return self.isPortOpen
+
+    def close(self):
+        with self.condition:
+            self.isPortOpen = False
+            self.condition.notify_all()
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            return len(self.readBuffer)
+
+    def write(self, data):
+        for frameType, sequence, payload in self.frameDecoder.feed(data):
+            if frameType != FRAME_TYPE_MOTOR_COMMAND:
+                continue
+            self.commandCount += 1
+            if self.dropInterval > 0 and self.commandCount % self.dropInterval == 0:
+                continue
+            speedA, speedB = decode_motor_command(payload)
+            self.pwmA = int(speedA * 255)
+            self.pwmB = int(speedB * 255)
+            status = encode_status(
+                self.statusSequence,
+                sequence,
+                self.pwmA,
+                self.pwmB,
+                self.frameDecoder.errorCount,
+            )
+            self.statusSequence = (self.statusSequence + 1) & 0xFF
+            with self.condition:
+                self.readBuffer += status
+                self.condition.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while self.isPortOpen and len(self.readBuffer) == 0:
+                remainingTime = deadline - time.monotonic()
+                if remainingTime <= 0:
+                    break
+                self.condition.wait(remainingTime)
+            data = bytes(self.readBuffer[:size])
+            del self.readBuffer[:size]
+            return data
@@ -0,0 +1,382 @@
+# Records sessions (frames, detections, motor commands) into an indexed file
+# and replays them through ImageProcessingManager without camera or robot
+
+# Image processing
+import cv2 as cv
+
+# Command line options
+import argparse
+
+# Records waiting for the writer thread
+import queue
+
+# Binary records
+import struct
+
+# Multi-threading
+import threading
+
+# for monotonic timestamps
+import time
+
+import numpy as np
+
+# Marker names and the Point class of detections
+from image_processing import MARKER_COLOR_NAMES, Point
+
+# File layout:
+#   SESSION_MAGIC
+#   records: RECORD_HEADER (type, frame id, timestamp, payload length) + payload
+#   index: INDEX_DTYPE array of all records
+#   SESSION_FOOTER (offset of the index, SESSION_MAGIC)
+# A file without footer (e.g. after a crash) is indexed by scanning its records
+SESSION_MAGIC = b"RVSESS1\n"
+RECORD_HEADER = struct.Struct("<BIdI")
+SESSION_FOOTER = struct.Struct("<Q8s")
+
+RECORD_TYPE_FRAME = 1
+RECORD_TYPE_DETECTION = 2
+RECORD_TYPE_COMMAND = 3
+
+# Found flag, x and y in pixels of each marker in MARKER_COLOR_NAMES order
+DETECTION_PAYLOAD = struct.Struct("<" + "Bdd" * len(MARKER_COLOR_NAMES))
+# Normalized motor speeds A and B
+COMMAND_PAYLOAD = struct.Struct("<dd")
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("type", np.uint8),
+        ("frameId", np.uint32),
+        ("timestamp", np.float64),
+        ("offset", np.uint64),
+        ("length", np.uint32),
+    ]
+)
+
+# ".png" keeps frames exactly as they were captured, so replayed detections
+# match the recorded ones. ".jpg" is about 4 times smaller, but its artifacts
+# move marker colors across the HSV bounds and change many detections
+FRAME_FORMATS = (".png", ".jpg")
+
+# Records waiting for the writer, more are dropped instead of slowing the pipeline
+RECORD_QUEUE_SIZE = 64
+
+# Replayed centers further apart than this count as a different detection
+DETECTION_TOLERANCE_PIXELS = 0.5
+
+
+def encode_detection(markerCenters):
+    values = []
+    for colorName in MARKER_COLOR_NAMES:
+        centerReady, center = markerCenters[colorName]
+        values.extend((centerReady, center.x, center.y))
+    return DETECTION_PAYLOAD.pack(*values)
+
+
+def decode_detection(payload):
+    values = DETECTION_PAYLOAD.unpack(payload)
+    return {
+        colorName: (
+            bool(values[3 * index]),
+            Point(*values[3 * index + 1 : 3 * index + 3]),
+        )
+        for index, colorName in enumerate(MARKER_COLOR_NAMES)
+    }
+
+
+class SessionRecorder:
+    # Writes records from any thread into a session file. Frames are copied
+    # and compressed by the writer thread, so recording costs the pipeline one
+    # copy per frame
+    def __init__(self, path, frameFormat=".png", jpegQuality=90):
+        if frameFormat not in FRAME_FORMATS:
+            raise ValueError("unknown frame format: {}".format(frameFormat))
+        self.path = path
+        self.frameFormat = frameFormat
+        self.encodeParameters = []
+        if frameFormat == ".jpg":
+            self.encodeParameters = [cv.IMWRITE_JPEG_QUALITY, jpegQuality]
+        self.isRecording = False
+        self.recordQueue = queue.Queue(RECORD_QUEUE_SIZE)
+        self.droppedRecordCount = 0
+        self.writtenRecordCount = 0
+        self.writtenByteCount = 0
+
+    def start(self):
+        self.sessionFile = open(self.path, "wb")
+        self.sessionFile.write(SESSION_MAGIC)
+        self.indexEntries = []
+        self.isRecording = True
+        self.writerThread = threading.Thread(
+            target=self.writer_thread_handler, daemon=True
+        )
+        self.writerThread.start()
+
+    def stop(self):
+        # Write the remaining records and the index
+        if not self.isRecording:
+            return
+        self.isRecording = False
+        self.recordQueue.put(None)
+        self.writerThread.join()
+
+        indexOffset = self.sessionFile.tell()
+        self.sessionFile.write(np.array(self.indexEntries, INDEX_DTYPE).tobytes())
+        self.sessionFile.write(SESSION_FOOTER.pack(indexOffset, SESSION_MAGIC))
+        self.sessionFile.close()
+
+    def put_record(self, record):
+        if not self.isRecording:
+            return
+        try:
+            self.recordQueue.put_nowait(record)
+        except queue.Full:
+            self.droppedRecordCount += 1
+
+    def record_frame(self, frameId, timestamp, image, markerCenters):
+        # image is the (cropped) frame given to marker detection
+        self.put_record((RECORD_TYPE_FRAME, frameId, timestamp, image.copy()))
+        self.put_record(
+            (RECORD_TYPE_DETECTION, frameId, timestamp, encode_detection(markerCenters))
+        )
+
+    def record_command(self, frameId, timestamp, speedA, speedB):
+        # frameId is the newest frame when the command is sent
+        self.put_record(
+            (
+                RECORD_TYPE_COMMAND,
+                frameId,
+                timestamp,
+                COMMAND_PAYLOAD.pack(speedA, speedB),
+            )
+        )
+
+    def writer_thread_handler(self):
+        while True:
+            record = self.recordQueue.get()
+            if record is None:
+                break
+            recordType, frameId, timestamp, payload = record
+            if recordType == RECORD_TYPE_FRAME:
+                success, encodedImage = cv.imencode(
+                    self.frameFormat, payload, self.encodeParameters
+                )
+                if not success:
+                    self.droppedRecordCount += 1
+                    continue
+                payload = encodedImage.tobytes()
+
+            offset = self.sessionFile.tell()
+            self.sessionFile.write(
+                RECORD_HEADER.pack(recordType, frameId, timestamp, len(payload))
+            )
+            self.sessionFile.write(payload)
+            self.indexEntries.append(
+                (recordType, frameId, timestamp, offset, len(payload))
+            )
+            self.writtenRecordCount += 1
+            self.writtenByteCount += RECORD_HEADER.size + len(payload)
+
+    def get_stats(self):
+        return {
+            "records": self.writtenRecordCount,
+            "droppedRecords": self.droppedRecordCount,
+            "bytes": self.writtenByteCount,
+        }
+
+
+class SessionReader:
+    # Random access to the records of a session file through its index
+    def __init__(self, path):
+        self.sessionFile = open(path, "rb")
+        if self.sessionFile.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            raise ValueError("not a session file: {}".format(path))
+        self.index = self.read_index()
+
+    def read_index(self):
+        self.sessionFile.seek(0, 2)
+        fileSize = self.sessionFile.tell()
+        if fileSize >= len(SESSION_MAGIC) + SESSION_FOOTER.size:
+            self.sessionFile.seek(fileSize - SESSION_FOOTER.size)
+            indexOffset, magic = SESSION_FOOTER.unpack(
+                self.sessionFile.read(SESSION_FOOTER.size)
+            )
+            if magic == SESSION_MAGIC:
+                self.sessionFile.seek(indexOffset)
+                return np.frombuffer(
+                    self.sessionFile.read(fileSize - SESSION_FOOTER.size - indexOffset),
+                    INDEX_DTYPE,
+                )
+        return self.scan_records(fileSize)
+
+    def scan_records(self, fileSize):
+        # Index of a session which was not stopped, a torn last record is ignored
+        indexEntries = []
+        offset = len(SESSION_MAGIC)
+        while offset + RECORD_HEADER.size <= fileSize:
+            self.sessionFile.seek(offset)
+            recordType, frameId, timestamp, length = RECORD_HEADER.unpack(
+                self.sessionFile.read(RECORD_HEADER.size)
+            )
+            if offset + RECORD_HEADER.size + length > fileSize:
+                break
+            indexEntries.append((recordType, frameId, timestamp, offset, length))
+            offset += RECORD_HEADER.size + length
+        return np.array(indexEntries, INDEX_DTYPE)
+
+    def close(self):
+        self.sessionFile.close()
+
+    def get_entries(self, recordType):
+        return self.index[self.index["type"] == recordType]
+
+    def read_payload(self, entry):
+        self.sessionFile.seek(int(entry["offset"]) + RECORD_HEADER.size)
+        return self.sessionFile.read(int(entry["length"]))
+
+    def read_frame(self, entry):
+        # BGR image of a frame record
+        return cv.imdecode(
+            np.frombuffer(self.read_payload(entry), np.uint8), cv.IMREAD_COLOR
+        )
+
+    def read_detections(self):
+        # Recorded marker centers by frame id
+        return {
+            int(entry["frameId"]): decode_detection(self.read_payload(entry))
+            for entry in self.get_entries(RECORD_TYPE_DETECTION)
+        }
+
+    def read_commands(self):
+        # Array of (frameId, timestamp, speedA, speedB) rows
+        entries = self.get_entries(RECORD_TYPE_COMMAND)
+        commands = np.empty((len(entries), 4))
+        for row, entry in enumerate(entries):
+            commands[row, :2] = entry["frameId"], entry["timestamp"]
+            commands[row, 2:] = COMMAND_PAYLOAD.unpack(self.read_payload(entry))
+        return commands
+
+
+def is_same_detection(markerCenters, recordedMarkerCenters):
+    for colorName in MARKER_COLOR_NAMES:
+        centerReady, center = markerCenters[colorName]
+        recordedReady, recordedCenter = recordedMarkerCenters[colorName]
+        if centerReady != recordedReady:
+            return False
+        if centerReady and (
+            abs(center.x - recordedCenter.x) > DETECTION_TOLERANCE_PIXELS
+            or abs(center.y - recordedCenter.y) > DETECTION_TOLERANCE_PIXELS
+        ):
+            return False
+    return True
+
+
+class SessionReplayer:
+    # Feeds the recorded frames through an ImageProcessingManager in the
+    # calling thread: every frame is processed once and in order, either at
+    # the recorded pace (realTime) or as fast as possible. Commands go to the
+    # manager's serial port, which should be "loopback" or not set
+    def __init__(self, sessionReader, imageProcessingManager, realTime=True):
+        self.sessionReader = sessionReader
+        self.imageProcessingManager = imageProcessingManager
+        self.realTime = realTime
+
+    def run(self):
+        # Returns the replay statistics
+        imageProcessingManager = self.imageProcessingManager
+        recordedDetections = self.sessionReader.read_detections()
+        frameEntries = self.sessionReader.get_entries(RECORD_TYPE_FRAME)
+
+        mismatchCount = 0
+        decodeSeconds = 0.0
+        imageProcessingManager.start_outputs()
+        startTime = time.monotonic()
+        try:
+            for entry in frameEntries:
+                frameId = int(entry["frameId"])
+                decodeStartTime = time.monotonic()
+                image = self.sessionReader.read_frame(entry)
+                decodeSeconds += time.monotonic() - decodeStartTime
+
+                # Recorded timestamps are moved to the current clock, so stale
+                # checks of the control loop behave as they did when recording
+                frameTimestamp = time.monotonic()
+                if self.realTime:
+                    frameTimestamp = startTime + (
+                        entry["timestamp"] - frameEntries[0]["timestamp"]
+                    )
+                    waitSeconds = frameTimestamp - time.monotonic()
+                    if waitSeconds > 0:
+                        time.sleep(waitSeconds)
+
+                imageProcessingManager.process_frame(frameId, frameTimestamp, image)
+
+                recordedMarkerCenters = recordedDetections.get(frameId)
+                if recordedMarkerCenters is not None and not is_same_detection(
+                    imageProcessingManager.markerCenters, recordedMarkerCenters
+                ):
+                    mismatchCount += 1
+        finally:
+            imageProcessingManager.stop_outputs()
+
+        elapsedSeconds = time.monotonic() - startTime
+        return {
+            "frames": len(frameEntries),
+            "seconds": elapsedSeconds,
+            "fps": len(frameEntries) / elapsedSeconds if elapsedSeconds > 0 else 0.0,
+            "decodeMs": 1000 * decodeSeconds / max(1, len(frameEntries)),
+            "detectionMismatches": mismatchCount,
+        }
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded session through the vision pipeline"
+    )
+    parser.add_argument("session", help="session file written with --record")
+    parser.add_argument(
+        "--fast", action="store_true", help="do not wait for the recorded times"
+    )
+    parser.add_argument("--controller", default="stop", help="control algorithm")
+    parser.add_argument(
+        "--color-profile", help="marker colors saved by hsv_calibration.py"
+    )
+    parser.add_argument("--pyramid-levels", type=int, default=0)
+    parser.add_argument(
+        "--no-tracking",
+        dest="tracking",
+        action="store_false",
+        help="always search markers in the full frame",
+    )
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    # Imported here, headless imports this module for --record
+    from headless import DEFAULT_OPTIONS, create_manager
+
+    args = parse_arguments(arguments)
+    options = dict(DEFAULT_OPTIONS)
+    options.update(
+        {
+            "serial_port": "loopback",
+            "controller": args.controller,
+            "pyramid_levels": args.pyramid_levels,
+            "tracking": args.tracking,
+            "color_profile": args.color_profile,
+        }
+    )
+    imageProcessingManager = create_manager(options)
+
+    sessionReader = SessionReader(args.session)
+    replayStats = SessionReplayer(
+        sessionReader, imageProcessingManager, not args.fast
+    ).run()
+    sessionReader.close()
+
+    print("[ REPLAY ] {}".format(replayStats))
+    print(imageProcessingManager.pipelineMetrics.format_log_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Trigonometry of link angles
+import math
+
+# Immutable records
+from collections import namedtuple
+
+
+class Point:
+    # Coordinates are floats, pixel positions have subpixel precision
+    def __init__(self, x=0.0, y=0.0):
+        self.x = x
+        self.y = y
+
+
+# Link angles are measured from the +x axis in radians (counter-clockwise),
+# the second one relative to the first link. Joint positions are in centimeters
+# with the green joint as origin, as computed by ImageProcessingManager
+JointState = namedtuple(
+    "JointState",
+    ("timestamp", "angles", "angularVelocities", "jointPositionsCm"),
+)
+
+
+def wrap_angle(angle):
+    # Angle in range (-pi, pi]
+    return math.pi - (math.pi - angle) % (2 * math.pi)
+
+
+def compute_link_angles(jointPositionsCm):
+    greenPositionCm, bluePositionCm, redPositionCm = jointPositionsCm
+    firstAngle = math.atan2(
+        bluePositionCm.y - greenPositionCm.y, bluePositionCm.x - greenPositionCm.x
+    )
+    secondAngle = math.atan2(
+        redPositionCm.y - bluePositionCm.y, redPositionCm.x - bluePositionCm.x
+    )
+    return firstAngle, wrap_angle(secondAngle - firstAngle)
+
+
+def compute_joint_positions(greenPositionCm, angles, linkLengthsCm):
+    # Forward kinematics of the two links
+    firstAngle, secondAngle = angles
+    firstLength, secondLength = linkLengthsCm
+    bluePositionCm = Point(
+        greenPositionCm.x + firstLength * math.cos(firstAngle),
+        greenPositionCm.y + firstLength * math.sin(firstAngle),
+    )
+    redPositionCm = Point(
+        bluePositionCm.x + secondLength * math.cos(firstAngle + secondAngle),
+        bluePositionCm.y + secondLength * math.sin(firstAngle + secondAngle),
+    )
+    return greenPositionCm, bluePositionCm, redPositionCm
+
+
+class AlphaBetaFilter:
+    # Constant velocity filter of an angle: alpha corrects the angle and beta
+    # the angular velocity with the residual of each measurement
+    def __init__(self, alpha=0.5, beta=0.1):
+        self.alpha = alpha
+        self.beta = beta
+        self.reset()
+
+    def reset(self):
+        self.angle = None
+        self.velocity = 0.0
+        self.timestamp = None
+
+    def update(self, angle, timestamp):
+        if self.angle is None:
+            self.angle = angle
+            self.timestamp = timestamp
+            return
+
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            return
+
+        predictedAngle = self.angle + self.velocity * dt
+        residual = wrap_angle(angle - predictedAngle)
+        self.angle = wrap_angle(predictedAngle + self.alpha * residual)
+        self.velocity += self.beta * residual / dt
+        self.timestamp = timestamp
+
+    def predict(self, timestamp):
+        return wrap_angle(self.angle + self.velocity * (timestamp - self.timestamp))
+
+
+class JointStateEstimator:
+    # Turns measured joint positions into link angles and angular velocities
+    # and predicts them forward in time, so the controller can act on where the
+    # links are when its command is sent instead of where they were when the
+    # frame was captured
+    def __init__(self, firstLinkLengthCm, alpha=0.5, beta=0.1):
+        self.firstLinkLengthCm = firstLinkLengthCm
+        self.angleFilters = (AlphaBetaFilter(alpha, beta), AlphaBetaFilter(alpha, beta))
+        self.reset()
+
+    def reset(self):
+        for angleFilter in self.angleFilters:
+            angleFilter.reset()
+        self.secondLinkLengthCm = None
+        self.greenPositionCm = None
+
+    def set_gains(self, alpha, beta):
+        for angleFilter in self.angleFilters:
+            angleFilter.alpha = alpha
+            angleFilter.beta = beta
+
+    def is_ready(self):
+        return self.greenPositionCm is not None
+
+    def update(self, jointPositionsCm, timestamp):
+        greenPositionCm, bluePositionCm, redPositionCm = jointPositionsCm
+        for angleFilter, angle in zip(
+            self.angleFilters, compute_link_angles(jointPositionsCm)
+        ):
+            angleFilter.update(angle, timestamp)
+
+        # The second link length is not known in advance, it is averaged
+        secondLinkLengthCm = math.hypot(
+            redPositionCm.x - bluePositionCm.x, redPositionCm.y - bluePositionCm.y
+        )
+        if self.secondLinkLengthCm is None:
+            self.secondLinkLengthCm = secondLinkLengthCm
+        else:
+            self.secondLinkLengthCm += 0.1 * (
+                secondLinkLengthCm - self.secondLinkLengthCm
+            )
+        self.greenPositionCm = greenPositionCm
+
+    def predict(self, timestamp):
+        # JointState at timestamp (time.monotonic() seconds)
+        angles = tuple(
+            angleFilter.predict(timestamp) for angleFilter in self.angleFilters
+        )
+        return JointState(
+            timestamp,
+            angles,
+            tuple(angleFilter.velocity for angleFilter in self.angleFilters),
+            compute_joint_positions(
+                self.greenPositionCm,
+                angles,
+                (self.firstLinkLengthCm, self.secondLinkLengthCm),
+            ),
+        )